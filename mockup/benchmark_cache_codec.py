@@ -0,0 +1,139 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/benchmark_cache_codec.py
+#
+# Compare encodings of the values in the database results cache, see
+# webserver/src/cache_codec.py: the bare pickles the cache used to
+# store, and the rows format, uncompressed and compressed with zlib and
+# with bz2 above COMPRESS_THRESHOLD bytes.
+#
+# The values are what the server caches for lists: the reconstructed
+# rows of GET_LATEST_LIST_WITH_LIST_ID for one list, and of
+# GET_LATEST_LISTS_WITH_USER_ID for a user's lists, along with the one
+# UUID rows of the role and owner statements. For each value and
+# encoding we report the encoded size, the median time to encode and
+# to decode it, and the redis memory used per key when KEYS_PER_VALUE
+# copies of it are stored.
+#
+# Needs a local redis-server. Uses, and empties, REDIS_DATABASE_ID.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import json
+import uuid
+import random
+import datetime
+import logging
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src"))
+from cache_codec import CacheCodec
+from model.ListItem import ListItem
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'benchmark_cache_codec'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+REDIS_HOSTNAME = "localhost"
+REDIS_PORT = 6379
+REDIS_DATABASE_ID = 15
+
+COMPRESS_THRESHOLD = 1024
+CODECS = [("pickle", CacheCodec(format="pickle")),
+          ("rows", CacheCodec(format="rows", compress_threshold=0)),
+          ("rows+zlib", CacheCodec(format="rows", compression="zlib", compress_threshold=COMPRESS_THRESHOLD)),
+          ("rows+bz2", CacheCodec(format="rows", compression="bz2", compress_threshold=COMPRESS_THRESHOLD))]
+REPETITIONS = 200
+KEYS_PER_VALUE = 1000
+EXPIRY_TIME = 60 * 60
+
+def make_list_row(number_of_items):
+    """ Return a reconstructed row of a list revision with
+    number_of_items items. """
+    list_items = []
+    for i in xrange(number_of_items):
+        ident = str(i + 1)
+        list_item = ListItem(ident,
+                             "Item %s %s" % (ident, random.choice(["book", "lamp", "headphones", "scarf"])),
+                             "http://www.example.com/products/%s" % (random.randint(0, 10 ** 8), ),
+                             random.choice(["", "Size M", "Any colour but green", "The 2012 edition please"]))
+        list_items.append(list_item.to_dict())
+    contents = json.dumps({"title": "Birthday list", "list_items": list_items})
+    datetime_edited = datetime.datetime(2012, 11, 3, 12, 0, 0) + datetime.timedelta(microseconds=random.randint(0, 10 ** 12))
+    return (str(uuid.uuid4()), str(uuid.uuid4()), contents, datetime_edited, str(uuid.uuid4()), random.randint(0, 19))
+
+def make_values():
+    return [("role id", [(str(uuid.uuid4()), )]),
+            ("1 list, 10 items", [make_list_row(10)]),
+            ("1 list, 100 items", [make_list_row(100)]),
+            ("20 lists, 20 items", [make_list_row(20) for i in xrange(20)])]
+
+def time_codec(codec, value):
+    """ Return (encoded size, median encode time, median decode time). """
+    fresh_until = time.time()
+    encode_durations = []
+    decode_durations = []
+    for i in xrange(REPETITIONS):
+        start = time.time()
+        data = codec.encode(value, fresh_until)
+        middle = time.time()
+        decoded = codec.decode(data)
+        end = time.time()
+        encode_durations.append(middle - start)
+        decode_durations.append(end - middle)
+    assert(decoded == (fresh_until, value))
+    encode_durations.sort()
+    decode_durations.sort()
+    return (len(data),
+            encode_durations[len(encode_durations) // 2],
+            decode_durations[len(decode_durations) // 2])
+
+def memory_per_key(r, data):
+    """ Return the bytes of redis memory per key, including its overhead,
+    when KEYS_PER_VALUE keys hold data. """
+    r.flushdb()
+    used_memory_before = r.info()["used_memory"]
+    pipe = r.pipeline(transaction=False)
+    for i in xrange(KEYS_PER_VALUE):
+        key = "v1.1:%s:GET_LATEST_LIST_WITH_LIST_ID" % (uuid.uuid4(), )
+        pipe.execute_command("SETEX", key, EXPIRY_TIME, data)
+    pipe.execute()
+    used_memory_after = r.info()["used_memory"]
+    r.flushdb()
+    return float(used_memory_after - used_memory_before) / KEYS_PER_VALUE
+
+if __name__ == "__main__":
+    random.seed(0)
+    r = redis.StrictRedis(host=REDIS_HOSTNAME,
+                          port=REDIS_PORT,
+                          db=REDIS_DATABASE_ID)
+    r.flushdb()
+    try:
+        logger.info("%20s %10s %10s %12s %12s %16s" % ("value", "codec", "bytes", "encode (us)", "decode (us)", "redis per key"))
+        for (value_name, value) in make_values():
+            for (codec_name, codec) in CODECS:
+                (number_of_bytes, encode_duration, decode_duration) = time_codec(codec, value)
+                data = codec.encode(value, time.time())
+                logger.info("%20s %10s %10d %12.1f %12.1f %16.0f" % (value_name,
+                                                                     codec_name,
+                                                                     number_of_bytes,
+                                                                     encode_duration * 10 ** 6,
+                                                                     decode_duration * 10 ** 6,
+                                                                     memory_per_key(r, data)))
+    finally:
+        r.flushdb()
@@ -0,0 +1,108 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/benchmark_cache_invalidation.py
+#
+# Compare the latency of expiring the cached results for one user
+# using the old KEYS "*pattern*" scan against the tag index in
+# webserver/src/cache_index.py, as the total number of keys in the
+# database results cache grows.
+#
+# Needs a local redis-server. Uses, and empties, REDIS_DATABASE_ID.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import uuid
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src"))
+from cache_index import CacheTagIndex
+from async_redis import SyncRedisClient
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'benchmark_cache_invalidation'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+REDIS_HOSTNAME = "localhost"
+REDIS_PORT = 6379
+REDIS_DATABASE_ID = 15
+
+KEY_COUNTS = [1000, 10000, 100000, 1000000]
+KEYS_PER_USER = 10
+REPETITIONS = 20
+EXPIRY_TIME = 60 * 60
+FILL_BATCH_SIZE = 10000
+
+def fill_unrelated_keys(client, index, number_of_keys):
+    """ Fill the cache with keys that belong to other users. """
+    commands = []
+    for i in xrange(number_of_keys):
+        other_user_id = uuid.uuid4().hex
+        key = "%s:GET_LATEST_LISTS_WITH_USER_ID" % (other_user_id, )
+        commands.append(("SETEX", key, EXPIRY_TIME, "x"))
+        index.add(commands, key, [other_user_id])
+        if len(commands) >= FILL_BATCH_SIZE:
+            client.pipeline(commands)
+            commands = []
+    client.pipeline(commands)
+
+def add_user_keys(client, index, user_id):
+    commands = []
+    for i in xrange(KEYS_PER_USER):
+        key = "%s:%s:STATEMENT_%s" % (user_id, i, i)
+        commands.append(("SETEX", key, EXPIRY_TIME, "x"))
+        index.add(commands, key, [user_id])
+    client.pipeline(commands)
+
+def expire_with_keys_scan(r, pattern):
+    for key in r.keys("*%s*" % (pattern, )):
+        r.delete(key)
+
+def expire_with_tag_index(index, tag):
+    # The sync client runs the callback before returning.
+    index.invalidate(tag, callback=lambda number_of_keys: None)
+
+def time_invalidation(client, index, invalidate):
+    durations = []
+    for i in xrange(REPETITIONS):
+        user_id = uuid.uuid4().hex
+        add_user_keys(client, index, user_id)
+        start = time.time()
+        invalidate(user_id)
+        durations.append(time.time() - start)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+if __name__ == "__main__":
+    client = SyncRedisClient(host=REDIS_HOSTNAME,
+                             port=REDIS_PORT,
+                             db=REDIS_DATABASE_ID)
+    r = client.r
+    index = CacheTagIndex(client, EXPIRY_TIME)
+    r.flushdb()
+    try:
+        number_of_keys_so_far = 0
+        logger.info("%12s %18s %18s" % ("keys", "KEYS scan (ms)", "tag index (ms)"))
+        for number_of_keys in KEY_COUNTS:
+            fill_unrelated_keys(client, index, number_of_keys - number_of_keys_so_far)
+            number_of_keys_so_far = number_of_keys
+            scan_duration = time_invalidation(client, index, lambda tag: expire_with_keys_scan(r, tag))
+            index_duration = time_invalidation(client, index, lambda tag: expire_with_tag_index(index, tag))
+            logger.info("%12s %18.3f %18.3f" % (number_of_keys,
+                                                scan_duration * 1000,
+                                                index_duration * 1000))
+    finally:
+        r.flushdb()
@@ -0,0 +1,194 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/benchmark_list_deltas.py
+#
+# Measure what delta-encoded list revisions cost and save, for several
+# values of list_snapshot_interval. 1 is the old behaviour of storing
+# every revision in full.
+#
+# For each workload and interval we edit a list EDITS times, through the
+# statements in webserver/src/database.py. In the "rename" workload an
+# edit either adds an item or renames one. In the "delete" workload the
+# list is grown to DELETE_WORKLOAD_ITEMS items, and from then on an edit
+# either deletes a random item or adds one. Then we report the bytes of contents stored per edit,
+# the size of the list table, and how long it takes to read the latest
+# revision of the list, i.e. run GET_LATEST_LIST_WITH_LIST_ID and
+# reconstruct the contents from the chain. Reads are uncached here; the
+# server caches the reconstructed contents.
+#
+# Needs a local PostgreSQL. Everything is done in a scratch schema,
+# BENCHMARK_SCHEMA, which is dropped afterwards.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import json
+import uuid
+import random
+import logging
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src"))
+from database import DatabaseManager
+from model.ListItem import ListItem
+import create_tables
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'benchmark_list_deltas'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+DATABASE_NAME = "helpmeshop"
+DATABASE_USERNAME = "ubuntu"
+DATABASE_PASSWORD = "password"
+DATABASE_HOST = "localhost"
+DATABASE_PORT = 5432
+BENCHMARK_SCHEMA = "benchmark_list_deltas"
+
+SNAPSHOT_INTERVALS = [1, 10, 20, 50]
+# With 499 edits the latest revision is the last delta of its chain for
+# every interval in SNAPSHOT_INTERVALS, i.e. the slowest one to read.
+EDITS = 499
+FRACTION_OF_EDITS_THAT_ADD_AN_ITEM = 0.7
+DELETE_WORKLOAD_ITEMS = 100
+FRACTION_OF_EDITS_THAT_DELETE_AN_ITEM = 0.5
+WORKLOADS = ["rename", "delete"]
+REPETITIONS = 50
+
+def create_schema(cur):
+    cur.execute("DROP SCHEMA IF EXISTS %s CASCADE;" % (BENCHMARK_SCHEMA, ))
+    cur.execute("CREATE SCHEMA %s;" % (BENCHMARK_SCHEMA, ))
+    cur.execute("SET search_path TO %s, public;" % (BENCHMARK_SCHEMA, ))
+    for statement in [create_tables.CREATE_LIST_TABLE,
+                      create_tables.CREATE_LIST_HEAD_TABLE,
+                      create_tables.INDEX_LIST_ID_ON_LIST,
+                      create_tables.INDEX_USER_ID_ON_LIST_HEAD,
+                      create_tables.INDEX_SNAPSHOT_REVISION_ID_ON_LIST]:
+        cur.execute(statement)
+
+def edit(contents, workload, edit_number):
+    """ Return the contents after the edit_number'th edit of workload. """
+    decoded = json.loads(contents)
+    list_items = decoded["list_items"]
+    if workload == "delete":
+        if len(list_items) >= DELETE_WORKLOAD_ITEMS and random.random() < FRACTION_OF_EDITS_THAT_DELETE_AN_ITEM:
+            del list_items[random.randrange(len(list_items))]
+            return json.dumps(decoded)
+        adding = True
+    else:
+        adding = not list_items or random.random() < FRACTION_OF_EDITS_THAT_ADD_AN_ITEM
+    if adding:
+        ident = str(edit_number + 1)
+        list_item = ListItem(ident, "Item %s" % (ident, ), "http://example.com/%s" % (ident, ), "Some notes")
+        list_items.append(list_item.to_json())
+    else:
+        i = random.randrange(len(list_items))
+        list_item = ListItem.from_json(list_items[i])
+        list_item.title = "Renamed %s" % (random.randint(0, 1000000), )
+        list_items[i] = list_item.to_json()
+    return json.dumps(decoded)
+
+def fill(cur, workload, snapshot_interval):
+    """ Create a list, edit it EDITS times, and return (list_id, contents
+    of the latest revision). """
+    cur.execute("TRUNCATE list, list_head;")
+    user_id = str(uuid.uuid4())
+    list_id = str(uuid.uuid4())
+    revision_id = str(uuid.uuid4())
+    contents = json.dumps({"title": "New list", "list_items": []})
+    cur.execute(DatabaseManager.CREATE_LIST_RETURN_LIST_ID,
+                {"revision_id": revision_id,
+                 "list_id": list_id,
+                 "user_id": user_id,
+                 "contents": contents,
+                 "title": "New list"})
+    parent_row = (revision_id, list_id, contents, None, revision_id, 0)
+    for i in xrange(EDITS):
+        contents = edit(contents, workload, i)
+        revision_id = str(uuid.uuid4())
+        (stored_contents, snapshot_revision_id, delta_number) = DatabaseManager.encode_list_revision(parent_row,
+                                                                                                     revision_id,
+                                                                                                     contents,
+                                                                                                     snapshot_interval)
+        cur.execute(DatabaseManager.UPDATE_LIST_WITH_PARENT_REVISION_ID,
+                    {"list_id": list_id,
+                     "parent_revision_id": parent_row[0],
+                     "revision_id": revision_id,
+                     "user_id": user_id,
+                     "contents": stored_contents,
+                     "snapshot_revision_id": snapshot_revision_id,
+                     "delta_number": delta_number,
+                     "title": "New list"})
+        assert(cur.rowcount == 1)
+        parent_row = (revision_id, list_id, contents, None, snapshot_revision_id, delta_number)
+    cur.execute("ANALYZE list;")
+    return (list_id, contents)
+
+def time_read(cur, list_id, expected_contents):
+    """ Return the median time to (query, reconstruct) the list. """
+    query_durations = []
+    reconstruct_durations = []
+    for i in xrange(REPETITIONS):
+        start = time.time()
+        cur.execute(DatabaseManager.GET_LATEST_LIST_WITH_LIST_ID, (list_id, ))
+        rows = cur.fetchall()
+        middle = time.time()
+        reconstructed_rows = DatabaseManager.reconstruct_list_revisions(rows)
+        end = time.time()
+        query_durations.append(middle - start)
+        reconstruct_durations.append(end - middle)
+    assert(json.loads(reconstructed_rows[0][2]) == json.loads(expected_contents))
+    query_durations.sort()
+    reconstruct_durations.sort()
+    return (query_durations[len(query_durations) // 2],
+            reconstruct_durations[len(reconstruct_durations) // 2])
+
+if __name__ == "__main__":
+    random.seed(0)
+    conn = psycopg2.connect(dbname=DATABASE_NAME,
+                            user=DATABASE_USERNAME,
+                            password=DATABASE_PASSWORD,
+                            host=DATABASE_HOST,
+                            port=DATABASE_PORT)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    try:
+        create_schema(cur)
+        logger.info("%d edits of one list per workload" % (EDITS, ))
+        logger.info("rename: %d%% adding an item, the rest renaming one" % (FRACTION_OF_EDITS_THAT_ADD_AN_ITEM * 100, ))
+        logger.info("delete: at %d items, %d%% deleting an item, the rest adding one" % (DELETE_WORKLOAD_ITEMS, FRACTION_OF_EDITS_THAT_DELETE_AN_ITEM * 100))
+        logger.info("%10s %10s %16s %11s %16s %14s %18s" % ("workload", "interval", "bytes per edit", "snapshots", "table size (kB)", "query (ms)", "reconstruct (ms)"))
+        for workload in WORKLOADS:
+            for snapshot_interval in SNAPSHOT_INTERVALS:
+                random.seed(0)
+                (list_id, contents) = fill(cur, workload, snapshot_interval)
+                cur.execute("SELECT sum(octet_length(contents)), sum(CASE WHEN delta_number = 0 THEN 1 ELSE 0 END) FROM list;")
+                (stored_bytes, snapshots) = cur.fetchone()
+                bytes_per_edit = float(stored_bytes) / (EDITS + 1)
+                cur.execute("SELECT pg_total_relation_size('list');")
+                table_size = cur.fetchone()[0]
+                (query_duration, reconstruct_duration) = time_read(cur, list_id, contents)
+                logger.info("%10s %10s %16.0f %11d %16.0f %14.3f %18.3f" % (workload,
+                                                                            snapshot_interval,
+                                                                            bytes_per_edit,
+                                                                            snapshots,
+                                                                            table_size / 1024.0,
+                                                                            query_duration * 1000,
+                                                                            reconstruct_duration * 1000))
+    finally:
+        cur.execute("DROP SCHEMA IF EXISTS %s CASCADE;" % (BENCHMARK_SCHEMA, ))
+        cur.close()
+        conn.close()
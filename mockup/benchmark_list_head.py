@@ -0,0 +1,152 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/benchmark_list_head.py
+#
+# Compare the latency of reading the latest revision of lists with the
+# old MAX(datetime_edited) GROUP BY self-joins against the list_head
+# lookups in webserver/src/database.py, as the number of revisions per
+# list grows.
+#
+# Needs a local PostgreSQL with the uuid-ossp extension. Everything is
+# done in a scratch schema, BENCHMARK_SCHEMA, which is dropped
+# afterwards, so the tables in DATABASE_NAME are left alone.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import random
+import logging
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src"))
+from database import DatabaseManager
+import create_tables
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'benchmark_list_head'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+DATABASE_NAME = "helpmeshop"
+DATABASE_USERNAME = "ubuntu"
+DATABASE_PASSWORD = "password"
+DATABASE_HOST = "localhost"
+DATABASE_PORT = 5432
+BENCHMARK_SCHEMA = "benchmark_list_head"
+
+NUMBER_OF_USERS = 20
+LISTS_PER_USER = 10
+REVISIONS_PER_LIST = [10, 100, 1000, 5000]
+REPETITIONS = 20
+
+# The statements that list_head replaces.
+OLD_GET_LATEST_LISTS_WITH_USER_ID = """
+    SELECT L.revision_id, L.list_id, L.contents, L.datetime_edited
+    FROM list L
+    INNER JOIN (
+        SELECT list_id, MAX(datetime_edited) AS datetime_edited
+        FROM list
+        WHERE helpmeshop_user_id = %s
+        GROUP BY list_id
+    ) X
+    ON X.list_id = L.list_id AND
+       X.datetime_edited = L.datetime_edited;"""
+OLD_GET_LATEST_LIST_WITH_LIST_ID = """
+    SELECT L.revision_id, L.list_id, L.contents, L.datetime_edited
+    FROM list L
+    INNER JOIN (
+        SELECT list_id, MAX(datetime_edited) AS datetime_edited
+        FROM list
+        GROUP BY list_id
+    ) X
+    ON X.list_id = L.list_id AND
+       X.datetime_edited = L.datetime_edited
+    WHERE L.list_id = %s;"""
+
+# Revision n of a list is edited n seconds after its first revision.
+INSERT_REVISIONS = """
+    INSERT INTO list (revision_id, list_id, helpmeshop_user_id, datetime_edited, contents)
+    SELECT uuid_generate_v4(), %s, %s,
+           TIMESTAMP '2011-01-01' + n * INTERVAL '1 second',
+           '{"title": "List ' || n || '", "list_items": []}'
+    FROM generate_series(1, %s) AS n;"""
+
+def create_schema(cur):
+    cur.execute("DROP SCHEMA IF EXISTS %s CASCADE;" % (BENCHMARK_SCHEMA, ))
+    cur.execute("CREATE SCHEMA %s;" % (BENCHMARK_SCHEMA, ))
+    cur.execute("SET search_path TO %s, public;" % (BENCHMARK_SCHEMA, ))
+    for statement in [create_tables.CREATE_LIST_TABLE,
+                      create_tables.CREATE_LIST_HEAD_TABLE,
+                      create_tables.INDEX_LIST_ID_ON_LIST,
+                      create_tables.INDEX_USER_ID_ON_LIST_HEAD]:
+        cur.execute(statement)
+
+def fill(cur, revisions_per_list):
+    """ Return (user_ids, list_ids) of the lists that were created. """
+    cur.execute("TRUNCATE list, list_head;")
+    user_ids = []
+    list_ids = []
+    for i in xrange(NUMBER_OF_USERS):
+        cur.execute("SELECT uuid_generate_v4();")
+        user_id = cur.fetchone()[0]
+        user_ids.append(user_id)
+        for j in xrange(LISTS_PER_USER):
+            cur.execute("SELECT uuid_generate_v4();")
+            list_id = cur.fetchone()[0]
+            list_ids.append(list_id)
+            cur.execute(INSERT_REVISIONS, (list_id, user_id, revisions_per_list))
+    cur.execute(create_tables.BACKFILL_LIST_HEAD)
+    cur.execute("ANALYZE list;")
+    cur.execute("ANALYZE list_head;")
+    return (user_ids, list_ids)
+
+def time_statement(cur, statement, candidate_args):
+    durations = []
+    for i in xrange(REPETITIONS):
+        args = (random.choice(candidate_args), )
+        start = time.time()
+        cur.execute(statement, args)
+        cur.fetchall()
+        durations.append(time.time() - start)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+if __name__ == "__main__":
+    random.seed(0)
+    conn = psycopg2.connect(dbname=DATABASE_NAME,
+                            user=DATABASE_USERNAME,
+                            password=DATABASE_PASSWORD,
+                            host=DATABASE_HOST,
+                            port=DATABASE_PORT)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    try:
+        create_schema(cur)
+        logger.info("%10s %10s %22s %22s %22s %22s" % ("revisions", "rows",
+                                                       "user, GROUP BY (ms)", "user, list_head (ms)",
+                                                       "list, GROUP BY (ms)", "list, list_head (ms)"))
+        for revisions_per_list in REVISIONS_PER_LIST:
+            (user_ids, list_ids) = fill(cur, revisions_per_list)
+            number_of_rows = len(list_ids) * revisions_per_list
+            durations = [time_statement(cur, OLD_GET_LATEST_LISTS_WITH_USER_ID, user_ids),
+                         time_statement(cur, DatabaseManager.GET_LATEST_LISTS_WITH_USER_ID, user_ids),
+                         time_statement(cur, OLD_GET_LATEST_LIST_WITH_LIST_ID, list_ids),
+                         time_statement(cur, DatabaseManager.GET_LATEST_LIST_WITH_LIST_ID, list_ids)]
+            logger.info("%10s %10s %22.3f %22.3f %22.3f %22.3f" % tuple([revisions_per_list, number_of_rows] + [duration * 1000 for duration in durations]))
+    finally:
+        cur.execute("DROP SCHEMA IF EXISTS %s CASCADE;" % (BENCHMARK_SCHEMA, ))
+        cur.close()
+        conn.close()
@@ -0,0 +1,119 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/benchmark_render_fragments.py
+#
+# Time rendering read_list.html for a list of 10, 100 and 1,000 items,
+# as ListReadHandler does for a logged in user, with the fragment cache
+# disabled, i.e. every item's form rendered on every view, and with
+# the list's fragment already cached, i.e. a lookup and swapping the
+# XSRF token in. See BasePageHandler.render_fragment().
+#
+# Needs nothing but the webserver's Python dependencies.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import json
+import uuid
+import datetime
+import logging
+
+WEBSERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src")
+sys.path.insert(0, WEBSERVER_PATH)
+import tornado.web
+import tornado.httpserver
+from tornado.options import options
+import assets
+from model.List import List
+from ListHandler import ListsHandler, ListReadHandler, ListCreateHandler, ListDeleteHandler
+from ListHandler import ListCreateItemHandler, ListUpdateItemHandler, ListDeleteItemHandler
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'benchmark_render_fragments'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+LIST_SIZES = [10, 100, 1000]
+REPETITIONS = 20
+
+def make_application():
+    """ Return an Application with the templates, and the handlers they
+    link to, of the server. """
+    handlers = [
+        tornado.web.URLSpec(pattern=r"/lists/",                      handler_class=ListsHandler, name="ListsHandler"),
+        tornado.web.URLSpec(pattern=r"/list/create",                 handler_class=ListCreateHandler, name="ListCreateHandler"),
+        tornado.web.URLSpec(pattern=r"/list/(.*)/read",              handler_class=ListReadHandler, name="ListReadHandler"),
+        tornado.web.URLSpec(pattern=r"/list/([^/]*)/delete",         handler_class=ListDeleteHandler, name="ListDeleteHandler"),
+        tornado.web.URLSpec(pattern=r"/list/(.*)/item/create",       handler_class=ListCreateItemHandler, name="ListCreateItemHandler"),
+        tornado.web.URLSpec(pattern=r"/list/(.*)/item/(.*)/update",  handler_class=ListUpdateItemHandler, name="ListUpdateItemHandler"),
+        tornado.web.URLSpec(pattern=r"/list/(.*)/item/(.*)/delete",  handler_class=ListDeleteItemHandler, name="ListDeleteItemHandler"),
+    ]
+    return tornado.web.Application(handlers,
+                                   template_path=os.path.join(WEBSERVER_PATH, "templates"),
+                                   static_path=os.path.join(WEBSERVER_PATH, "static"),
+                                   static_handler_class=assets.AssetFileHandler,
+                                   ui_methods={"asset_urls": assets.asset_urls},
+                                   xsrf_cookies=True,
+                                   cookie_secret="benchmark")
+
+def make_list(number_of_items):
+    list_items = [{"ident": str(i + 1),
+                   "title": "Item %s" % (i + 1, ),
+                   "url": "http://example.com/%s" % (i, ),
+                   "notes": "Some notes about item %s" % (i + 1, )} for i in xrange(number_of_items)]
+    contents = json.dumps({"title": "A list of %s items" % (number_of_items, ),
+                           "list_items": list_items})
+    return List(str(uuid.uuid4()), str(uuid.uuid4()), contents, datetime.datetime.utcnow())
+
+def render(application, list_obj):
+    """ Render the page as ListReadHandler.get() does, for a new request
+    from a new browser. """
+    request = tornado.httpserver.HTTPRequest("GET", "/list/%s/read" % (list_obj.url_safe_list_id, ), connection=None)
+    handler = ListReadHandler(application, request)
+    handler._current_user = "user"
+    list_contents = handler.render_fragment("fragment_list_contents.html",
+                                            list_obj.revision_id,
+                                            list_obj=list_obj,
+                                            user=handler.current_user)
+    return handler.render_string("read_list.html",
+                                 list_obj=list_obj,
+                                 user=handler.current_user,
+                                 list_contents=list_contents)
+
+def time_render(application, list_obj):
+    durations = []
+    for i in xrange(REPETITIONS):
+        start = time.time()
+        render(application, list_obj)
+        durations.append(time.time() - start)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+if __name__ == "__main__":
+    logger.info("%10s %14s %14s" % ("items", "uncached (ms)", "cached (ms)"))
+    for number_of_items in LIST_SIZES:
+        list_obj = make_list(number_of_items)
+
+        options.fragment_cache_max_entries = 0
+        application = make_application()
+        uncached_duration = time_render(application, list_obj)
+
+        options.fragment_cache_max_entries = 100
+        options.fragment_cache_max_bytes = 64 * 1024 * 1024
+        application = make_application()
+        render(application, list_obj)
+        cached_duration = time_render(application, list_obj)
+
+        logger.info("%10d %14.2f %14.2f" % (number_of_items, uncached_duration * 1000, cached_duration * 1000))
@@ -0,0 +1,104 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/benchmark_render_lists.py
+#
+# Time the work the server does for /lists/ once it has the rows from
+# the database: build a model.List for every row, as
+# DatabaseManager.get_lists() does, and render lists.html, for a user
+# with NUMBER_OF_LISTS lists of ITEMS_PER_LIST items each.
+#
+# The items of a list used to be stored as JSON strings inside the
+# contents, and are now stored as JSON objects. Both are timed, as
+# lists written before the change are still read.
+#
+# Needs nothing but the webserver's Python dependencies.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import json
+import uuid
+import datetime
+import logging
+
+WEBSERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src")
+sys.path.insert(0, WEBSERVER_PATH)
+import tornado.template
+import assets
+from model.List import List
+from model.ListItem import ListItem
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'benchmark_render_lists'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+NUMBER_OF_LISTS = 500
+ITEMS_PER_LIST = 100
+REPETITIONS = 10
+
+def get_rows(items_as_strings):
+    rows = []
+    for i in xrange(NUMBER_OF_LISTS):
+        list_items = []
+        for j in xrange(ITEMS_PER_LIST):
+            list_item = {"ident": str(j + 1),
+                         "title": "Item %s of list %s" % (j + 1, i),
+                         "url": "http://example.com/%s/%s" % (i, j),
+                         "notes": "Some notes about item %s" % (j + 1, )}
+            if items_as_strings:
+                list_item = json.dumps(list_item)
+            list_items.append(list_item)
+        contents = json.dumps({"title": "List %s" % (i, ),
+                               "list_items": list_items})
+        rows.append((str(uuid.uuid4()), str(uuid.uuid4()), contents, datetime.datetime.now()))
+    return rows
+
+def static_url(path):
+    return "/static/%s" % (path, )
+
+class Handler(object):
+    """ What the UI methods the templates call need of a handler. """
+    static_url = staticmethod(static_url)
+
+HANDLER = Handler()
+
+def render(template, rows):
+    lists = [List(revision_id, list_id, contents, datetime_edited) for (revision_id, list_id, contents, datetime_edited) in rows]
+    return template.generate(lists=lists,
+                             user="user",
+                             title="Help Me Shop",
+                             reverse_url=lambda name, *args: "/%s/%s" % (name, "/".join(args)),
+                             static_url=static_url,
+                             asset_urls=lambda name: assets.asset_urls(HANDLER, name),
+                             xsrf_form_html=lambda: '<input type="hidden" name="_xsrf" value="x"/>')
+
+def time_render(template, rows):
+    durations = []
+    for i in xrange(REPETITIONS):
+        start = time.time()
+        render(template, rows)
+        durations.append(time.time() - start)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+if __name__ == "__main__":
+    loader = tornado.template.Loader(os.path.join(WEBSERVER_PATH, "templates"))
+    template = loader.load("lists.html")
+    logger.info("%s lists of %s items" % (NUMBER_OF_LISTS, ITEMS_PER_LIST))
+    for (label, items_as_strings) in [("items stored as strings", True),
+                                      ("items stored as objects", False)]:
+        rows = get_rows(items_as_strings)
+        logger.info("%s: %.1f ms" % (label, time_render(template, rows) * 1000))
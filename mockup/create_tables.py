@@ -8,6 +8,9 @@
 # Assume that the PostgreSQL database is empty and create all
 # the tables from scratch.
 #
+# Run with the argument "migrate" to instead add whatever is missing
+# to an existing database, see MIGRATE_STATEMENTS.
+#
 # Refer to helpmeshop/doc/database_model.[vsd/png].
 # ----------------------------------------------------------------------
 
@@ -113,13 +116,27 @@ CREATE_AUTH_API_TABLE = """CREATE TABLE auth_api (
     
 # Lists.
 DROP_LIST_TABLE = """DROP TABLE IF EXISTS list;"""
+# contents is either the full contents of the list, if delta_number is
+# 0, or a JSON patch from the revision before. See
+# webserver/src/database.py.
 CREATE_LIST_TABLE = """CREATE TABLE list (revision_id UUID PRIMARY KEY,
                                           list_id UUID NOT NULL,
                                           helpmeshop_user_id UUID NOT NULL,
                                           datetime_edited TIMESTAMP NOT NULL,
                                           contents TEXT NOT NULL,
+                                          snapshot_revision_id UUID NOT NULL,
+                                          delta_number INTEGER NOT NULL DEFAULT 0,
                                           UNIQUE(list_id, datetime_edited));"""
 
+# Latest revision, owner and title of every list. Kept up to date by the
+# list CRUD statements in webserver/src/database.py.
+DROP_LIST_HEAD_TABLE = """DROP TABLE IF EXISTS list_head;"""
+CREATE_LIST_HEAD_TABLE = """CREATE TABLE list_head (list_id UUID PRIMARY KEY,
+                                                    revision_id UUID UNIQUE NOT NULL,
+                                                    helpmeshop_user_id UUID NOT NULL,
+                                                    title TEXT,
+                                                    datetime_edited TIMESTAMP NOT NULL);"""
+
 INSERT_STATEMENTS = [DROP_ROLE_TABLE,
                      CREATE_ROLE_TABLE,
                      DROP_USER_TABLE,
@@ -135,7 +152,9 @@ INSERT_STATEMENTS = [DROP_ROLE_TABLE,
                      DROP_AUTH_API_TABLE,
                      CREATE_AUTH_API_TABLE,
                      DROP_LIST_TABLE,
-                     CREATE_LIST_TABLE]
+                     CREATE_LIST_TABLE,
+                     DROP_LIST_HEAD_TABLE,
+                     CREATE_LIST_HEAD_TABLE]
 # ----------------------------------------------------------------------
 
 # ----------------------------------------------------------------------
@@ -145,7 +164,11 @@ INSERT_STATEMENTS = [DROP_ROLE_TABLE,
 # http://www.postgresql.org/docs/8.2/static/indexes-unique.html
 # ----------------------------------------------------------------------
 INDEX_LIST_ID_ON_LIST = """CREATE INDEX list_id_on_list on list(list_id);"""
-INDEX_STATEMENTS = [INDEX_LIST_ID_ON_LIST]
+INDEX_USER_ID_ON_LIST_HEAD = """CREATE INDEX helpmeshop_user_id_on_list_head on list_head(helpmeshop_user_id);"""
+INDEX_SNAPSHOT_REVISION_ID_ON_LIST = """CREATE INDEX snapshot_revision_id_on_list on list(snapshot_revision_id, delta_number);"""
+INDEX_STATEMENTS = [INDEX_LIST_ID_ON_LIST,
+                    INDEX_USER_ID_ON_LIST_HEAD,
+                    INDEX_SNAPSHOT_REVISION_ID_ON_LIST]
 # ----------------------------------------------------------------------
 
 # ----------------------------------------------------------------------
@@ -156,6 +179,62 @@ FOREIGN_KEY_STATEMENTS = []
 
 ALL_STATEMENTS = INSERT_STATEMENTS + INDEX_STATEMENTS + FOREIGN_KEY_STATEMENTS                  
 
+# ----------------------------------------------------------------------
+# Migrations.
+#
+# Run with "python create_tables.py migrate" to bring an existing
+# database up to date without dropping anything.
+#
+# list_head: create the table and fill it in from the list table. The
+# head of a list is its latest revision, the owner is the user who
+# made its first revision. Titles are filled in by migrate(), as they
+# are stored inside the JSON contents.
+#
+# Delta-encoded revisions: every existing revision already holds the full
+# contents of its list, i.e. is a snapshot.
+# ----------------------------------------------------------------------
+BACKFILL_LIST_HEAD = """
+    INSERT INTO list_head (list_id, revision_id, helpmeshop_user_id, title, datetime_edited)
+    SELECT latest.list_id, latest.revision_id, first.helpmeshop_user_id, NULL, latest.datetime_edited
+    FROM (
+        SELECT DISTINCT ON (list_id) list_id, revision_id, datetime_edited
+        FROM list
+        ORDER BY list_id, datetime_edited DESC
+    ) latest
+    INNER JOIN (
+        SELECT DISTINCT ON (list_id) list_id, helpmeshop_user_id
+        FROM list
+        ORDER BY list_id, datetime_edited ASC
+    ) first
+    ON first.list_id = latest.list_id
+    WHERE NOT EXISTS (SELECT 1 FROM list_head H WHERE H.list_id = latest.list_id);"""
+SELECT_LIST_HEADS_WITHOUT_TITLE = """
+    SELECT H.list_id, L.contents
+    FROM list_head H
+    INNER JOIN list L
+    ON L.revision_id = H.revision_id
+    WHERE H.title IS NULL;"""
+UPDATE_LIST_HEAD_TITLE = """UPDATE list_head SET title = %s WHERE list_id = %s;"""
+
+ADD_LIST_SNAPSHOT_COLUMNS = """
+    ALTER TABLE list
+    ADD COLUMN IF NOT EXISTS snapshot_revision_id UUID,
+    ADD COLUMN IF NOT EXISTS delta_number INTEGER NOT NULL DEFAULT 0;"""
+BACKFILL_LIST_SNAPSHOT_REVISION_ID = """
+    UPDATE list
+    SET snapshot_revision_id = revision_id
+    WHERE snapshot_revision_id IS NULL;"""
+SET_LIST_SNAPSHOT_REVISION_ID_NOT_NULL = """ALTER TABLE list ALTER COLUMN snapshot_revision_id SET NOT NULL;"""
+
+MIGRATE_STATEMENTS = [CREATE_LIST_HEAD_TABLE.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS"),
+                      INDEX_USER_ID_ON_LIST_HEAD.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS"),
+                      BACKFILL_LIST_HEAD,
+                      ADD_LIST_SNAPSHOT_COLUMNS,
+                      BACKFILL_LIST_SNAPSHOT_REVISION_ID,
+                      SET_LIST_SNAPSHOT_REVISION_ID_NOT_NULL,
+                      INDEX_SNAPSHOT_REVISION_ID_ON_LIST.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS")]
+# ----------------------------------------------------------------------
+
 # ----------------------------------------------------------------------
 # insert_dummy_data() commands.
 # ----------------------------------------------------------------------
@@ -245,6 +324,26 @@ def insert_dummy_data(cur):
                 logger.debug("user insert args:\n%s" % (pprint.pformat(args), ))
                 cur.execute(INSERT_CONDITION_REPORT, args)
 
+def migrate(cur):
+    """ Bring an existing database up to date. Safe to run repeatedly. """
+    logger = logging.getLogger("%s.migrate" % (APP_NAME, ))
+    logger.info("entry")
+    for statement in MIGRATE_STATEMENTS:
+        logger.info("Executing: %s" % (statement, ))
+        cur.execute(statement)
+        logger.info("rowcount: %s" % (cur.rowcount, ))
+
+    cur.execute(SELECT_LIST_HEADS_WITHOUT_TITLE)
+    titles = []
+    for (list_id, contents) in cur.fetchall():
+        try:
+            title = json.loads(contents).get("title", "")
+        except ValueError:
+            title = ""
+        titles.append((title, list_id))
+    logger.info("Filling in %s list titles..." % (len(titles), ))
+    cur.executemany(UPDATE_LIST_HEAD_TITLE, titles)
+
 if __name__ == "__main__":
     logger.info("Starting main.  args: %s" % (sys.argv[1:], ))
     
@@ -261,10 +360,13 @@ if __name__ == "__main__":
     cur = conn.cursor()    
     logger.debug("Opened database connection and cursor.")        
     try:
-        for statement in ALL_STATEMENTS:
-            logger.info("Executing: %s" % (statement, ))
-            cur.execute(statement)        
-        insert_dummy_data(cur)
+        if sys.argv[1:2] == ["migrate"]:
+            migrate(cur)
+        else:
+            for statement in ALL_STATEMENTS:
+                logger.info("Executing: %s" % (statement, ))
+                cur.execute(statement)        
+            insert_dummy_data(cur)
     finally:
         logger.debug("Closing database connection and cursor...")
         conn.commit()
@@ -0,0 +1,162 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/loadtest_lists.py
+#
+# Log in with an API key and then fire concurrent GET requests at the
+# server, reporting throughput and latency percentiles.
+#
+# Usage:
+#
+#   python loadtest_lists.py <api_secret_key> [label] [path]
+#
+# path defaults to /lists/, and may be a full URL instead. An
+# api_secret_key of - fetches as an anonymous reader. To compare redis clients run the server
+# against a local redis-server twice, once with
+# redis_use_sync_client = True and once with it False in server.conf,
+# and run this script against each, e.g.
+#
+#   python loadtest_lists.py <key> sync
+#   python loadtest_lists.py <key> async
+#
+# Logging is compared the same way, e.g. with log_level = "DEBUG" and
+# log_async = False and then True, see webserver/src/async_logging.py:
+#
+#   python loadtest_lists.py <key> log-sync
+#   python loadtest_lists.py <key> log-async
+#
+# To compare the page of a list served by the server with the page
+# published for nginx, see webserver/src/publisher.py, fetch it
+# anonymously from each, e.g.
+#
+#   python loadtest_lists.py - server /list/<id>/read
+#   python loadtest_lists.py - nginx https://<host>/list/<id>/read
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import urllib
+import logging
+import Cookie
+
+import tornado.ioloop
+import tornado.httpclient
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'loadtest_lists'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+BASE_URL = "http://127.0.0.1:8000"
+NUMBER_OF_REQUESTS = 2000
+CONCURRENCY = 50
+WARMUP_REQUESTS = 50
+
+def get_cookies(response, cookies):
+    for header in response.headers.get_list("Set-Cookie"):
+        cookie = Cookie.SimpleCookie(header)
+        for (name, morsel) in cookie.items():
+            cookies[name] = morsel.value
+    return cookies
+
+def format_cookies(cookies):
+    return "; ".join("%s=%s" % (name, value) for (name, value) in cookies.items())
+
+def log_in(api_secret_key):
+    """ Return the cookies of a session logged in with api_secret_key. """
+    http_client = tornado.httpclient.HTTPClient()
+    cookies = {}
+    response = http_client.fetch(BASE_URL + "/login/api/")
+    get_cookies(response, cookies)
+    body = urllib.urlencode({"api_secret_key": api_secret_key,
+                             "_xsrf": cookies["_xsrf"]})
+    try:
+        response = http_client.fetch(BASE_URL + "/login/api/",
+                                     method="POST",
+                                     body=body,
+                                     headers={"Cookie": format_cookies(cookies)},
+                                     follow_redirects=False)
+    except tornado.httpclient.HTTPError, e:
+        response = e.response
+    assert response.code == 302, "Login failed: %s" % (response.code, )
+    get_cookies(response, cookies)
+    assert "user" in cookies
+    return cookies
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run(url, cookies, number_of_requests):
+    """ Fetch url number_of_requests times, CONCURRENCY at a time.
+    Returns (duration, latencies, errors). """
+    io_loop = tornado.ioloop.IOLoop.instance()
+    http_client = tornado.httpclient.AsyncHTTPClient(max_clients=CONCURRENCY)
+    headers = {"Cookie": format_cookies(cookies)}
+    state = {"started": 0, "finished": 0, "errors": 0}
+    latencies = []
+
+    def start_one():
+        if state["started"] >= number_of_requests:
+            return
+        state["started"] += 1
+        start_time = time.time()
+        http_client.fetch(url,
+                          headers=headers,
+                          callback=lambda response: on_response(response, start_time))
+
+    def on_response(response, start_time):
+        latencies.append(time.time() - start_time)
+        if response.code != 200:
+            state["errors"] += 1
+        state["finished"] += 1
+        if state["finished"] == number_of_requests:
+            io_loop.stop()
+        else:
+            start_one()
+
+    start_time = time.time()
+    for i in xrange(CONCURRENCY):
+        start_one()
+    io_loop.start()
+    duration = time.time() - start_time
+    latencies.sort()
+    return (duration, latencies, state["errors"])
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        logger.error("Usage: %s <api_secret_key> [label] [path]" % (sys.argv[0], ))
+        sys.exit(1)
+    api_secret_key = sys.argv[1]
+    label = len(sys.argv) > 2 and sys.argv[2] or ""
+    path = len(sys.argv) > 3 and sys.argv[3] or "/lists/"
+    if path.startswith("http"):
+        url = path
+    else:
+        url = BASE_URL + path
+
+    if api_secret_key == "-":
+        cookies = {}
+    else:
+        cookies = log_in(api_secret_key)
+    run(url, cookies, WARMUP_REQUESTS)
+    (duration, latencies, errors) = run(url, cookies, NUMBER_OF_REQUESTS)
+    logger.info("%s %s: %s requests, concurrency %s, %s errors" % (label, path, NUMBER_OF_REQUESTS, CONCURRENCY, errors))
+    logger.info("%s throughput: %.1f requests/s" % (label, NUMBER_OF_REQUESTS / duration))
+    logger.info("%s latency ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % \
+                (label,
+                 percentile(latencies, 0.50) * 1000,
+                 percentile(latencies, 0.90) * 1000,
+                 percentile(latencies, 0.99) * 1000,
+                 latencies[-1] * 1000))
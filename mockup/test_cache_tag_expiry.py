@@ -0,0 +1,85 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/test_cache_tag_expiry.py
+#
+# Check that tagging a cache key never shortens the life of its tag
+# sets below that of any key already in them, whatever the cache
+# policies of the keys, and that invalidating the tag then still finds
+# the longer-lived key. See CacheTagIndex.add() in
+# webserver/src/cache_index.py.
+#
+# Needs a local redis-server. Uses, and empties, REDIS_DATABASE_ID.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import uuid
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src"))
+from cache_index import CacheTagIndex
+from async_redis import SyncRedisClient
+from database import DatabaseManager
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'test_cache_tag_expiry'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+REDIS_HOSTNAME = "localhost"
+REDIS_PORT = 6379
+REDIS_DATABASE_ID = 15
+
+def store(client, index, key, tags, policy):
+    """ Store key as DatabaseManager.add_store_commands() does. """
+    commands = [("SETEX", key, policy.ttl + policy.stale_grace, "x")]
+    index.add(commands, key, tags)
+    client.pipeline(commands)
+
+def check_policies(client, index, long_name, short_name):
+    """ Tag a key of statement long_name, then one of short_name, with
+    the same list_id and check that the tag set outlives the first. """
+    long_policy = DatabaseManager.CACHE_POLICIES[long_name]
+    short_policy = DatabaseManager.CACHE_POLICIES[short_name]
+    list_id = uuid.uuid4().hex
+    long_key = "%s:%s" % (list_id, long_name)
+    short_key = "%s:%s" % (list_id, short_name)
+    tag_key = index.get_tag_key(list_id)
+    store(client, index, long_key, [list_id], long_policy)
+    store(client, index, short_key, [list_id], short_policy)
+    long_ttl = client.r.ttl(long_key)
+    tag_ttl = client.r.ttl(tag_key)
+    logger.info("%s: %s s, %s: %s s, tag set: %s s",
+                long_name, long_ttl, short_name, client.r.ttl(short_key), tag_ttl)
+    assert tag_ttl >= long_ttl, "tag set expires before %s" % (long_key, )
+    results = []
+    index.invalidate(list_id, callback=results.append)
+    assert results == [2], results
+    assert not client.r.exists(long_key)
+    assert not client.r.exists(short_key)
+
+if __name__ == "__main__":
+    client = SyncRedisClient(host=REDIS_HOSTNAME,
+                             port=REDIS_PORT,
+                             db=REDIS_DATABASE_ID)
+    client.r.flushdb()
+    try:
+        index = CacheTagIndex(client, DatabaseManager.TAG_EXPIRY_TIME)
+        for policy in DatabaseManager.CACHE_POLICIES.values() + [DatabaseManager.DEFAULT_CACHE_POLICY]:
+            assert DatabaseManager.TAG_EXPIRY_TIME >= policy.ttl + policy.stale_grace
+        check_policies(client, index, "GET_OWNER_USER_ID_WITH_LIST_ID", "GET_LATEST_LIST_WITH_LIST_ID")
+        check_policies(client, index, "GET_LATEST_LIST_WITH_LIST_ID", "GET_OWNER_USER_ID_WITH_LIST_ID")
+        logger.info("OK")
+    finally:
+        client.r.flushdb()
@@ -0,0 +1,127 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2011 Asim Ihsan (asim dot ihsan at gmail dot com)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+# File: helpmeshop/src/mockup/test_redis_clients.py
+#
+# Check that SyncRedisClient and AsyncRedisClient, in
+# webserver/src/async_redis.py, return identical values for the same
+# commands, pipelines and transactions against the same redis.
+#
+# Every case starts from an empty database with the setup commands
+# run, once for each client.
+#
+# Needs a local redis-server. Uses, and empties, REDIS_DATABASE_ID.
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import logging
+
+import tornado.gen
+import tornado.ioloop
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "webserver", "src"))
+from async_redis import SyncRedisClient, AsyncRedisClient
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+APP_NAME = 'test_redis_clients'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+# ----------------------------------------------------------------------
+
+REDIS_HOSTNAME = "localhost"
+REDIS_PORT = 6379
+REDIS_DATABASE_ID = 15
+
+SETUP = [("SET", "string", "value"),
+         ("SETEX", "expiring", 1000, "value"),
+         ("HSET", "hash", "field", "value"),
+         ("SADD", "set", "member")]
+
+# (name, command or list of commands, transaction). A list of commands
+# is sent as a pipeline.
+CASES = [("GET", ("GET", "string"), False),
+         ("GET missing", ("GET", "missing"), False),
+         ("MGET", ("MGET", "string", "missing"), False),
+         ("SET", ("SET", "key", "value"), False),
+         ("SET NX", ("SET", "key", "value", "NX", "EX", 10), False),
+         ("SET NX existing", ("SET", "string", "value", "NX", "EX", 10), False),
+         ("SETEX", ("SETEX", "key", 10, "value"), False),
+         ("DEL", ("DEL", "string"), False),
+         ("DEL missing", ("DEL", "missing"), False),
+         ("EXISTS", ("EXISTS", "string"), False),
+         ("EXISTS missing", ("EXISTS", "missing"), False),
+         ("EXPIRE", ("EXPIRE", "string", 10), False),
+         ("EXPIRE missing", ("EXPIRE", "missing", 10), False),
+         ("TTL", ("TTL", "expiring"), False),
+         ("TTL no expiry", ("TTL", "string"), False),
+         ("TTL missing", ("TTL", "missing"), False),
+         ("HGETALL", ("HGETALL", "hash"), False),
+         ("HGETALL missing", ("HGETALL", "missing"), False),
+         ("HDEL", ("HDEL", "hash", "field"), False),
+         ("HDEL missing", ("HDEL", "hash", "missing"), False),
+         ("SADD", ("SADD", "set", "member", "other"), False),
+         ("SMEMBERS", ("SMEMBERS", "set"), False),
+         ("SMEMBERS missing", ("SMEMBERS", "missing"), False),
+         ("pipeline", [("GET", "string"),
+                       ("SET", "missing", "value", "NX"),
+                       ("DEL", "missing"),
+                       ("TTL", "missing"),
+                       ("HGETALL", "hash")], False),
+         ("transaction", [("SMEMBERS", "set"),
+                          ("DEL", "set")], True),
+         ("transaction missing", [("DEL", "missing"),
+                                  ("TTL", "missing")], True)]
+
+@tornado.gen.engine
+def run_case(client, command, transaction, callback):
+    sync_client.r.flushdb()
+    sync_client.pipeline(SETUP)
+    if isinstance(command, list):
+        response = yield tornado.gen.Task(client.pipeline, command, transaction=transaction)
+    else:
+        response = yield tornado.gen.Task(client.execute_command, *command)
+    callback(response)
+
+@tornado.gen.engine
+def run_cases(callback):
+    failures = 0
+    for (name, command, transaction) in CASES:
+        sync_response = yield tornado.gen.Task(run_case, sync_client, command, transaction)
+        async_response = yield tornado.gen.Task(run_case, async_client, command, transaction)
+        # repr() tells apart e.g. 1 and 1L, anywhere in the reply.
+        if repr(sync_response) == repr(async_response):
+            logger.info("%-20s %r", name, sync_response)
+        else:
+            logger.error("%-20s sync: %r, async: %r", name, sync_response, async_response)
+            failures += 1
+    callback(failures)
+
+def on_cases_run(failures):
+    io_loop.stop()
+    sync_client.r.flushdb()
+    if failures:
+        logger.error("%d of %d cases differ", failures, len(CASES))
+        sys.exit(1)
+    logger.info("OK")
+
+if __name__ == "__main__":
+    io_loop = tornado.ioloop.IOLoop.instance()
+    sync_client = SyncRedisClient(host=REDIS_HOSTNAME,
+                                  port=REDIS_PORT,
+                                  db=REDIS_DATABASE_ID)
+    async_client = AsyncRedisClient(host=REDIS_HOSTNAME,
+                                    port=REDIS_PORT,
+                                    db=REDIS_DATABASE_ID,
+                                    max_connections=1)
+    io_loop.add_callback(lambda: run_cases(callback=on_cases_run))
+    io_loop.start()
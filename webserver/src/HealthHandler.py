@@ -0,0 +1,56 @@
+# ----------------------------------------------------------------------------
+#   NOTES
+#
+#   /health is 200 once this process has started up, see start_up() in
+#   start_server.py, and 503 until then. haproxy checks it, see
+#   infrastructure/haproxy.conf, so that a server is only sent traffic
+#   once it is warm.
+#
+#   All the processes of a server accept on the same port, so a check
+#   reaches whichever process accepts it. They start up at the same time,
+#   but the first process also warms up the shared cache, so it may be
+#   ready a while after the others.
+#
+#   The addresses in metrics_allowed_ips also get the state of this
+#   process's database pools and redis connections.
+# ----------------------------------------------------------------------------
+
+import os
+import logging
+import tornado
+import tornado.web
+import tornado.escape
+import tornado.process
+from tornado.options import options
+
+import metrics
+from base_request_handlers import BaseHandler
+
+class HealthHandler(BaseHandler):
+    def get(self):
+        logger = logging.getLogger("HealthHandler.get")
+        ready = getattr(self.application, "ready", False)
+        health = {"ready": ready,
+                  "pid": os.getpid(),
+                  "task_id": tornado.process.task_id()}
+        allowed_ips = [ip.strip() for ip in options.metrics_allowed_ips.split(",")]
+        if self.request.remote_ip in allowed_ips:
+            health["pools"] = dict((name, metrics.get_pool_statistics(client))
+                                   for (name, client) in metrics.registry.pools.iteritems())
+            health["redis"] = self.get_redis_statistics()
+        if not ready:
+            logger.debug("not ready yet.")
+            self.set_status(503)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.finish(tornado.escape.json_encode(health))
+
+    def get_redis_statistics(self):
+        """ Return the connection counts of the redis clients created at
+        start-up. Only AsyncRedisClient keeps any. """
+        redis_statistics = {}
+        for (name, manager) in [("database_results", getattr(self.application, "db", None)),
+                                ("user_sessions", getattr(self.application, "user_session", None))]:
+            if manager is not None and hasattr(manager.r, "get_statistics"):
+                redis_statistics[name] = manager.r.get_statistics()
+        return redis_statistics
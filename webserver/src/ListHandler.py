@@ -1,11 +1,13 @@
 # ----------------------------------------------------------------------------
 #   NOTES
 #
-#   !!AI List modification (reading, deleting) must be based on a revision_id
-#   as well as the list_id. This prevents situations where you're modifying
-#   a list which has already been modified by someone else, in which case
-#   you need to refresh your view of the list before continuing. For now,
-#   let's ignore this.
+#   Item modification (creating, updating, deleting) is based on a
+#   revision_id as well as the list_id. This prevents situations where
+#   you're modifying a list which has already been modified by someone
+#   else, in which case you get a 409 and need to refresh your view of
+#   the list before continuing. See BaseListModifyHandler.modify_list().
+#
+#   !!AI Deleting a whole list isn't based on a revision_id yet.
 #
 #   #!!AI All list modification operations must use POSTs. This will force
 #   Tornado to check XSRF. Of course, we could hack our own XSRF using GETs,
@@ -15,13 +17,130 @@
 import logging
 import base64
 import pprint
+import uuid
 import tornado
+import tornado.gen
 import tornado.escape
+import tornado.stack_context
 
 from model.List import List
 from base_request_handlers import BasePageHandler
 from utilities import validate_base64_parameter, convert_uuid_string_to_base64, convert_base64_to_uuid_string, normalize_uuid_string
         
+class BaseListHandler(BasePageHandler):
+    """ Base class for handlers that show or change a list. """
+    def render_read_list(self, list_obj, user):
+        """ Return the page of list_obj for 'user', None for an anonymous
+        reader. """
+        data = {}
+        data['list_obj'] = list_obj
+        data['user'] = user
+        data['list_contents'] = self.render_fragment("fragment_list_contents.html",
+                                                     list_obj.revision_id,
+                                                     list_obj=list_obj,
+                                                     user=user)
+        return self.render_string("read_list.html", **data)
+
+    def publish_list(self, list_id):
+        """ Publish the page of the list for anonymous readers, see
+        publisher.py, as it is now that it has been written, or remove
+        it if the list is gone. Call after every write; nobody needs to
+        wait for this. """
+        if self.publisher is None:
+            return
+        # Publishing outlives the request, so mustn't run in its stack
+        # context, where errors would go to a handler that has finished.
+        with tornado.stack_context.NullContext():
+            self._publish_list(list_id)
+
+    @tornado.gen.engine
+    def _publish_list(self, list_id):
+        logger = logging.getLogger("BaseListHandler._publish_list")
+        url_safe_list_id = convert_uuid_string_to_base64(list_id)
+        try:
+            list_obj = yield tornado.gen.Task(self.db.read_list,
+                                              list_id,
+                                              primary=True)
+            if not list_obj:
+                logger.debug("unpublishing. list_id: %s", list_id)
+                self.publisher.unpublish(url_safe_list_id)
+            else:
+                logger.debug("publishing. list_id: %s, revision_id: %s", list_id, list_obj.revision_id)
+                self.publisher.publish(url_safe_list_id,
+                                       self.render_read_list(list_obj, None),
+                                       list_obj.datetime_edited)
+        except Exception:
+            # nginx would go on serving the page of the revision before
+            # this write, so remove it and let the server answer instead.
+            logger.exception("failed to publish, unpublishing. list_id: %s", list_id)
+            self.publisher.unpublish(url_safe_list_id)
+
+class BaseListModifyHandler(BaseListHandler):
+    """ Base class for handlers that modify a list, which only the owner
+    of the list may do. """
+    @tornado.gen.engine
+    def check_list_owner(self, list_id, callback):
+        """ Raise a 404 if the list doesn't exist, or a 403 if the current
+        user doesn't own it. """
+        logger = logging.getLogger("BaseListModifyHandler.check_list_owner")
+        owner_user_id_obj = yield tornado.gen.Task(self.db.get_owner_user_id,
+                                                   list_id,
+                                                   primary=self.read_from_primary)
+        logger.debug("list_id: %s, owner: %s, current_user: %s", list_id, owner_user_id_obj, self.current_user)
+        if owner_user_id_obj is None:
+            raise tornado.web.HTTPError(404, "Could not find the list.")
+        if owner_user_id_obj != uuid.UUID(self.current_user):
+            raise tornado.web.HTTPError(403, "User does not own the list.")
+        callback()
+
+    @tornado.gen.engine
+    def modify_list(self, list_id, revision_id, change, callback):
+        """ Apply 'change', a function that takes a List and changes it,
+        to revision 'revision_id' of the list, the one the user saw, and
+        write the result as the next revision. Returns the new
+        revision_id.
+
+        Raise a 404 if the list doesn't exist or 'change' returns False,
+        and a 409 if revision_id isn't the latest revision of the list
+        any more. If revision_id is None the latest revision we know of
+        is changed instead.
+
+        The list comes from the cache, so the only database round trip
+        is the conditional write. On a cache miss the list is read from
+        the primary database, as a replica that lags would make the
+        write fail. The cache of this process may not have heard of a
+        write made through another one yet, so if the user saw a
+        different revision than the cached one the list is read again
+        from the primary, uncached, before answering 409. """
+        logger = logging.getLogger("BaseListModifyHandler.modify_list")
+        logger.debug("list_id: %s, revision_id: %s", list_id, revision_id)
+        list_obj = yield tornado.gen.Task(self.db.read_list,
+                                          list_id,
+                                          primary=True)
+        if list_obj and revision_id is not None and \
+           normalize_uuid_string(revision_id) != normalize_uuid_string(list_obj.revision_id):
+            logger.debug("cached list is at revision_id: %s", list_obj.revision_id)
+            list_obj = yield tornado.gen.Task(self.db.read_list,
+                                              list_id,
+                                              primary=True,
+                                              cached=False)
+        if not list_obj:
+            raise tornado.web.HTTPError(404, "Could not find the list.")
+        if revision_id is not None and \
+           normalize_uuid_string(revision_id) != normalize_uuid_string(list_obj.revision_id):
+            logger.debug("list is at revision_id: %s", list_obj.revision_id)
+            raise tornado.web.HTTPError(409, "The list has changed. Refresh it and try again.")
+        if change(list_obj) == False:
+            raise tornado.web.HTTPError(404, "Could not find the item.")
+        new_revision_id = yield tornado.gen.Task(self.db.update_list_revision,
+                                                 list_obj,
+                                                 self.current_user)
+        if not new_revision_id:
+            raise tornado.web.HTTPError(409, "The list has changed. Refresh it and try again.")
+        self.record_write()
+        self.publish_list(list_id)
+        callback(new_revision_id)
+
 class ListsHandler(BasePageHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
@@ -33,21 +152,24 @@ class ListsHandler(BasePageHandler):
             raise tornado.web.HTTPError(403)    
         data = {}
         data['user'] = tornado.escape.xhtml_escape(self.current_user)
-        lists = yield tornado.gen.Task(self.db.get_lists, self.current_user)
-        for list_obj in lists:
-            contents_decoded = tornado.escape.json_decode(list_obj.contents)
-            setattr(list_obj, "title", contents_decoded["title"])
-        logger.debug("lists:\n%s" % (pprint.pformat(lists), ))        
+        lists = yield tornado.gen.Task(self.db.get_lists,
+                                       self.current_user,
+                                       primary=self.read_from_primary)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("lists:\n%s", pprint.pformat(lists))
+        last_modified = max([list_obj.datetime_edited for list_obj in lists] or [None])
+        if self.check_not_modified([list_obj.revision_id for list_obj in lists], last_modified):
+            return
         data['lists'] = lists 
         data['title'] = "Help Me Shop"      
         self.render("lists.html", **data)   
 
-class ListCreateHandler(BasePageHandler):
+class ListCreateHandler(BaseListHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
     def post(self):
         logger = logging.getLogger("ListCreateHandler.post")
-        logger.debug("entry. current_user: %s" % (self.current_user, ))
+        logger.debug("entry. current_user: %s", self.current_user)
         if not self.current_user:
             logging.debug("User is not authorized.")
             raise tornado.web.HTTPError(403)
@@ -56,40 +178,34 @@ class ListCreateHandler(BasePageHandler):
         new_list_id = yield tornado.gen.Task(self.db.create_list,
                                              self.current_user,
                                              tornado.escape.json_encode(new_list_contents))
-        logger.debug("new_list_id: %s" % (new_list_id, ))
+        logger.debug("new_list_id: %s", new_list_id)
+        self.record_write()
+        self.publish_list(str(new_list_id))
         
         new_url = self.reverse_url("ListsHandler")
-        logger.debug("Redirecting to: %s" % (new_url, ))
+        logger.debug("Redirecting to: %s", new_url)
         self.redirect(new_url)        
 
 # ----------------------------------------------------------------------------
-#   Simplest way of doing this is to:
-#   - Read the current list object from the database.
-#   - Write new contents into the object.
-#   - Write the object back to the database.
-#   - Read the current list object from the database.
-#
-#   !!AI Creating an item is the same as modifying or deleting an item,
-#   because items are encoded in the JSON 'contents' field. Hence refactor
-#   this code into a base class later.
-#
-#   !!AI We also need to pass in the revision_id of the list version we 
-#   think we're modifying. If this is no longer the newest revision_id
-#   then bail out in a manner useful to the user ("You need to refresh").
-#   But I want to stop using variables in the path, and use real URL
-#   encoding.
+#   Creating, updating and deleting an item all:
+#   - Read the current list object, from the cache.
+#   - Change the list object.
+#   - Write the object back to the database, as the revision that follows
+#     the one the user saw, see BaseListModifyHandler.modify_list().
 # ----------------------------------------------------------------------------
-class ListCreateItemHandler(BasePageHandler):
+class ListCreateItemHandler(BaseListModifyHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
     def post(self, list_id_base64):
         logger = logging.getLogger("ListCreateItemHandler.post")
-        logger.debug("entry. list_id_base64: %s, current_user: %s" % (list_id_base64, self.current_user, ))
+        logger.debug("entry. list_id_base64: %s, current_user: %s", list_id_base64, self.current_user)
         
         # --------------------------------------------------------------------
-        #   Gather inputs.
+        #   Gather inputs. Older pages don't send list_revision_id, in
+        #   which case the item is added to the latest revision.
         # --------------------------------------------------------------------
         list_id_base64 = str(list_id_base64)
+        revision_id_base64 = self.get_argument("list_revision_id", None)
         # --------------------------------------------------------------------
         
         # --------------------------------------------------------------------
@@ -100,8 +216,13 @@ class ListCreateItemHandler(BasePageHandler):
             raise tornado.web.HTTPError(403)        
         if not validate_base64_parameter(list_id_base64):
             raise tornado.web.HTTPError(400, "List identifier is malformed.")
+        if revision_id_base64 is not None and not validate_base64_parameter(str(revision_id_base64)):
+            raise tornado.web.HTTPError(400, "Revision identifier is malformed.")
         list_id = convert_base64_to_uuid_string(str(list_id_base64))                
-        logger.debug("list_id: %s" % (list_id, ))
+        logger.debug("list_id: %s", list_id)
+        revision_id = None
+        if revision_id_base64 is not None:
+            revision_id = convert_base64_to_uuid_string(str(revision_id_base64))
         # --------------------------------------------------------------------
         
         # --------------------------------------------------------------------
@@ -112,61 +233,34 @@ class ListCreateItemHandler(BasePageHandler):
         #   - If the list exists.
         #   - The user is the owner of this particular list. This is currently
         #     defined as the user with the first edit, i.e. the creator.
-        #
-        #   !!AI For now ignore this. This urgently needs implementation.
-        # --------------------------------------------------------------------
-        
-        # --------------------------------------------------------------------
-        
         # --------------------------------------------------------------------
-        #   Get the current list object.
-        # --------------------------------------------------------------------
-        list_obj = yield tornado.gen.Task(self.db.read_list,                                
-                                          list_id)
-        if not list_obj:
-            raise tornado.web.HTTPError(404, "Could not find the list.")        
+        yield tornado.gen.Task(self.check_list_owner, list_id)
         # --------------------------------------------------------------------
         
         # --------------------------------------------------------------------
         #   Add a new list item to the list and then add it to the database.        
         # --------------------------------------------------------------------        
-        # Everything except this line belongs in a base class.
-        list_obj.create_item()        
-        
-        rc = yield tornado.gen.Task(self.db.update_list,
-                                    list_obj.list_id,
-                                    self.current_user,
-                                    list_obj.contents)
-        logger.debug("update_list rc: %s" % (rc, ))              
-        if rc != True:
-            raise tornado.web.HTTPError(500, "Failed to create a new item in the list.")
-        # --------------------------------------------------------------------
-        
-        # --------------------------------------------------------------------
-        #   Read in the new list object, confirm that the revision ID has
-        #   changed.
-        # --------------------------------------------------------------------
-        new_list_obj = yield tornado.gen.Task(self.db.read_list,                                
-                                              list_id)
-        if not new_list_obj:
-            raise tornado.web.HTTPError(404, "Could not find the list after updating it.")
-        assert(new_list_obj.revision_id != list_obj.revision_id)
+        new_revision_id = yield tornado.gen.Task(self.modify_list,
+                                                 list_id,
+                                                 revision_id,
+                                                 lambda list_obj: list_obj.create_item())
+        logger.debug("new_revision_id: %s", new_revision_id)
         # --------------------------------------------------------------------
         
         # --------------------------------------------------------------------
         #   Re-direct to the read list page.
         # --------------------------------------------------------------------
-        new_url = self.reverse_url("ListReadHandler", new_list_obj.url_safe_list_id)
-        logger.debug("redirecting to: %s" % (new_url, ))
+        new_url = self.reverse_url("ListReadHandler", list_id_base64)
+        logger.debug("redirecting to: %s", new_url)
         self.redirect(new_url)
 # ----------------------------------------------------------------------------
         
-class ListDeleteHandler(BasePageHandler):
+class ListDeleteHandler(BaseListHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
     def post(self, list_id_base64):
         logger = logging.getLogger("ListDeleteHandler.post")
-        logger.debug("entry. current_user: %s" % (self.current_user, ))
+        logger.debug("entry. current_user: %s", self.current_user)
         
         # --------------------------------------------------------------------
         #   Gather inputs.
@@ -185,28 +279,30 @@ class ListDeleteHandler(BasePageHandler):
         # --------------------------------------------------------------------
         
         list_id = convert_base64_to_uuid_string(str(list_id_base64))        
-        logger.debug("list_id: %s" % (list_id, ))
+        logger.debug("list_id: %s", list_id)
         rc = yield tornado.gen.Task(self.db.delete_list,                                
                                     list_id,
                                     self.current_user)
-        logger.debug("rc: %s" % (rc, ))        
+        logger.debug("rc: %s", rc)        
         if rc != True:
             raise tornado.web.HTTPError(400, "Failed to delete the list.")
+        self.record_write()
+        self.publish_list(list_id)
             
         new_url = self.reverse_url("ListsHandler")
-        logger.debug("Redirecting to: %s" % (new_url, ))
+        logger.debug("Redirecting to: %s", new_url)
         self.redirect(new_url)
 
 # ----------------------------------------------------------------------------
 #   Keep in mind that lists are public, so we don't need to authenticate
 #   users who simply want to view a list.
 # ----------------------------------------------------------------------------
-class ListReadHandler(BasePageHandler):
+class ListReadHandler(BaseListHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
     def get(self, list_id_base64): 
         logger = logging.getLogger("ListReadHandler.get")
-        logger.debug("entry. list_id_base64: %s" % (list_id_base64, ))
+        logger.debug("entry. list_id_base64: %s", list_id_base64)
         
         # --------------------------------------------------------------------
         #   Gather and validate inputs.
@@ -215,35 +311,44 @@ class ListReadHandler(BasePageHandler):
         if not validate_base64_parameter(list_id_base64):
             raise tornado.web.HTTPError(400, "List identifier is malformed.")                    
         list_id = convert_base64_to_uuid_string(str(list_id_base64))        
-        logger.debug("list_id: %s" % (list_id, ))
+        logger.debug("list_id: %s", list_id)
         # --------------------------------------------------------------------
         
         list_obj = yield tornado.gen.Task(self.db.read_list,                                
-                                          list_id)
+                                          list_id,
+                                          primary=self.read_from_primary)
         if not list_obj:
             raise tornado.web.HTTPError(404)
-        data = {}
-        data['list_obj'] = list_obj
-        data['user'] = self.current_user                
-        self.render("read_list.html", **data)     
+        if self.check_not_modified([list_obj.revision_id], list_obj.datetime_edited):
+            return
+        if not self.current_user:
+            self.finish_with_cached_body(("read_list.html", list_obj.revision_id),
+                                         [normalize_uuid_string(list_obj.list_id)],
+                                         lambda: self.render_read_list(list_obj, None))
+            return
+        self.finish(self.render_read_list(list_obj, self.current_user))
         
-class ListUpdateItemHandler(BasePageHandler):
+class ListUpdateItemHandler(BaseListModifyHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
     def post(self, list_id_base64, item_ident):
         logger = logging.getLogger("ListUpdateItemHandler.post")
-        logger.debug("entry. list_id_base64: %s, item_ident: %s" % (list_id_base64, item_ident))
-        logger.debug("request: %s" % (self.request, ))
-        logger.debug("request arguments\n%s" % (pprint.pformat(self.request.arguments), ))
-        logger.debug("request files: %s" % (self.request.files, ))
+        logger.debug("entry. list_id_base64: %s, item_ident: %s", list_id_base64, item_ident)
+        logger.debug("request: %s", self.request)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("request arguments\n%s", pprint.pformat(self.request.arguments))
+        logger.debug("request files: %s", self.request.files)
         
         # --------------------------------------------------------------------
         #   Gather the arguments. GET arguments come for free in the
         #   function call.
         # --------------------------------------------------------------------
         revision_id_base64 = str(self.get_argument("list_revision_id"))
-        logger.debug("revision_id_base64: %s" % (revision_id_base64, ))
+        logger.debug("revision_id_base64: %s", revision_id_base64)
         list_id_base64 = str(list_id_base64)
+        title = self.get_argument("list_item_title", None)
+        url = self.get_argument("list_item_url", None)
+        notes = self.get_argument("list_item_notes", None)
         # --------------------------------------------------------------------        
         
         # --------------------------------------------------------------------
@@ -266,27 +371,38 @@ class ListUpdateItemHandler(BasePageHandler):
         revision_id = convert_base64_to_uuid_string(str(revision_id_base64))        
         # --------------------------------------------------------------------
         
+        yield tornado.gen.Task(self.check_list_owner, list_id)
+        
+        new_revision_id = yield tornado.gen.Task(self.modify_list,
+                                                 list_id,
+                                                 revision_id,
+                                                 lambda list_obj: list_obj.update_item(item_ident,
+                                                                                       title,
+                                                                                       url,
+                                                                                       notes))
+        logger.debug("new_revision_id: %s", new_revision_id)
+        
         # --------------------------------------------------------------------
         #   Return to the view that shows the list being read.
         # --------------------------------------------------------------------
         new_url = self.reverse_url("ListReadHandler", list_id_base64)
-        logger.debug("redirecting to: %s" % (new_url, ))
+        logger.debug("redirecting to: %s", new_url)
         self.redirect(new_url)
         # --------------------------------------------------------------------
     
-class ListDeleteItemHandler(BasePageHandler):
+class ListDeleteItemHandler(BaseListModifyHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
     def post(self, list_id_base64, item_ident):
         logger = logging.getLogger("ListDeleteItemHandler.post")
-        logger.debug("entry. list_id_base64: %s, item_ident: %s" % (list_id_base64, item_ident))
+        logger.debug("entry. list_id_base64: %s, item_ident: %s", list_id_base64, item_ident)
         
         # --------------------------------------------------------------------
         #   Gather the arguments. GET arguments come for free in the
         #   function call.
         # --------------------------------------------------------------------
         revision_id_base64 = str(self.get_argument("list_revision_id"))
-        logger.debug("revision_id_base64: %s" % (revision_id_base64, ))
+        logger.debug("revision_id_base64: %s", revision_id_base64)
         list_id_base64 = str(list_id_base64)
         # --------------------------------------------------------------------        
         
@@ -310,10 +426,18 @@ class ListDeleteItemHandler(BasePageHandler):
         revision_id = convert_base64_to_uuid_string(str(revision_id_base64))        
         # --------------------------------------------------------------------
         
+        yield tornado.gen.Task(self.check_list_owner, list_id)
+        
+        new_revision_id = yield tornado.gen.Task(self.modify_list,
+                                                 list_id,
+                                                 revision_id,
+                                                 lambda list_obj: list_obj.delete_item(item_ident))
+        logger.debug("new_revision_id: %s", new_revision_id)
+        
         # --------------------------------------------------------------------
         #   Return to the view that shows the list being read.
         # --------------------------------------------------------------------
         new_url = self.reverse_url("ListReadHandler", list_id_base64)
-        logger.debug("redirecting to: %s" % (new_url, ))
+        logger.debug("redirecting to: %s", new_url)
         self.redirect(new_url)
         # --------------------------------------------------------------------
\ No newline at end of file
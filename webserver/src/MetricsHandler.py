@@ -0,0 +1,33 @@
+# ----------------------------------------------------------------------------
+#   NOTES
+#
+#   /metrics returns the metrics of every server process summed, as JSON,
+#   see metrics.py. Only the addresses in metrics_allowed_ips may read
+#   it, as statement names and pool sizes are nobody else's business.
+# ----------------------------------------------------------------------------
+
+import logging
+import tornado
+import tornado.gen
+import tornado.escape
+from tornado.options import options
+
+import metrics
+from base_request_handlers import BaseHandler
+
+class MetricsHandler(BaseHandler):
+    @tornado.web.asynchronous
+    @tornado.gen.engine
+    def get(self):
+        logger = logging.getLogger("MetricsHandler.get")
+        allowed_ips = [ip.strip() for ip in options.metrics_allowed_ips.split(",")]
+        if self.request.remote_ip not in allowed_ips:
+            logger.debug("refusing remote_ip: %s", self.request.remote_ip)
+            raise tornado.web.HTTPError(403)
+        # Create the DatabaseManager, and so register its pools, if no
+        # request has yet.
+        self.db
+        totals = yield tornado.gen.Task(metrics.publisher.aggregate)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.finish(tornado.escape.json_encode(totals))
@@ -0,0 +1,246 @@
+# ----------------------------------------------------------------------------
+#   Fingerprinted static assets.
+#
+#   The stylesheets and scripts the pages link to are grouped into
+#   BUNDLES. Running
+#
+#       python assets.py
+#
+#   as part of a deploy concatenates and minifies the files of every
+#   bundle and writes the result, and a .gz of it for nginx's
+#   gzip_static, under static/assets/ with the hash of its contents in
+#   its name, e.g.
+#
+#       static/assets/js/site.0123456789.js
+#       static/assets/js/site.0123456789.js.gz
+#
+#   followed by static/assets/manifest.json, which maps the name of every
+#   bundle to the file built for it. Files of earlier builds are left in
+#   place, so that pages rendered before a deploy still find their
+#   assets.
+#
+#   Templates link to a bundle with asset_urls(), see the generic header
+#   and footer. With use_built_assets set the URL is that of the built
+#   file, which never changes, so nginx tells browsers to keep it for a
+#   year without asking again, see infrastructure/nginx.conf, as does
+#   AssetFileHandler when tornado serves it. Without it, e.g. while
+#   working on the sources, the page links to every source file of the
+#   bundle through static_url() and nothing needs building.
+#
+#   Minifying is deliberately conservative, see minify_css() and
+#   minify_js(), as gzip does most of the work anyway. Libraries that ship
+#   a minified copy, e.g. jquery.jeditable.mini.js, use it instead.
+# ----------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import errno
+import hashlib
+import logging
+import cStringIO
+import threading
+import tornado.web
+from tornado.options import define, options
+
+from publisher import write_file_atomically
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("use_built_assets", default=False, type=bool, help="Link pages to the bundles built by assets.py, listed in static/assets/manifest.json, rather than to their source files")
+# ----------------------------------------------------------------------------
+
+# (name, source files), relative to the static path. A bundle of one file
+# that is already minified is only fingerprinted.
+BUNDLES = [("css/site.css", ["css/style.css"]),
+           ("js/site.js", ["js/libs/jquery.jeditable.js",
+                           "js/plugins.js",
+                           "js/script.js"]),
+           ("js/libs/modernizr-2.0.6.min.js", ["js/libs/modernizr-2.0.6.min.js"]),
+           ("js/libs/jquery-1.7.1.min.js", ["js/libs/jquery-1.7.1.min.js"])]
+OUTPUT_DIRECTORY = "assets"
+MANIFEST_NAME = "manifest.json"
+HASH_LENGTH = 10
+COMPRESS_LEVEL = 9
+# Built files never change, so may be kept for as long as HTTP allows.
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+# Suffixes of the minified copies that libraries ship.
+MINIFIED_SUFFIXES = [".min", ".mini"]
+DIRECTORY_MODE = 0755
+
+# ----------------------------------------------------------------------------
+#   Building.
+# ----------------------------------------------------------------------------
+# Strings and comments, so that minifying leaves strings alone and isn't
+# confused by quotes in comments.
+REGEXP_CSS_TOKENS = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|/\*.*?\*/)""", re.DOTALL)
+REGEXP_CSS_SPACE_AROUND = re.compile(r" ?([{};,>]) ?")
+REGEXP_CSS_SPACE_AFTER = re.compile(r": ")
+
+def minify_css(css):
+    """ Remove comments, except /*! ones, and whitespace that doesn't
+    change the meaning of css. """
+    tokens = REGEXP_CSS_TOKENS.split(css)
+    # Drop the comments first, so that the whitespace either side of one
+    # is collapsed too.
+    tokens = REGEXP_CSS_TOKENS.split("".join(token for token in tokens
+                                             if not (token.startswith("/*") and not token.startswith("/*!"))))
+    minified = []
+    for (i, token) in enumerate(tokens):
+        if i % 2 == 0:
+            token = re.sub(r"\s+", " ", token)
+            token = REGEXP_CSS_SPACE_AROUND.sub(r"\1", token)
+            token = REGEXP_CSS_SPACE_AFTER.sub(":", token)
+        minified.append(token)
+    return "".join(minified).replace(";}", "}").strip()
+
+def minify_js(js):
+    """ Remove indentation, blank lines and lines that are only comments,
+    except /*! ones. Lines are kept apart, as JavaScript may rely on the
+    newlines to end statements. """
+    lines = []
+    in_comment = False
+    for line in js.splitlines():
+        line = line.strip()
+        if in_comment:
+            if "*/" not in line:
+                continue
+            in_comment = False
+            line = line[line.index("*/") + 2:].strip()
+        if line.startswith("/*") and not line.startswith("/*!"):
+            end = line.find("*/", 2)
+            if end == -1:
+                in_comment = True
+                continue
+            line = line[end + 2:].strip()
+        if not line or line.startswith("//"):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+def get_minified_path(static_path, path):
+    """ Return the minified copy of path, relative to static_path, that
+    it ships with, if any. """
+    (root, extension) = os.path.splitext(path)
+    for suffix in MINIFIED_SUFFIXES:
+        if root.endswith(suffix):
+            return path
+    for suffix in MINIFIED_SUFFIXES:
+        minified_path = root + suffix + extension
+        if os.path.isfile(os.path.join(static_path, minified_path)):
+            return minified_path
+    return None
+
+def build_bundle(static_path, sources):
+    """ Return the concatenated and minified contents of sources. """
+    contents = []
+    for path in sources:
+        minified_path = get_minified_path(static_path, path)
+        with open(os.path.join(static_path, minified_path or path), "rb") as f:
+            data = f.read()
+        if minified_path is None:
+            if path.endswith(".css"):
+                data = minify_css(data)
+            else:
+                data = minify_js(data)
+        contents.append(data.strip())
+    if sources[0].endswith(".js"):
+        # Guard against a file that ends without a semicolon.
+        return ";\n".join(contents) + "\n"
+    return "\n".join(contents) + "\n"
+
+def build(static_path):
+    """ Build every bundle under static_path and write the manifest.
+    Return the manifest. """
+    logger = logging.getLogger("assets.build")
+    manifest = {}
+    modification_time = time.time()
+    for (name, sources) in BUNDLES:
+        data = build_bundle(static_path, sources)
+        (root, extension) = os.path.splitext(name)
+        fingerprint = hashlib.md5(data).hexdigest()[:HASH_LENGTH]
+        output_name = "%s/%s.%s%s" % (OUTPUT_DIRECTORY, root, fingerprint, extension)
+        output_path = os.path.join(static_path, output_name)
+        try:
+            os.makedirs(os.path.dirname(output_path), DIRECTORY_MODE)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        output = cStringIO.StringIO()
+        gzip_file = gzip.GzipFile(mode="wb", fileobj=output, compresslevel=COMPRESS_LEVEL, mtime=0)
+        gzip_file.write(data)
+        gzip_file.close()
+        write_file_atomically(output_path + ".gz", output.getvalue(), modification_time)
+        write_file_atomically(output_path, data, modification_time)
+        source_size = sum(os.path.getsize(os.path.join(static_path, path)) for path in sources)
+        logger.info("%s: %d sources, %d bytes, minified %d, gzipped %d",
+                    output_name, len(sources), source_size, len(data), len(output.getvalue()))
+        manifest[name] = output_name
+    # Written last, so that the manifest never names a file that isn't
+    # there yet.
+    write_file_atomically(os.path.join(static_path, OUTPUT_DIRECTORY, MANIFEST_NAME),
+                          json.dumps(manifest, indent=4, sort_keys=True) + "\n",
+                          modification_time)
+    return manifest
+
+# ----------------------------------------------------------------------------
+#   Serving.
+# ----------------------------------------------------------------------------
+# Manifests read, by static path.
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def load_manifest(static_path):
+    """ Return the manifest built under static_path, reading it on first
+    use. Raises IOError if there is none, i.e. assets.py wasn't run. """
+    with _manifests_lock:
+        if static_path not in _manifests:
+            with open(os.path.join(static_path, OUTPUT_DIRECTORY, MANIFEST_NAME)) as f:
+                _manifests[static_path] = json.load(f)
+        return _manifests[static_path]
+
+class AssetFileHandler(tornado.web.StaticFileHandler):
+    """ Serves the static path as StaticFileHandler does, except that the
+    URL of a bundle is that of its built file, which may be cached for a
+    year, if use_built_assets is set. """
+    @classmethod
+    def make_static_url(cls, settings, path):
+        if options.use_built_assets:
+            output_name = load_manifest(settings["static_path"]).get(path)
+            if output_name is not None:
+                return settings.get("static_url_prefix", "/static/") + output_name
+        return super(AssetFileHandler, cls).make_static_url(settings, path)
+
+    def get_cache_time(self, path, modified, mime_type):
+        if is_built_asset(path):
+            return CACHE_MAX_AGE
+        return super(AssetFileHandler, self).get_cache_time(path, modified, mime_type)
+
+    def set_extra_headers(self, path):
+        if is_built_asset(path):
+            self.set_header("Cache-Control", "public, max-age=%d, immutable" % (CACHE_MAX_AGE, ))
+
+def is_built_asset(path):
+    return path.startswith(OUTPUT_DIRECTORY + "/") and not path.endswith(MANIFEST_NAME)
+
+def asset_urls(handler, name):
+    """ UI method: return the URLs to link to for the bundle name. """
+    if options.use_built_assets:
+        return [handler.static_url(name)]
+    for (bundle_name, sources) in BUNDLES:
+        if bundle_name == name:
+            return [handler.static_url(path) for path in sources]
+    raise KeyError("no bundle named %s" % (name, ))
+# ----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(message)s")
+    if len(sys.argv) > 1:
+        static_path = sys.argv[1]
+    else:
+        static_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    build(static_path)
@@ -0,0 +1,168 @@
+# ----------------------------------------------------------------------------
+#   Logging off the IOLoop thread.
+#
+#   By default the root logger's handlers, a StreamHandler and a
+#   RotatingFileHandler, see start_server.py, format every record and
+#   write it to the terminal and the log file on the thread that logs it,
+#   i.e. the IOLoop. With log_async set, start() moves those handlers
+#   behind a QueueLogHandler instead. Logging a record then only puts it
+#   on a bounded queue, and a writer thread formats and writes it.
+#
+#   The queue is bounded, so that a burst of logging costs memory up to
+#   log_queue_size records and never stalls the IOLoop:
+#
+#   - once the queue is half full, only one in log_sample_every records
+#     below WARNING is queued, the rest are sampled out.
+#   - once the queue is full, records are dropped, whatever their level.
+#
+#   The writer thread logs how many records were sampled out and dropped,
+#   at most every DROPPED_REPORT_INTERVAL seconds, and the counts are
+#   part of /metrics, see metrics.py.
+#
+#   The message of a record is formatted from its arguments by the writer
+#   thread, so arguments must not be changed after they are logged. Log
+#   with arguments, e.g. logger.debug("list_id: %s", list_id), rather than
+#   formatting the message yourself, so that records of disabled levels,
+#   see log_level, cost nothing but the isEnabledFor() check.
+# ----------------------------------------------------------------------------
+
+import time
+import Queue
+import logging
+import threading
+
+from tornado.options import define, options
+
+import metrics
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("log_level", default="DEBUG", help="Level of the root logger, e.g. DEBUG or INFO")
+define("log_async", default=False, type=bool, help="Format and write log records on a background thread")
+define("log_queue_size", default=10000, type=int, help="Maximum number of log records waiting for the background thread")
+define("log_sample_every", default=10, type=int, help="Once the log queue is half full, queue one in this many records below WARNING")
+# ----------------------------------------------------------------------------
+
+# How often, in seconds, the writer thread logs the number of records it
+# lost.
+DROPPED_REPORT_INTERVAL = 10
+# Put on the queue by close() to stop the writer thread.
+STOP = object()
+
+class QueueLogHandler(logging.Handler):
+    def __init__(self, handlers, max_size, sample_every):
+        """ Hand records to a thread that passes them on to 'handlers'. """
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(max_size)
+        self.sample_from = max_size // 2
+        self.sample_every = max(1, sample_every)
+        self.thread = None
+
+        # Written only by the thread that logs, read by the writer thread.
+        self.queued = 0
+        self.sampled = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        # Written only by the writer thread.
+        self.written = 0
+        self.reported_sampled_out = 0
+        self.reported_dropped = 0
+        self.last_report_time = time.time()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="QueueLogHandler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self.sample_from:
+            self.sampled += 1
+            if self.sampled % self.sample_every != 0:
+                self.sampled_out += 1
+                return
+        if record.exc_info:
+            # The traceback refers to the frames of this thread; render it
+            # now rather than keeping them alive until the writer gets to
+            # the record.
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+            self.queued += 1
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=DROPPED_REPORT_INTERVAL)
+            except Queue.Empty:
+                record = None
+            if record is STOP:
+                break
+            if record is not None:
+                self.handle_record(record)
+                self.written += 1
+            if time.time() - self.last_report_time >= DROPPED_REPORT_INTERVAL:
+                self.report_lost_records()
+
+    def handle_record(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def report_lost_records(self):
+        self.last_report_time = time.time()
+        (sampled_out, dropped) = (self.sampled_out, self.dropped)
+        if sampled_out == self.reported_sampled_out and dropped == self.reported_dropped:
+            return
+        message = "lost log records, sampled out: %s, dropped: %s" % (sampled_out - self.reported_sampled_out,
+                                                                      dropped - self.reported_dropped)
+        self.handle_record(logging.makeLogRecord({"name": "QueueLogHandler",
+                                                  "levelno": logging.WARNING,
+                                                  "levelname": "WARNING",
+                                                  "msg": message}))
+        (self.reported_sampled_out, self.reported_dropped) = (sampled_out, dropped)
+
+    def get_statistics(self):
+        return {"queued": self.queued,
+                "waiting": self.queue.qsize(),
+                "written": self.written,
+                "sampled_out": self.sampled_out,
+                "dropped": self.dropped}
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        """ Write the records still queued, then stop the writer thread.
+        logging.shutdown() calls this when the process exits. """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(STOP)
+            self.thread.join()
+            self.report_lost_records()
+        self.flush()
+        logging.Handler.close(self)
+
+def start():
+    """ If log_async is set, move the root logger's handlers behind a
+    QueueLogHandler. Call after the server has forked, in every process,
+    as the writer thread doesn't survive a fork. """
+    logger = logging.getLogger("async_logging.start")
+    if not options.log_async:
+        return None
+    root_logger = logging.getLogger()
+    handler = QueueLogHandler(root_logger.handlers[:],
+                              options.log_queue_size,
+                              options.log_sample_every)
+    handler.start()
+    for target_handler in handler.handlers:
+        root_logger.removeHandler(target_handler)
+    root_logger.addHandler(handler)
+    metrics.registry.register_source("logging", handler.get_statistics)
+    logger.debug("logging on a background thread, queue size: %s", options.log_queue_size)
+    return handler
+# ----------------------------------------------------------------------------
@@ -0,0 +1,447 @@
+# ----------------------------------------------------------------------------
+#   Redis clients with a callback interface, for use from inside
+#   @tornado.gen.engine functions, e.g.:
+#
+#       value = yield tornado.gen.Task(self.r.get, key)
+#       replies = yield tornado.gen.Task(self.r.pipeline, [("GET", key1),
+#                                                          ("GET", key2)])
+#
+#   AsyncRedisClient speaks the redis protocol over tornado IOStreams, so
+#   a redis round-trip never blocks the IOLoop. It keeps a pool of at most
+#   max_connections connections; each connection carries one command or
+#   pipeline at a time and callers queue for a free connection.
+#
+#   SyncRedisClient has the same interface but wraps a blocking
+#   redis.StrictRedis, and calls the callback before returning. It is
+#   used when redis_use_sync_client is set, e.g. by tooling that runs
+#   without an IOLoop.
+#
+#   Both clients parse replies with RESPONSE_CALLBACKS, which match
+#   redis-py 2.4's callbacks but for TTL, so they return identical values,
+#   e.g. HGETALL returns a dict, EXISTS and DEL return a bool, a SET NX
+#   that didn't set returns False and TTL returns None for a key without
+#   an expiry or that doesn't exist. See mockup/test_redis_clients.py.
+# ----------------------------------------------------------------------------
+
+import socket
+import logging
+import functools
+import collections
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.stack_context
+from tornado.options import define, options
+
+import redis
+from redis.exceptions import ConnectionError, ResponseError, InvalidResponse
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("redis_use_sync_client", default=False, type=bool, help="Use the blocking redis client rather than the IOLoop one")
+define("redis_max_connections", default=10, type=int, help="Maximum number of redis connections per process and database ID")
+# ----------------------------------------------------------------------------
+
+def create_redis_client(db):
+    """ Return the redis client to use for database ID 'db', as
+    configured by the redis_* options. """
+    if options.redis_use_sync_client:
+        return SyncRedisClient(host=options.redis_hostname,
+                               port=options.redis_port,
+                               db=db)
+    return AsyncRedisClient(host=options.redis_hostname,
+                            port=options.redis_port,
+                            db=db,
+                            max_connections=options.redis_max_connections)
+
+def bool_ok(response):
+    return response == "OK"
+
+def pairs_to_dict(response):
+    it = iter(response)
+    return dict(zip(it, it))
+
+# The subset of redis-py's response callbacks for the commands we use.
+RESPONSE_CALLBACKS = {
+    "DEL": bool,
+    "EXISTS": bool,
+    "EXPIRE": bool,
+    "FLUSHDB": bool_ok,
+    "HDEL": bool,
+    "HGETALL": lambda r: r and pairs_to_dict(r) or {},
+    "HSET": int,
+    "PUBLISH": int,
+    "SADD": int,
+    "SELECT": bool_ok,
+    # A SET with NX or XX that didn't set replies nil.
+    "SET": bool_ok,
+    "SETEX": bool_ok,
+    "SMEMBERS": lambda r: r and set(r) or set(),
+    # Not in redis-py 2.4, which returns the reply as is. -1 is no expiry
+    # and, from redis 2.8, -2 is no such key.
+    "TTL": lambda r: None if r < 0 else r,
+}
+
+def parse_response(command_name, response):
+    parser = RESPONSE_CALLBACKS.get(command_name.upper(), None)
+    if parser is None:
+        return response
+    return parser(response)
+
+class RedisClientMixin(object):
+    """ Named helpers for the commands we use, on top of
+    execute_command(). """
+    def get(self, name, callback=None):
+        self.execute_command("GET", name, callback=callback)
+
+    def mget(self, names, callback=None):
+        self.execute_command("MGET", *names, callback=callback)
+
+    def setex(self, name, time, value, callback=None):
+        self.execute_command("SETEX", name, time, value, callback=callback)
+
+    def delete(self, *names, **kwargs):
+        self.execute_command("DEL", *names, callback=kwargs.get("callback", None))
+
+    def exists(self, name, callback=None):
+        self.execute_command("EXISTS", name, callback=callback)
+
+    def expire(self, name, time, callback=None):
+        self.execute_command("EXPIRE", name, time, callback=callback)
+
+    def ttl(self, name, callback=None):
+        self.execute_command("TTL", name, callback=callback)
+
+    def hget(self, name, key, callback=None):
+        self.execute_command("HGET", name, key, callback=callback)
+
+    def hgetall(self, name, callback=None):
+        self.execute_command("HGETALL", name, callback=callback)
+
+    def hset(self, name, key, value, callback=None):
+        self.execute_command("HSET", name, key, value, callback=callback)
+
+    def hdel(self, name, *keys, **kwargs):
+        self.execute_command("HDEL", name, *keys, callback=kwargs.get("callback", None))
+
+    def publish(self, channel, message, callback=None):
+        self.execute_command("PUBLISH", channel, message, callback=callback)
+
+class SyncRedisClient(RedisClientMixin):
+    def __init__(self, host, port, db):
+        self.r = redis.StrictRedis(host=host, port=port, db=db)
+        for (command_name, callback) in RESPONSE_CALLBACKS.iteritems():
+            self.r.set_response_callback(command_name, callback)
+
+    def execute_command(self, *args, **kwargs):
+        callback = kwargs.get("callback", None)
+        response = self.r.execute_command(*args)
+        if callback:
+            callback(response)
+
+    def pipeline(self, commands, callback=None, transaction=False):
+        """ Execute the list of command tuples 'commands' in one
+        round-trip and return the list of their responses. If
+        transaction is True wrap them in MULTI/EXEC. """
+        pipe = self.r.pipeline(transaction=transaction)
+        for command in commands:
+            pipe.execute_command(*command)
+        responses = pipe.execute()
+        if callback:
+            callback(responses)
+
+class AsyncRedisClient(RedisClientMixin):
+    def __init__(self, host, port, db, max_connections, io_loop=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.max_connections = max_connections
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+
+        self.idle_connections = []
+        self.number_of_connections = 0
+        # Callbacks waiting for a free connection.
+        self.waiting = collections.deque()
+
+    def execute_command(self, *args, **kwargs):
+        callback = kwargs.get("callback", None)
+        on_responses = functools.partial(self._on_responses,
+                                         [args[0]],
+                                         lambda responses: callback and callback(responses[0]))
+        self._execute(encode_commands([args]), 1, on_responses)
+
+    def pipeline(self, commands, callback=None, transaction=False):
+        """ Execute the list of command tuples 'commands' in one
+        round-trip and return the list of their responses. If
+        transaction is True wrap them in MULTI/EXEC. """
+        if not commands:
+            callback and callback([])
+            return
+        command_names = [command[0] for command in commands]
+        if transaction:
+            commands = [("MULTI", )] + list(commands) + [("EXEC", )]
+            # Drop the replies to MULTI and each QUEUED, keep EXEC's.
+            on_exec = lambda responses: self._on_responses(command_names,
+                                                           callback,
+                                                           responses[-1])
+            on_responses = functools.partial(self._on_responses,
+                                             ["MULTI"] * (len(commands) - 1) + ["EXEC"],
+                                             on_exec)
+        else:
+            on_responses = functools.partial(self._on_responses,
+                                             command_names,
+                                             callback)
+        self._execute(encode_commands(commands), len(commands), on_responses)
+
+    def _on_responses(self, command_names, callback, responses):
+        if isinstance(responses, Exception):
+            raise responses
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        if callback:
+            callback([parse_response(command_name, response)
+                      for (command_name, response) in zip(command_names, responses)])
+
+    def _execute(self, data, number_of_replies, on_responses):
+        # Run on_responses in the caller's stack context, so that errors
+        # are handled by the request that issued the command.
+        on_responses = tornado.stack_context.wrap(on_responses)
+        def on_connection(connection):
+            if isinstance(connection, Exception):
+                on_responses(connection)
+                return
+            connection.send(data,
+                            number_of_replies,
+                            functools.partial(self._on_sent, connection, on_responses))
+        self._acquire(on_connection)
+
+    def _on_sent(self, connection, on_responses, responses):
+        if not isinstance(responses, Exception):
+            self._release(connection)
+        on_responses(responses)
+
+    def _acquire(self, callback):
+        if self.idle_connections:
+            callback(self.idle_connections.pop())
+        elif self.number_of_connections < self.max_connections:
+            self.number_of_connections += 1
+            connection = AsyncRedisConnection(self.host,
+                                              self.port,
+                                              self.db,
+                                              self.io_loop,
+                                              self._on_connection_closed)
+            connection.connect(callback)
+        else:
+            self.waiting.append(callback)
+
+    def _release(self, connection):
+        if self.waiting:
+            self.waiting.popleft()(connection)
+        else:
+            self.idle_connections.append(connection)
+
+    def _on_connection_closed(self, connection):
+        logger = logging.getLogger("AsyncRedisClient._on_connection_closed")
+        logger.debug("connection closed")
+        self.number_of_connections -= 1
+        if connection in self.idle_connections:
+            self.idle_connections.remove(connection)
+        # Let a waiting caller open a fresh connection.
+        if self.waiting:
+            self._acquire(self.waiting.popleft())
+
+    def get_statistics(self):
+        return {"connections": self.number_of_connections,
+                "idle_connections": len(self.idle_connections),
+                "waiting": len(self.waiting)}
+
+def encode_commands(commands):
+    output = []
+    for args in commands:
+        output.append("*%d\r\n" % (len(args), ))
+        for arg in args:
+            if isinstance(arg, unicode):
+                arg = arg.encode("utf-8")
+            elif not isinstance(arg, str):
+                arg = str(arg)
+            output.append("$%d\r\n%s\r\n" % (len(arg), arg))
+    return "".join(output)
+
+# Returned by ReplyParser._parse() when the buffer ends before the reply
+# does, and when it has started parsing an array.
+INCOMPLETE = object()
+ARRAY = object()
+
+class ReplyParser(object):
+    """ Incremental parser of the redis unified reply protocol. Error
+    replies are returned as ResponseError instances.
+
+    Where it got to is kept between calls to get_reply(), so that every
+    byte is parsed once however many chunks a reply arrives in, and the
+    chunks aren't joined until the bulk reply waiting for them is
+    complete. """
+    def __init__(self):
+        self.buffer = ""
+        # Position in buffer of the next reply to parse.
+        self.position = 0
+        # Data fed since buffer was last joined.
+        self.chunks = []
+        # Bytes in buffer and chunks.
+        self.length = 0
+        # Bytes there must be in buffer and chunks before the next reply
+        # can be parsed any further.
+        self.needed = 0
+        # [number of elements to go, elements so far] of each array being
+        # parsed, outermost first.
+        self.arrays = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+
+    def get_reply(self):
+        """ Return (True, reply) if a complete reply is buffered, else
+        (False, None). """
+        if self.length < self.needed:
+            return (False, None)
+        if self.chunks:
+            self.chunks.insert(0, self.buffer)
+            self.buffer = "".join(self.chunks)
+            self.chunks = []
+        while True:
+            reply = self._parse()
+            if reply is INCOMPLETE:
+                self._discard_parsed()
+                return (False, None)
+            if reply is ARRAY:
+                continue
+            complete = True
+            while self.arrays:
+                array = self.arrays[-1]
+                array[1].append(reply)
+                array[0] -= 1
+                if array[0] > 0:
+                    complete = False
+                    break
+                self.arrays.pop()
+                reply = array[1]
+            if complete:
+                if self.position == len(self.buffer):
+                    self._discard_parsed()
+                return (True, reply)
+
+    def _discard_parsed(self):
+        """ Drop the part of buffer that has been parsed. """
+        if self.position == 0:
+            return
+        self.buffer = self.buffer[self.position:]
+        self.length -= self.position
+        self.needed = max(0, self.needed - self.position)
+        self.position = 0
+
+    def _parse(self):
+        """ Parse the reply, or array header, at position, and move past
+        it. Return INCOMPLETE, without moving, if the buffer ends first. """
+        position = self.position
+        end = self.buffer.find("\r\n", position)
+        if end == -1:
+            self.needed = len(self.buffer) + 1
+            return INCOMPLETE
+        kind = self.buffer[position]
+        line = self.buffer[position + 1:end]
+        position = end + 2
+        if kind == "+":
+            reply = line
+        elif kind == "-":
+            reply = ResponseError(line)
+        elif kind == ":":
+            # A long, as redis-py returns.
+            reply = long(line)
+        elif kind == "$":
+            length = int(line)
+            if length == -1:
+                reply = None
+            else:
+                if len(self.buffer) < position + length + 2:
+                    self.needed = position + length + 2
+                    return INCOMPLETE
+                reply = self.buffer[position:position + length]
+                position += length + 2
+        elif kind == "*":
+            length = int(line)
+            if length == -1:
+                reply = None
+            elif length == 0:
+                reply = []
+            else:
+                self.arrays.append([length, []])
+                reply = ARRAY
+        else:
+            raise InvalidResponse("Protocol error: %r" % (line, ))
+        self.position = position
+        return reply
+
+class AsyncRedisConnection(object):
+    def __init__(self, host, port, db, io_loop, on_close):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.io_loop = io_loop
+        self.on_close = on_close
+        self.parser = ReplyParser()
+        self.stream = None
+
+        # (number of replies expected, replies so far, callback)
+        self.pending = None
+
+    def connect(self, callback):
+        """ Connect and select the database, then call callback with
+        this connection, or with an exception if we could not connect. """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self.stream = tornado.iostream.IOStream(sock, io_loop=self.io_loop)
+        self.stream.set_close_callback(self._on_stream_closed)
+        # Until we are connected a failure must be reported to 'callback'.
+        self.pending = (1, [], lambda responses: callback(responses))
+        def on_connected():
+            self.stream.read_until_close(lambda data: None,
+                                         streaming_callback=self._on_data)
+            self.pending = None
+            self.send(encode_commands([("SELECT", self.db)]),
+                      1,
+                      functools.partial(self._on_selected, callback))
+        self.stream.connect((self.host, self.port), on_connected)
+
+    def _on_selected(self, callback, responses):
+        if isinstance(responses, Exception):
+            callback(responses)
+        elif isinstance(responses[0], Exception):
+            self.stream.close()
+            callback(responses[0])
+        else:
+            callback(self)
+
+    def send(self, data, number_of_replies, callback):
+        assert(self.pending is None)
+        self.pending = (number_of_replies, [], callback)
+        self.stream.write(data)
+
+    def _on_data(self, data):
+        self.parser.feed(data)
+        while self.pending is not None:
+            (number_of_replies, replies, callback) = self.pending
+            (complete, reply) = self.parser.get_reply()
+            if not complete:
+                break
+            replies.append(reply)
+            if len(replies) == number_of_replies:
+                self.pending = None
+                callback(replies)
+
+    def _on_stream_closed(self):
+        self.on_close(self)
+        if self.pending is not None:
+            (number_of_replies, replies, callback) = self.pending
+            self.pending = None
+            callback(ConnectionError("Lost connection to redis at %s:%s" % (self.host, self.port)))
@@ -50,14 +50,17 @@ class LogoutHandler(BasePageHandler):
     do with the user as well. The user implicitly expects the logout to
     result in a clean slate, so let's give it to them.
     """
+    @tornado.web.asynchronous
+    @tornado.gen.engine
     def get(self):
         logger = logging.getLogger("LogoutHandler.get")
         logger.debug("entry.")        
         if self.current_user:
-            logger.debug("User currently logged in: %s" % (self.current_user, ))
-            self.user_session.deauthorize_user(self.current_user)
+            logger.debug("User currently logged in: %s", self.current_user)
+            self.session.deauthorize()
+            yield tornado.gen.Task(self.session.flush)
             normalized_user_id = normalize_uuid_string(self.current_user)
-            self.db.expire_cache(normalized_user_id)
+            yield tornado.gen.Task(self.db.expire_cache, normalized_user_id)
         self.redirect("/")
 
 # ----------------------------------------------------------------------------
@@ -74,7 +77,7 @@ class LoginApiHandler(BaseLoginHandler):
         logger.debug("entry")
         data = {}
         if self.current_user:
-            logging.debug("User is already authorized as user: %s." % (self.current_user, ))
+            logging.debug("User is already authorized as user: %s.", self.current_user)
             self.redirect("/")
         else:
             data['user'] = None
@@ -87,16 +90,15 @@ class LoginApiHandler(BaseLoginHandler):
         logger = logging.getLogger("LoginApiHandler.post")        
         logger.debug("entry.")        
         api_secret_key = self.get_argument("api_secret_key")
-        logger.debug("api_secret_key: %s" % (api_secret_key, ))        
+        logger.debug("api_secret_key: %s", api_secret_key)        
         user_id = yield tornado.gen.Task(self.db.get_user_id_from_api_secret_key,
                                          api_secret_key)
-        logger.debug("user_id: %s" % (user_id, ))
+        logger.debug("user_id: %s", user_id)
         if not user_id:
             # User does not exist.
             raise tornado.web.HTTPError(403, "API key not authorized.")                    
-        self.set_secure_cookie_and_authorization(user_id, "api") 
+        yield tornado.gen.Task(self.set_secure_cookie_and_authorization, user_id, "api")
         self.redirect("/")
-        self.finish()
         
 # ----------------------------------------------------------------------------
 #   RequestHandler that deals with Mozilla BrowserID authentication.
@@ -106,7 +108,8 @@ class LoginBrowserIDHandler(BaseLoginHandler):
     def post(self):
         logger = logging.getLogger("LoginBrowserIDHandler.get")
         logger.debug("entry")             
-        logger.debug("request: \n%s" % (pprint.pformat(self.request), ))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("request: \n%s", pprint.pformat(self.request))
         
         adjust_request_host_to_referer(self.request)
         
@@ -114,7 +117,7 @@ class LoginBrowserIDHandler(BaseLoginHandler):
         domain = self.request.host
         data = {'assertion': assertion,
                 'audience': domain}
-        logger.debug('data: %s' % (data, ))
+        logger.debug('data: %s', data)
         
         http_client = tornado.httpclient.AsyncHTTPClient()
         url = 'https://browserid.org/verify' 
@@ -127,9 +130,9 @@ class LoginBrowserIDHandler(BaseLoginHandler):
     @tornado.gen.engine
     def _on_response(self, response):
         logger = logging.getLogger("LoginBrowserIDHandler._on_response")
-        logger.debug("entry. response: %s" % (response, ))     
+        logger.debug("entry. response: %s", response)     
         struct = tornado.escape.json_decode(response.body)
-        logger.debug("response struct: %s" % (struct, ))
+        logger.debug("response struct: %s", struct)
         if struct['status'] != 'okay':
             raise tornado.web.HTTPError(400, "BrowserID status not okay")            
         
@@ -139,20 +142,19 @@ class LoginBrowserIDHandler(BaseLoginHandler):
         email = struct['email']
         user_id = yield tornado.gen.Task(self.db.get_user_id_from_browserid_email,
                                  email)
-        logger.debug("user_id: %s" % (user_id, ))
+        logger.debug("user_id: %s", user_id)
         if not user_id:
             # User does not exist.
             logger.debug("User does not exist.")
             user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
+            logger.debug("user_id: %s", user_id)
             rc = yield tornado.gen.Task(self.db.create_auth_browserid,
                                         email,
                                         user_id)
-            logger.debug("create_auth_browserid rc: %s" % (rc, ))
+            logger.debug("create_auth_browserid rc: %s", rc)
             assert(rc == True)
         
-        self.set_secure_cookie_and_authorization(user_id, "browserid")        
-        
+        yield tornado.gen.Task(self.set_secure_cookie_and_authorization, user_id, "browserid")
         self.set_header("Content-Type", "application/json; charset=UTF-8")
         response = {'next_url': '/'}
         self.write(tornado.escape.json_encode(response))
@@ -170,12 +172,12 @@ class LoginTwitterHandler(BaseLoginHandler, tornado.auth.TwitterMixin):
         # We'll get a "denied" GET paramater back if the user has refused
         # to authorise us.
         denied = self.get_argument("denied", None)
-        logger.debug("denied: %s" % (denied, ))
+        logger.debug("denied: %s", denied)
         if denied:
             raise tornado.web.HTTPError(500, "Twitter authentication failed. User refused to authorize.")
     
         oauth_token = self.get_argument("oauth_token", None)
-        logger.debug("oauth_token: %s" % (oauth_token, ))
+        logger.debug("oauth_token: %s", oauth_token)
         if oauth_token:
             self.get_authenticated_user(self.async_callback(self._on_auth))
             return
@@ -185,7 +187,8 @@ class LoginTwitterHandler(BaseLoginHandler, tornado.auth.TwitterMixin):
     @tornado.gen.engine
     def _on_auth(self, user):
         logger = logging.getLogger("LoginTwitterHandler._on_auth")
-        logger.debug("entry. user:\n%s" % (pprint.pformat(user), ))    
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("entry. user:\n%s", pprint.pformat(user))
         if not user:
             raise tornado.web.HTTPError(500, "Twitter authentication failed")
         assert("username" in user)
@@ -194,22 +197,22 @@ class LoginTwitterHandler(BaseLoginHandler, tornado.auth.TwitterMixin):
         # Twitter credentials are uniquely identified by the username
         user_id = yield tornado.gen.Task(self.db.get_user_id_from_twitter_username,
                                          user["username"])
-        logger.debug("user_id: %s" % (user_id, ))
+        logger.debug("user_id: %s", user_id)
         if not user_id:
             # User does not exist.
             logger.debug("User does not exist.")
             assert("profile_image_url" in user)
             
             user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
+            logger.debug("user_id: %s", user_id)
             rc = yield tornado.gen.Task(self.db.create_auth_twitter,
                                         user["username"],
                                         user_id,
                                         user["profile_image_url"])
-            logger.debug("create_auth_twitter rc: %s" % (rc, ))
+            logger.debug("create_auth_twitter rc: %s", rc)
             assert(rc == True)
             
-        self.set_secure_cookie_and_authorization(user_id, "twitter")
+        yield tornado.gen.Task(self.set_secure_cookie_and_authorization, user_id, "twitter")
         self.redirect("/")
 # ----------------------------------------------------------------------------
 
@@ -235,7 +238,7 @@ class LoginFacebookHandler(BaseLoginHandler, tornado.auth.FacebookGraphMixin):
         redirect_uri = '%s/login/facebook/' % (options.base_uri, )
         
         code = self.get_argument("code", False)
-        logger.debug("code: %s" % (code, ))        
+        logger.debug("code: %s", code)        
         if code:
             self.get_authenticated_user(
                 redirect_uri=redirect_uri,
@@ -252,7 +255,7 @@ class LoginFacebookHandler(BaseLoginHandler, tornado.auth.FacebookGraphMixin):
     @tornado.gen.engine    
     def _on_login(self, user):
         logger = logging.getLogger("LoginFacebookHandler._on_login")
-        logger.debug("entry. user: %s" % (user, ))
+        logger.debug("entry. user: %s", user)
         if not user:
             raise tornado.web.HTTPError(500, "Facebook authentication failed")
         assert("id" in user)        
@@ -261,7 +264,7 @@ class LoginFacebookHandler(BaseLoginHandler, tornado.auth.FacebookGraphMixin):
         # Facebook credentials are uniquely identified by the id
         user_id = yield tornado.gen.Task(self.db.get_user_id_from_facebook_id,
                                          user["id"])
-        logger.debug("user_id: %s" % (user_id, ))
+        logger.debug("user_id: %s", user_id)
         if not user_id:
             # User does not exist.
             logger.debug("User does not exist.")            
@@ -274,7 +277,7 @@ class LoginFacebookHandler(BaseLoginHandler, tornado.auth.FacebookGraphMixin):
             assert("picture" in user)
             
             user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
+            logger.debug("user_id: %s", user_id)
             rc = yield tornado.gen.Task(self.db.create_auth_facebook,
                                         user["id"],
                                         user_id,
@@ -285,10 +288,10 @@ class LoginFacebookHandler(BaseLoginHandler, tornado.auth.FacebookGraphMixin):
                                         user["last_name"],
                                         user["name"],
                                         user["picture"])                                       
-            logger.debug("create_auth_facebook rc: %s" % (rc, ))
+            logger.debug("create_auth_facebook rc: %s", rc)
             assert(rc == True)
             
-        self.set_secure_cookie_and_authorization(user_id, "facebook")
+        yield tornado.gen.Task(self.set_secure_cookie_and_authorization, user_id, "facebook")
         self.redirect("/") 
 
 # ----------------------------------------------------------------------------
@@ -326,14 +329,15 @@ class LoginGoogleHandler(BaseLoginHandler, tornado.auth.GoogleMixin):
     @tornado.web.asynchronous
     def get(self):
         logger = logging.getLogger("LoginGoogleHandler.get")
-        logger.debug("entry. request: \n%s" % (pprint.pformat(self.request), ))                
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("entry. request: \n%s", pprint.pformat(self.request))
         
         # If openid_mode is None we have not authenticated yet.
         # If openid_mode is cancel the user has refused to
         # authorise us.
         # If openid_mode is id_res the user has authorised us.
         openid_mode = self.get_argument("openid.mode", None)
-        logger.debug("openid_mode: %s" % (openid_mode, ))
+        logger.debug("openid_mode: %s", openid_mode)
         if openid_mode == "cancel":
             raise tornado.web.HTTPError(500, "Google authentication failed. User refused to authorize.")
         
@@ -348,7 +352,7 @@ class LoginGoogleHandler(BaseLoginHandler, tornado.auth.GoogleMixin):
     def _on_auth(self, user):
         print "Google _on_auth called"
         logger = logging.getLogger("LoginGoogleHandler._on_auth")
-        logger.debug("entry. user: %s" % (user, ))            
+        logger.debug("entry. user: %s", user)            
         if not user:
             raise tornado.web.HTTPError(500, "Google authentication failed")
         assert("email" in user)
@@ -357,7 +361,7 @@ class LoginGoogleHandler(BaseLoginHandler, tornado.auth.GoogleMixin):
         # Google credentials are uniquely identified by the email address.
         user_id = yield tornado.gen.Task(self.db.get_user_id_from_google_email,
                                          user["email"])
-        logger.debug("user_id: %s" % (user_id, ))
+        logger.debug("user_id: %s", user_id)
         if not user_id:
             # User does not exist.
             logger.debug("User does not exist.")
@@ -367,7 +371,7 @@ class LoginGoogleHandler(BaseLoginHandler, tornado.auth.GoogleMixin):
             assert("locale" in user)
             
             user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
+            logger.debug("user_id: %s", user_id)
             rc = yield tornado.gen.Task(self.db.create_auth_google,
                                         user["email"],
                                         user_id,
@@ -375,10 +379,10 @@ class LoginGoogleHandler(BaseLoginHandler, tornado.auth.GoogleMixin):
                                         user["last_name"],
                                         user["name"],
                                         user["locale"])
-            logger.debug("create_auth_twitter rc: %s" % (rc, ))
+            logger.debug("create_auth_twitter rc: %s", rc)
             assert(rc == True)
             
-        self.set_secure_cookie_and_authorization(user_id, "google")
+        yield tornado.gen.Task(self.set_secure_cookie_and_authorization, user_id, "google")
         self.redirect("/")
 # ----------------------------------------------------------------------------
 
@@ -403,6 +407,6 @@ def adjust_request_host_to_referer(request):
         else:
             port = 443
         new_host = "%s:%s" % (urlparse.urlparse(referer).netloc, port)
-        logger.debug("Changed request host from %s to %s" % (request.host, new_host))
+        logger.debug("Changed request host from %s to %s", request.host, new_host)
         request.host = new_host
     # --------------------------------------------------------------------
\ No newline at end of file
@@ -1,36 +1,128 @@
 
+import os
 import logging
+import time
+import datetime
+import gzip
+import hashlib
+import email.utils
+import cStringIO
 import tornado
+import tornado.gen
+import tornado.escape
+import tornado.stack_context
 from tornado.options import define, options
 import re
+import uuid
 
 import database
 import user_session
+import metrics
+import publisher
+from local_cache import LocalCache
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("anonymous_page_max_age", default=0, type=int, help="Seconds for which browsers and nginx may reuse a page shown to an anonymous reader without asking the server whether it changed")
+define("fragment_cache_max_entries", default=0, type=int, help="Maximum number of rendered fragments each process keeps. 0 disables the fragment cache.")
+define("fragment_cache_max_bytes", default=0, type=int, help="Maximum total size in bytes of the rendered fragments each process keeps.")
+define("fragment_cache_ttl", default=60 * 60, type=int, help="Seconds a rendered fragment is kept for.")
+define("response_cache_max_entries", default=0, type=int, help="Maximum number of response bodies for anonymous readers each process keeps. 0 disables the response cache.")
+define("response_cache_max_bytes", default=0, type=int, help="Maximum total size in bytes, plain and gzipped, of the response bodies each process keeps.")
+define("response_cache_ttl", default=60 * 60, type=int, help="Seconds a response body is kept for.")
+# ----------------------------------------------------------------------------
 
 # ----------------------------------------------------------------------------
 #   Base request handler.
 # ----------------------------------------------------------------------------
 class BaseHandler(tornado.web.RequestHandler):
     REGEXP_BASE64 = re.compile("^[A-Za-z0-9-_=]+$")
+    # Signed cookie with the time of the user's last write, see
+    # record_write().
+    WRITTEN_AT_COOKIE = "written_at"
 
     @property
     def db(self):
         """ Create a database connection when a request handler is called
-        and store the connection in the application object.
+        and store the connection in the application object. The server
+        creates it at start-up, see start_up() in start_server.py.
         """
         if not hasattr(self.application, 'db'):
             self.application.db = database.DatabaseManager()
         return self.application.db
         
+    @property
+    def fragment_cache(self):
+        """ The LocalCache of rendered fragments, see render_fragment(). """
+        if not hasattr(self.application, 'fragment_cache'):
+            self.application.fragment_cache = LocalCache(max_entries=options.fragment_cache_max_entries,
+                                                         max_bytes=options.fragment_cache_max_bytes,
+                                                         ttl=options.fragment_cache_ttl)
+            metrics.registry.register_source("fragment_cache", self.application.fragment_cache.get_statistics)
+        return self.application.fragment_cache
+
+    @property
+    def response_cache(self):
+        """ The LocalCache of response bodies, see finish_with_cached_body().
+        Its entries are invalidated along with the database results they
+        were made from. """
+        if not hasattr(self.application, 'response_cache'):
+            self.application.response_cache = LocalCache(max_entries=options.response_cache_max_entries,
+                                                         max_bytes=options.response_cache_max_bytes,
+                                                         ttl=options.response_cache_ttl)
+            self.db.add_local_cache(self.application.response_cache)
+            metrics.registry.register_source("response_cache", self.application.response_cache.get_statistics)
+        return self.application.response_cache
+
+    @property
+    def publisher(self):
+        """ The ListPublisher, see publisher.py, or None if publish_path
+        isn't set. """
+        if not hasattr(self.application, 'publisher'):
+            self.application.publisher = None
+            if options.publish_path:
+                self.application.publisher = publisher.ListPublisher(options.publish_path)
+                self.application.publisher.start()
+                metrics.registry.register_source("publisher", self.application.publisher.get_statistics)
+        return self.application.publisher
+
     @property
     def user_session(self):
         """ Create a redis connection to CRUD the current user's session
-        data.
+        data. The server creates it at start-up too.
         """
         if not hasattr(self.application, 'user_session'):
             self.application.user_session = user_session.UserSessionManager()
         return self.application.user_session        
 
+    def record_write(self):
+        """ Note that this request changed the database. For
+        read_your_writes_window seconds the user's reads go to the
+        primary database rather than the replica, which may not have
+        the change yet. """
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=options.read_your_writes_window)
+        self.set_secure_cookie(self.WRITTEN_AT_COOKIE,
+                               "%.3f" % (time.time(), ),
+                               expires_days=None,
+                               expires=expires)
+        self._read_from_primary = True
+
+    @property
+    def read_from_primary(self):
+        """ Whether this request's reads should go to the primary
+        database, because the user wrote something recently. Pass it as
+        primary= to the DatabaseManager reads. """
+        if not hasattr(self, "_read_from_primary"):
+            self._read_from_primary = False
+            written_at = self.get_secure_cookie(self.WRITTEN_AT_COOKIE)
+            if written_at:
+                try:
+                    self._read_from_primary = time.time() - float(written_at) < options.read_your_writes_window
+                except ValueError:
+                    pass
+        return self._read_from_primary
+
     @staticmethod
     def validate_base64_parameter(parameter):
         """ Given a string in variable 'parameter' confirm that it is a
@@ -42,36 +134,270 @@ class BaseHandler(tornado.web.RequestHandler):
 #   Base page handler.
 # ----------------------------------------------------------------------------
 class BasePageHandler(BaseHandler):        
-    def get_current_user(self):
+    def _execute(self, transforms, *args, **kwargs):
+        """ Checking whether the user is authorized needs a redis
+        round-trip, and tornado's current_user property can't wait for
+        one. Hence, before running the request, load the current user
+        without blocking the IOLoop, and only then carry on with
+        tornado's normal request processing. """
+        self._transforms = transforms
+        def on_current_user(user_id):
+            self._current_user = user_id
+            super(BasePageHandler, self)._execute(transforms, *args, **kwargs)
+        with tornado.stack_context.ExceptionStackContext(self._handle_load_current_user_exception):
+            self.load_current_user(callback=on_current_user)
+
+    def _handle_load_current_user_exception(self, type, value, traceback):
+        if self._finished:
+            return False
+        self._handle_request_exception(value)
+        return True
+
+    @tornado.gen.engine
+    def load_current_user(self, callback):
         """ Determine what the current user is. Return None if there is
         currently no authorized user. We do this in two cases,
         1) A user never logged in before.
         2) A user was logged in but their session expired.
+
+        The user's session is kept in self.session for the rest of the
+        request, so that we only go to redis for it once.
         """
-        user_id = self.get_secure_cookie("user")
-        if not user_id:
-            return None
-        if not self.user_session.is_user_authorized(user_id):
-            return None
-        return user_id        
+        logger = logging.getLogger("BasePageHandler.load_current_user")
+        self.session = None
+        cookie = self.get_secure_cookie("user")
+        if not cookie:
+            callback(None)
+            return
+        (user_id, refreshed_at) = self.user_session.decode_cookie(cookie)
+        self.session = yield tornado.gen.Task(self.user_session.get_session(user_id).load)
+        if not self.session.is_authorized():
+            callback(None)
+            return
+        if self.user_session.is_refresh_due(self.session, refreshed_at):
+            # The EXPIRE is written with any other session changes in
+            # on_finish().
+            logger.debug("refreshing session expiry. user_id: %s", user_id)
+            self.session.set_expiry()
+            self.user_session.expiry_refreshes += 1
+            self.set_user_cookie(user_id)
+        callback(user_id)
+
+    def set_user_cookie(self, user_id):
+        """ Set the signed cookie that says the user has authenticated,
+        recording that their session expiry was just refreshed. """
+        self.set_secure_cookie("user", self.user_session.encode_cookie(user_id))
+
+    def get_current_user(self):
+        """ The current user is loaded by _execute() before the request
+        is processed, so we only get here if that failed part way. """
+        return None
+
+    def on_finish(self):
+        """ Write any queued changes to the user's session. The response
+        has already been sent, so nobody waits for this. """
+        session = getattr(self, "session", None)
+        if session is None:
+            return
+        session.flush(callback=lambda: self.user_session.record_request(session))
+
+    # ------------------------------------------------------------------------
+    #   Conditional GETs.
+    #
+    #   A page that shows lists is fully determined by the revisions of
+    #   the lists, who it is shown to, and the templates and static files
+    #   it is rendered with. Its ETag is a hash of these, so a handler can
+    #   answer If-None-Match with a 304 as soon as it knows the revisions,
+    #   without rendering anything, see check_not_modified().
+    #
+    #   Pages for an anonymous reader contain no XSRF token and set no
+    #   cookies, so browsers and nginx may share them for
+    #   anonymous_page_max_age seconds. Pages for a user are private.
+    #
+    #   A strong ETag must differ between the gzipped and the plain body
+    #   of a page, so the ETag of a gzipped one ends in GZIP_ETAG_SUFFIX.
+    #   Either is accepted as the page the client already has.
+    # ------------------------------------------------------------------------
+    GZIP_ETAG_SUFFIX = "-gz"
+
+    # Hash of the templates and static files, see get_pages_version().
+    pages_version = None
+
+    def get_pages_version(self):
+        """ Return a hash of the names, sizes and modification times of
+        the templates and static files, so that a deploy that changes how
+        pages look changes their ETags. In debug mode, where templates are
+        edited in place, it is worked out on every request, else once per
+        process. """
+        if BasePageHandler.pages_version is not None and not self.settings.get("debug"):
+            return BasePageHandler.pages_version
+        h = hashlib.sha1()
+        for path in (self.settings["template_path"], self.settings["static_path"]):
+            for (dirpath, dirnames, filenames) in sorted(os.walk(path)):
+                for filename in sorted(filenames):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    h.update("%s/%s %s %s\n" % (dirpath, filename, stat.st_size, stat.st_mtime))
+        BasePageHandler.pages_version = h.hexdigest()
+        return BasePageHandler.pages_version
+
+    def check_not_modified(self, revision_ids, last_modified):
+        """ Set the ETag of the page that shows the list revisions
+        'revision_ids', in the order shown, and its Last-Modified,
+        last_modified, the latest datetime_edited of the revisions, taken
+        to be UTC, or None. Also set how the page may be cached.
+
+        If the client already has the page then send a 304 and return
+        True, and the caller must not render anything. Else return
+        False. """
+        logger = logging.getLogger("BasePageHandler.check_not_modified")
+        parts = [self.get_pages_version(), self.current_user or ""]
+        if self.current_user:
+            # Pages for a user contain their XSRF token.
+            parts.append(self.xsrf_token)
+        parts.extend(str(revision_id) for revision_id in revision_ids)
+        digest = hashlib.sha1("|".join(parts)).hexdigest()
+        page_etags = ['"%s"' % (digest, ), '"%s%s"' % (digest, self.GZIP_ETAG_SUFFIX)]
+        if self.is_gzipping():
+            etag = page_etags[1]
+        else:
+            etag = page_etags[0]
+        self.set_header("Etag", etag)
+        if last_modified is not None:
+            last_modified = last_modified.replace(microsecond=0)
+            self.set_header("Last-Modified", last_modified)
+        if self.current_user:
+            self.set_header("Cache-Control", "private, max-age=0, must-revalidate")
+        else:
+            self.set_header("Cache-Control", "public, max-age=%d" % (options.anonymous_page_max_age, ))
+        # Logging in changes the page, and with gzip on so does whether
+        # the client takes gzip.
+        self.set_header("Vary", "Accept-Encoding, Cookie")
+
+        if_none_match = self.request.headers.get("If-None-Match")
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        not_modified = False
+        if if_none_match is not None:
+            # nginx weakens the ETags of the responses it gzips.
+            etags = [tag.strip() for tag in if_none_match.split(",")]
+            not_modified = "*" in etags or \
+                           any(page_etag in etags or ("W/" + page_etag) in etags for page_etag in page_etags)
+        elif if_modified_since is not None and last_modified is not None:
+            date_tuple = email.utils.parsedate(if_modified_since)
+            if date_tuple is not None:
+                not_modified = datetime.datetime(*date_tuple[:6]) >= last_modified
+        if not not_modified:
+            return False
+        logger.debug("not modified. etag: %s", etag)
+        self.set_status(304)
+        self.finish()
+        return True
+
+    def is_gzipping(self):
+        """ Return True if the body of this response is sent gzipped, by
+        tornado or by finish_with_cached_body(). Both gzip an HTML body
+        whenever the client accepts gzip. """
+        return bool(self.settings.get("gzip")) and \
+               self.request.supports_http_1_1() and \
+               "gzip" in self.request.headers.get("Accept-Encoding", "")
+    # ------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------
+    #   Rendered fragments.
+    #
+    #   A list revision never changes, so neither does the HTML of a
+    #   template that shows it, apart from the XSRF token in its forms,
+    #   which belongs to the browser. render_fragment() renders such a
+    #   template with a placeholder for the token and keeps the result
+    #   in the per-process fragment_cache. Every request then only swaps
+    #   its own token in.
+    #
+    #   Besides the revision, the template may only depend on whether
+    #   'user' is set, which is part of the cache key.
+    # ------------------------------------------------------------------------
+    # Marks where xsrf_form_html() goes in a cached fragment. Text in a
+    # template is escaped, so it can't contain this.
+    XSRF_PLACEHOLDER = "<!--xsrf_form_html:%s-->" % (uuid.uuid4().hex, )
+
+    def render_fragment(self, template_name, revision_id, **kwargs):
+        """ Return template_name rendered with kwargs, which must only
+        describe the list revision revision_id, and 'user'. """
+        logger = logging.getLogger("BasePageHandler.render_fragment")
+        if kwargs.get("user"):
+            viewer = "user"
+        else:
+            viewer = "anonymous"
+        key = (template_name, str(revision_id), viewer, self.get_pages_version())
+        html = self.fragment_cache.get(key)
+        if html is None:
+            logger.debug("rendering. template_name: %s, revision_id: %s, viewer: %s", template_name, revision_id, viewer)
+            html = self.render_string(template_name,
+                                      xsrf_form_html=lambda: self.XSRF_PLACEHOLDER,
+                                      **kwargs)
+            self.fragment_cache.set(key, html, len(html), ())
+        if self.XSRF_PLACEHOLDER in html:
+            html = html.replace(self.XSRF_PLACEHOLDER, tornado.escape.utf8(self.xsrf_form_html()))
+        return html
+    # ------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------
+    #   Response bodies.
+    #
+    #   A page for an anonymous reader is the same for everyone, so the
+    #   whole body can be kept, see finish_with_cached_body(). It is
+    #   gzipped once, at RESPONSE_COMPRESS_LEVEL, when it is stored, and
+    #   the gzipped bytes are sent as they are to clients that accept
+    #   gzip, rather than tornado compressing the body again on every
+    #   request.
+    # ------------------------------------------------------------------------
+    RESPONSE_COMPRESS_LEVEL = 9
+
+    def finish_with_cached_body(self, key, tags, render):
+        """ Finish the request with the HTML body that render() returns,
+        which must only depend on key. The body is kept in the
+        response_cache, tagged with 'tags', the tags of the database
+        results it was made from. """
+        logger = logging.getLogger("BasePageHandler.finish_with_cached_body")
+        assert(not self.current_user)
+        key = key + (self.get_pages_version(), )
+        entry = self.response_cache.get(key)
+        if entry is None:
+            logger.debug("rendering. key: %s", key)
+            body = tornado.escape.utf8(render())
+            output = cStringIO.StringIO()
+            gzip_file = gzip.GzipFile(mode="wb", fileobj=output, compresslevel=self.RESPONSE_COMPRESS_LEVEL, mtime=0)
+            gzip_file.write(body)
+            gzip_file.close()
+            entry = (body, output.getvalue())
+            self.response_cache.set(key, entry, len(entry[0]) + len(entry[1]), tags)
+        (body, gzipped_body) = entry
+        self.set_header("Content-Type", "text/html; charset=UTF-8")
+        if self.is_gzipping():
+            # Tornado's own gzip leaves bodies with a Content-Encoding be.
+            self.set_header("Content-Encoding", "gzip")
+            body = gzipped_body
+        self.finish(body)
+    # ------------------------------------------------------------------------
 # ----------------------------------------------------------------------------
 
 # ----------------------------------------------------------------------------
 #   Base login handler.
 # ----------------------------------------------------------------------------
 class BaseLoginHandler(BasePageHandler):
-    def set_secure_cookie_and_authorization(self, user_id, authorization_type):
+    @tornado.gen.engine
+    def set_secure_cookie_and_authorization(self, user_id, authorization_type, callback):
+        """ Log the user in. If the user is already authorized then this
+        just re-sets their authorization expiry time.
+
+        The session is written before we return because the user's
+        next request, typically following a redirect, must see it. """
         logger = logging.getLogger("BaseLoginHandler.set_secure_cookie_and_authorization")
-        logger.debug("entry. user_id: %s, authorization_type: %s" % (user_id, authorization_type))
-        self.set_secure_cookie('user', user_id)        
-        if not self.user_session.is_user_authorized(user_id):
-            logger.debug("User is not currently authorized.") 
-            self.user_session.authorize_user(user_id, authorization_type)
-        else:
-            # If the user is already authorized then just re-set their
-            # authorization expiry time.
-            logger.debug("User is already authorized.")
-            self.user_session.set_user_expiry(user_id)
+        logger.debug("entry. user_id: %s, authorization_type: %s", user_id, authorization_type)
+        self.set_user_cookie(user_id)
+        if self.session is None or self.session.user_id != user_id:
+            self.session = self.user_session.get_session(user_id, data={})
+        self.session.authorize(authorization_type)
+        yield tornado.gen.Task(self.session.flush)
+        callback()
 # ----------------------------------------------------------------------------
 
 
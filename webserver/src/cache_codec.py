@@ -0,0 +1,213 @@
+# ----------------------------------------------------------------------------
+#   Encoding of the values in the database results cache.
+#
+#   A cached value is the list of rows a statement returned, possibly
+#   transformed, together with the time until which it is fresh. Rows are
+#   tuples of UUID strings, text, timestamps and numbers, which the rows
+#   format stores compactly:
+#
+#       header   format (1 byte), compression (1 byte), fresh_until (double)
+#       body     number of rows (uint32), then for every row the number of
+#                columns (uint8) and every column as a type byte and its
+#                value. A UUID string is 16 bytes, a naive datetime is
+#                microseconds since the epoch (int64), text is its length
+#                (uint32) and its bytes.
+#
+#   The body is compressed if it is larger than compress_threshold bytes.
+#   Values the rows format can't hold, e.g. a datetime with a timezone,
+#   are pickled instead, with the same header.
+#
+#   The first byte is the format, so that a reader can decode values from
+#   writers older or newer than itself. Values written before this module
+#   existed are bare pickles, and start with the pickle protocol opcode.
+#   CacheCodec can write those too, format "pickle", so that during a
+#   rolling upgrade the new servers write values the old ones can read.
+# ----------------------------------------------------------------------------
+
+import re
+import bz2
+import zlib
+import struct
+import datetime
+import cPickle as pickle
+
+FORMAT_PICKLE = 1
+FORMAT_ROWS = 2
+# Bare pickles, protocol 2 or higher, start with this opcode.
+LEGACY_PICKLE_MARKER = "\x80"
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_BZ2 = 2
+COMPRESSIONS = {"zlib": COMPRESSION_ZLIB,
+                "bz2": COMPRESSION_BZ2}
+
+HEADER = struct.Struct(">BBd")
+UINT8 = struct.Struct(">B")
+UINT32 = struct.Struct(">I")
+INT64 = struct.Struct(">q")
+DOUBLE = struct.Struct(">d")
+
+TYPE_NONE = "n"
+TYPE_UUID = "u"
+TYPE_STR = "s"
+TYPE_UNICODE = "t"
+TYPE_DATETIME = "d"
+TYPE_INT = "i"
+TYPE_FLOAT = "f"
+TYPE_TRUE = "T"
+TYPE_FALSE = "F"
+
+REGEXP_UUID = re.compile("^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+EPOCH = datetime.datetime(1970, 1, 1)
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+class UnsupportedValue(Exception):
+    pass
+
+def encode_rows(rows):
+    """ Return the rows format body for the list of tuples 'rows', or
+    raise UnsupportedValue. """
+    if not isinstance(rows, list):
+        raise UnsupportedValue(type(rows))
+    output = [UINT32.pack(len(rows))]
+    append = output.append
+    for row in rows:
+        if not isinstance(row, tuple) or len(row) > 255:
+            raise UnsupportedValue(type(row))
+        append(UINT8.pack(len(row)))
+        for value in row:
+            if value is None:
+                append(TYPE_NONE)
+            elif isinstance(value, str):
+                if len(value) == 36 and REGEXP_UUID.match(value):
+                    append(TYPE_UUID)
+                    append(value.replace("-", "").decode("hex"))
+                else:
+                    append(TYPE_STR)
+                    append(UINT32.pack(len(value)))
+                    append(value)
+            elif isinstance(value, unicode):
+                value = value.encode("utf-8")
+                append(TYPE_UNICODE)
+                append(UINT32.pack(len(value)))
+                append(value)
+            elif isinstance(value, datetime.datetime):
+                if value.tzinfo is not None:
+                    raise UnsupportedValue("datetime with tzinfo")
+                delta = value - EPOCH
+                append(TYPE_DATETIME)
+                append(INT64.pack((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds))
+            elif isinstance(value, bool):
+                append(value and TYPE_TRUE or TYPE_FALSE)
+            elif isinstance(value, (int, long)):
+                if not INT64_MIN <= value <= INT64_MAX:
+                    raise UnsupportedValue("integer out of range")
+                append(TYPE_INT)
+                append(INT64.pack(value))
+            elif isinstance(value, float):
+                append(TYPE_FLOAT)
+                append(DOUBLE.pack(value))
+            else:
+                raise UnsupportedValue(type(value))
+    return "".join(output)
+
+def decode_rows(data):
+    """ The inverse of encode_rows(). """
+    (number_of_rows, ) = UINT32.unpack_from(data, 0)
+    position = 4
+    rows = []
+    for i in xrange(number_of_rows):
+        number_of_columns = ord(data[position])
+        position += 1
+        row = []
+        for j in xrange(number_of_columns):
+            value_type = data[position]
+            position += 1
+            if value_type == TYPE_UUID:
+                h = data[position:position + 16].encode("hex")
+                row.append("%s-%s-%s-%s-%s" % (h[:8], h[8:12], h[12:16], h[16:20], h[20:]))
+                position += 16
+            elif value_type == TYPE_STR or value_type == TYPE_UNICODE:
+                (length, ) = UINT32.unpack_from(data, position)
+                position += 4
+                value = data[position:position + length]
+                position += length
+                if value_type == TYPE_UNICODE:
+                    value = value.decode("utf-8")
+                row.append(value)
+            elif value_type == TYPE_DATETIME:
+                (microseconds, ) = INT64.unpack_from(data, position)
+                position += 8
+                row.append(EPOCH + datetime.timedelta(microseconds=microseconds))
+            elif value_type == TYPE_INT:
+                (value, ) = INT64.unpack_from(data, position)
+                position += 8
+                row.append(value)
+            elif value_type == TYPE_NONE:
+                row.append(None)
+            elif value_type == TYPE_FLOAT:
+                (value, ) = DOUBLE.unpack_from(data, position)
+                position += 8
+                row.append(value)
+            elif value_type == TYPE_TRUE:
+                row.append(True)
+            elif value_type == TYPE_FALSE:
+                row.append(False)
+            else:
+                raise ValueError("Unknown value type: %r" % (value_type, ))
+        rows.append(tuple(row))
+    return rows
+
+class CacheCodec(object):
+    def __init__(self, format="rows", compression="zlib", compress_threshold=1024):
+        """ format is the format that encode() writes, "rows" or
+        "pickle", where "pickle" writes bare pickles without a header.
+        Values whose body is larger than compress_threshold bytes are
+        compressed with 'compression', "zlib" or "bz2". A
+        compress_threshold of 0 disables compression. decode() reads
+        every format whatever these are. """
+        assert(format in ("rows", "pickle"))
+        self.format = format
+        self.compression = COMPRESSIONS[compression]
+        self.compress_threshold = compress_threshold
+
+    def encode(self, value, fresh_until):
+        if self.format == "pickle":
+            return pickle.dumps((fresh_until, value), -1)
+        try:
+            body = encode_rows(value)
+            format = FORMAT_ROWS
+        except UnsupportedValue:
+            body = pickle.dumps(value, -1)
+            format = FORMAT_PICKLE
+        compression = COMPRESSION_NONE
+        if self.compress_threshold > 0 and len(body) > self.compress_threshold:
+            if self.compression == COMPRESSION_ZLIB:
+                compressed_body = zlib.compress(body, 1)
+            else:
+                compressed_body = bz2.compress(body)
+            # Don't store a compressed body that's no smaller.
+            if len(compressed_body) < len(body):
+                body = compressed_body
+                compression = self.compression
+        return HEADER.pack(format, compression, fresh_until) + body
+
+    def decode(self, data):
+        """ Return (fresh_until, value). """
+        if data[0] == LEGACY_PICKLE_MARKER:
+            return pickle.loads(data)
+        (format, compression, fresh_until) = HEADER.unpack_from(data, 0)
+        body = data[HEADER.size:]
+        if compression == COMPRESSION_ZLIB:
+            body = zlib.decompress(body)
+        elif compression == COMPRESSION_BZ2:
+            body = bz2.decompress(body)
+        elif compression != COMPRESSION_NONE:
+            raise ValueError("Unknown compression: %s" % (compression, ))
+        if format == FORMAT_ROWS:
+            return (fresh_until, decode_rows(body))
+        if format == FORMAT_PICKLE:
+            return (fresh_until, pickle.loads(body))
+        raise ValueError("Unknown cache value format: %s" % (format, ))
@@ -0,0 +1,80 @@
+# ----------------------------------------------------------------------------
+#   Reverse index from invalidation tags to cache keys.
+#
+#   Every cached database result is stored under a key built from the
+#   statement's arguments, e.g. "<list_id>:GET_LATEST_LIST_WITH_LIST_ID".
+#   When a list or a user changes we need to find every cached key that
+#   mentions that list_id or user_id. Scanning the keyspace with KEYS is
+#   O(N) in the total number of keys and blocks redis while it runs, so
+#   instead we maintain a redis set per tag:
+#
+#       tag:<normalized uuid or email>  ->  {cache key, cache key, ...}
+#
+#   The set is filled in the same pipeline that stores the cached value,
+#   and invalidating a tag only touches the keys that were tagged with it.
+# ----------------------------------------------------------------------------
+
+import logging
+
+import tornado.gen
+
+TAG_KEY_PREFIX = "tag:"
+
+class CacheTagIndex(object):
+    def __init__(self, r, expiry_time, use_unlink=False):
+        """ r is one of the callback-style clients from async_redis.py.
+        expiry_time is how long a tag set lives after a key was last added
+        to it, and must be at least as long as any key that is tagged
+        lives; see add(). If use_unlink is True then keys are removed with UNLINK, which frees
+        memory in a background thread, rather than DEL. UNLINK requires
+        redis >= 4.0. """
+        self.r = r
+        self.expiry_time = expiry_time
+        self.use_unlink = use_unlink
+
+    @staticmethod
+    def get_tag_key(tag):
+        return "%s%s" % (TAG_KEY_PREFIX, tag)
+
+    def add(self, commands, key, tags):
+        """ Append to the list of pipeline command tuples 'commands' the
+        commands that record that the cache key 'key' depends on every
+        tag in 'tags'.
+
+        The expiry time of the tag sets is refreshed every time a key is
+        added to them, so tag sets for cold data expire on their own. It
+        is the same for every tag set, rather than that of the key just
+        added, as otherwise adding a short-lived key would shorten the
+        life of a set that still holds longer-lived keys, which then
+        could no longer be invalidated. A tag set may outlive some of its
+        keys, which is harmless; deleting a key that has already expired
+        is a no-op. """
+        for tag in set(tags):
+            tag_key = self.get_tag_key(tag)
+            commands.append(("SADD", tag_key, key))
+            commands.append(("EXPIRE", tag_key, self.expiry_time))
+
+    @tornado.gen.engine
+    def invalidate(self, tag, callback):
+        """ Delete every cache key that was tagged with 'tag', and the tag
+        set itself. Returns the number of cache keys that were removed.
+
+        Reading and deleting the tag set happens in one MULTI/EXEC
+        transaction, so a key tagged concurrently with the invalidation
+        either is deleted now or lands in a fresh tag set; it is never
+        silently dropped from the index. The cache keys are then removed
+        with a single DEL (or UNLINK) command. """
+        logger = logging.getLogger("CacheTagIndex.invalidate")
+        tag_key = self.get_tag_key(tag)
+        (keys, _) = yield tornado.gen.Task(self.r.pipeline,
+                                           [("SMEMBERS", tag_key),
+                                            ("DEL", tag_key)],
+                                           transaction=True)
+        logger.debug("tag: %s, number of keys: %s", tag, len(keys))
+        if keys:
+            if self.use_unlink:
+                command = "UNLINK"
+            else:
+                command = "DEL"
+            yield tornado.gen.Task(self.r.execute_command, command, *keys)
+        callback(len(keys))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------------
+#   Retention and compaction of list revisions.
+#
+#   update_list_revision() appends a revision of a list to the list
+#   table on every edit, and nothing else ever removes rows. The
+#   ListRevisionCompactor deletes old revisions, keeping for every list:
+#
+#   - its head revision, i.e. the one list_head points at, always.
+#   - its compaction_keep_revisions most recent revisions.
+#   - any revision newer than compaction_keep_seconds.
+#   - every revision that one of these is a delta of.
+#
+#   Lists are compacted in ranges of list_id of about
+#   compaction_batch_size revisions, one DELETE per range, so that each
+#   DELETE does little work, holds its locks briefly and the IOLoop gets
+#   to run between them. A compaction reads the table once in all.
+#
+#   Every read that DatabaseManager serves, and caches, goes through
+#   list_head, and the head revision of a list is never deleted. Hence
+#   compaction can't change the result of any cached statement and
+#   doesn't need to expire anything.
+#
+#   Run this file to compact once and exit. Alternatively set
+#   compaction_interval_seconds in server.conf and the server compacts
+#   periodically, see start().
+# ----------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import logging
+
+import tornado.gen
+import tornado.ioloop
+import tornado.process
+import tornado.options
+from tornado.options import define, options
+
+import momoko
+
+import metrics
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("compaction_keep_revisions", default=10, type=int, help="Number of most recent revisions of each list kept by compaction")
+define("compaction_keep_seconds", default=60 * 60 * 24 * 7, type=int, help="Revisions younger than this many seconds are kept by compaction")
+define("compaction_batch_size", default=1000, type=int, help="Number of revisions looked at by one compaction statement")
+define("compaction_interval_seconds", default=0, type=int, help="Seconds between compactions run by the server. 0 disables them")
+# ----------------------------------------------------------------------------
+
+class ListRevisionCompactor(object):
+    # ------------------------------------------------------------------------
+    #   Most revisions are stored as a delta from the revision before, see
+    #   database.py, so a revision can only be read if every revision
+    #   before it in its chain, back to the chain's snapshot, is still
+    #   there. Hence we keep or delete whole chains. A chain is kept if it
+    #   contains a list's head, one of its keep_revisions most recent
+    #   revisions, or a revision newer than keep_seconds.
+    #
+    #   Every revision of a chain has the same list_id, so a list can be
+    #   compacted on its own. We walk the lists in order of list_id:
+    #   GET_END_OF_RANGE returns the list_id of the batch_size'th revision
+    #   after 'after', or NULL if there are fewer left, and
+    #   DELETE_OLD_REVISIONS_IN_RANGE deletes the revisions of chains that
+    #   aren't kept of the lists in (after, end]. Both only read the range
+    #   through list_id_on_list. A range holds more than batch_size
+    #   revisions only if its last list alone has that many.
+    #
+    #   NULL 'after' and 'end' mean no bound. Returns the size of the
+    #   contents of each deleted revision.
+    # ------------------------------------------------------------------------
+    GET_END_OF_RANGE = """
+        SELECT list_id
+        FROM list
+        WHERE %(after)s IS NULL OR list_id > %(after)s
+        ORDER BY list_id
+        OFFSET %(offset)s
+        LIMIT 1;"""
+    DELETE_OLD_REVISIONS_IN_RANGE = """
+        WITH ages AS (
+            SELECT revision_id,
+                   snapshot_revision_id,
+                   datetime_edited,
+                   row_number() OVER (PARTITION BY list_id ORDER BY datetime_edited DESC) AS age
+            FROM list
+            WHERE (%(after)s IS NULL OR list_id > %(after)s) AND
+                  (%(end)s IS NULL OR list_id <= %(end)s)
+        ),
+        kept_chains AS (
+            SELECT snapshot_revision_id
+            FROM ages
+            WHERE age <= %(keep_revisions)s OR
+                  datetime_edited >= now() - %(keep_seconds)s * INTERVAL '1 second'
+            UNION
+            SELECT L.snapshot_revision_id
+            FROM list_head H
+            INNER JOIN list L
+            ON L.revision_id = H.revision_id
+            WHERE (%(after)s IS NULL OR H.list_id > %(after)s) AND
+                  (%(end)s IS NULL OR H.list_id <= %(end)s)
+        )
+        DELETE FROM list
+        WHERE revision_id IN (
+            SELECT A.revision_id
+            FROM ages A
+            WHERE NOT EXISTS (SELECT 1 FROM kept_chains K WHERE K.snapshot_revision_id = A.snapshot_revision_id)
+        )
+        RETURNING octet_length(contents);"""
+    # ------------------------------------------------------------------------
+
+    def __init__(self, db, keep_revisions, keep_seconds, batch_size):
+        """ db is a momoko client. """
+        self.db = db
+        self.keep_revisions = keep_revisions
+        self.keep_seconds = keep_seconds
+        self.batch_size = batch_size
+        self.is_running = False
+
+        # Totals over every compaction run by this object.
+        self.rows_reclaimed = 0
+        self.bytes_reclaimed = 0
+        self.runs = 0
+
+    @tornado.gen.engine
+    def compact(self, callback):
+        """ Delete old revisions, a range of lists at a time.
+        Returns (rows reclaimed, bytes of contents reclaimed). If a
+        compaction is already running then returns (0, 0) straight away. """
+        logger = logging.getLogger("ListRevisionCompactor.compact")
+        if self.is_running:
+            logger.debug("compaction is already running.")
+            callback((0, 0))
+            return
+        self.is_running = True
+        args = {"keep_revisions": self.keep_revisions,
+                "keep_seconds": self.keep_seconds,
+                "offset": max(0, self.batch_size - 1),
+                "after": None,
+                "end": None}
+        logger.debug("entry. args: %s", args)
+        rows = 0
+        number_of_bytes = 0
+        try:
+            while True:
+                start = time.time()
+                cursor = yield tornado.gen.Task(self.db.execute,
+                                                self.GET_END_OF_RANGE,
+                                                args)
+                metrics.registry.record_query("GET_END_OF_RANGE", time.time() - start, cursor.rowcount)
+                row = cursor.fetchone()
+                args["end"] = row and row[0]
+                start = time.time()
+                cursor = yield tornado.gen.Task(self.db.execute,
+                                                self.DELETE_OLD_REVISIONS_IN_RANGE,
+                                                args)
+                metrics.registry.record_query("DELETE_OLD_REVISIONS_IN_RANGE", time.time() - start, cursor.rowcount)
+                sizes = [row[0] for row in cursor.fetchall()]
+                rows += len(sizes)
+                number_of_bytes += sum(sizes)
+                logger.debug("range (%s, %s] deleted %s revisions", args["after"], args["end"], len(sizes))
+                if args["end"] is None:
+                    break
+                args["after"] = args["end"]
+        finally:
+            self.is_running = False
+        self.runs += 1
+        self.rows_reclaimed += rows
+        self.bytes_reclaimed += number_of_bytes
+        logger.info("reclaimed %s revisions, %s bytes of contents", rows, number_of_bytes)
+        callback((rows, number_of_bytes))
+
+    def get_statistics(self):
+        return {"runs": self.runs,
+                "rows_reclaimed": self.rows_reclaimed,
+                "bytes_reclaimed": self.bytes_reclaimed}
+
+def create_compactor():
+    """ Return a ListRevisionCompactor configured from options, with a
+    database client of its own. """
+    db = momoko.AsyncClient({
+        'host': options.database_host,
+        'port': options.database_port,
+        'database': options.database_name,
+        'user': options.database_username,
+        'password': options.database_password,
+        'min_conn': 1,
+        'max_conn': 1,
+        'cleanup_timeout': options.database_cleanup_timeout})
+    return ListRevisionCompactor(db,
+                                 keep_revisions=options.compaction_keep_revisions,
+                                 keep_seconds=options.compaction_keep_seconds,
+                                 batch_size=options.compaction_batch_size)
+
+def start():
+    """ If compaction_interval_seconds is set then compact periodically
+    on the IOLoop. Call after the server has forked; only the first
+    process compacts. Returns the PeriodicCallback, or None. """
+    logger = logging.getLogger("compaction.start")
+    if options.compaction_interval_seconds <= 0:
+        logger.debug("periodic compaction is disabled.")
+        return None
+    if tornado.process.task_id() not in (None, 0):
+        return None
+    compactor = create_compactor()
+    metrics.registry.register_pool("compaction", compactor.db)
+    metrics.registry.register_source("compaction", compactor.get_statistics)
+    periodic_callback = tornado.ioloop.PeriodicCallback(lambda: compactor.compact(callback=lambda result: None),
+                                                        options.compaction_interval_seconds * 1000)
+    periodic_callback.start()
+    logger.info("compacting every %s seconds", options.compaction_interval_seconds)
+    return periodic_callback
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(message)s')
+
+    # DatabaseManager defines the database options.
+    import database
+    config_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.conf")
+    tornado.options.parse_config_file(config_filepath)
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    def on_compacted(result):
+        io_loop.stop()
+    create_compactor().compact(callback=on_compacted)
+    io_loop.start()
@@ -7,22 +7,30 @@
 
 import tornado
 import tornado.gen
+import tornado.ioloop
+import tornado.stack_context
 from tornado.options import define, options
 
 import os
 import sys
 import logging
-import cPickle as pickle
 import hashlib
 import base64
 import uuid
-import bz2
+import json
+import time
 
 import momoko
-import redis
 
 from model.List import List
 from utilities import normalize_uuid_string
+from json_patch import make_patch, apply_patch
+from cache_index import CacheTagIndex
+from async_redis import create_redis_client
+from local_cache import LocalCache, CacheInvalidationSubscriber
+from single_flight import SingleFlight
+from cache_codec import CacheCodec
+import metrics
 
 # ----------------------------------------------------------------------------
 #   Configuration constants.
@@ -36,9 +44,33 @@ define("database_min_conn", default=None, type=int, help="Minimum number of data
 define("database_max_conn", default=None, type=int, help="Maximum number of database connections.")
 define("database_cleanup_timeout", default=None, type=int, help="Database cleanup timeout.")
 
+define("database_replica_host", default=None, help="Hostname of a streaming replica of the database to run cached SELECTs on. None runs everything on the primary.")
+define("database_replica_port", default=None, type=int, help="Port of the database replica.")
+define("database_replica_min_conn", default=None, type=int, help="Minimum number of database replica connections.")
+define("database_replica_max_conn", default=None, type=int, help="Maximum number of database replica connections.")
+define("read_your_writes_window", default=5, type=int, help="Seconds after a write during which the writer's reads, and cache fills of what was written, go to the primary rather than the replica.")
+
 define("redis_hostname", default=None, help="Redis server hostname")
 define("redis_port", default=None, type=int, help="Redis server port")
 define("redis_database_id_for_database_results", default=None, type=int, help="Database ID for database statements")
+define("redis_cache_use_unlink", default=False, type=bool, help="Use UNLINK rather than DEL to expire cache keys (redis >= 4.0)")
+define("redis_cache_invalidation_channel", default="cache_invalidation", help="Redis pub/sub channel for cache invalidations")
+
+define("local_cache_max_entries", default=0, type=int, help="Maximum number of entries in the per-process cache. 0 disables it.")
+define("local_cache_max_bytes", default=0, type=int, help="Maximum total size in bytes of the per-process cache.")
+define("local_cache_ttl", default=0, type=int, help="Time-to-live in seconds of per-process cache entries.")
+
+define("cache_generation", default=1, type=int, help="Part of every cache key. Bump it to start with an empty cache, e.g. after a schema change.")
+define("cache_warm_up_lists", default=0, type=int, help="After starting, fill the cache with the roles and this many of the most recently edited lists. 0 disables warm-up.")
+
+define("cache_codec", default="rows", help="Format of cached values: 'rows', or 'pickle' while servers older than cache_codec.py still share the cache.")
+define("cache_compression", default="zlib", help="Compression of large cached values: 'zlib' or 'bz2'.")
+define("cache_compress_threshold", default=0, type=int, help="Compress cached values larger than this many bytes. 0 disables compression.")
+
+define("cache_fill_lock_timeout", default=0, type=int, help="Seconds a worker holds the redis lock for filling a missing cache key, and the most other workers wait for it. 0 disables the lock.")
+define("cache_fill_lock_poll_interval", default=0.01, type=float, help="Seconds between checks for the cached value while another worker holds its lock.")
+
+define("list_snapshot_interval", default=20, type=int, help="Store the full contents of a list every this many revisions, and JSON patches in between. 1 stores every revision in full.")
 # ----------------------------------------------------------------------------
         
 # ----------------------------------------------------------------------------
@@ -66,7 +98,60 @@ define("redis_database_id_for_database_results", default=None, type=int, help="D
 #   hard code a lot of logic here, I think.
 #   
 #   I've accepted the hard solution, and to hard code a lot of logic.
+#
+#   To find the affected cache keys cheaply every cached value is tagged
+#   with its normalized arguments (UUIDs, emails, ...) in a reverse index,
+#   see cache_index.py. expire_cache() then only touches the keys that
+#   were tagged with the value that changed.
+#
+#   In front of redis every worker process has a small LRU cache of its
+#   own, see local_cache.py. expire_cache() publishes each expired tag on
+#   a redis channel so that every worker drops its local copies.
+#
+#   The cache survives restarts of the server. Every key starts with the
+#   cache generation, CACHE_FORMAT_VERSION and the cache_generation
+#   option, so that bumping either one starts an empty cache, and the
+#   keys of old generations expire on their own. Bump
+#   CACHE_FORMAT_VERSION when the code changes what is cached, e.g. a
+#   statement's rows or a transform, and cache_generation when the data
+#   changes under the server, e.g. after a migration. How values are
+#   encoded is not part of the key: every value says which format it is
+#   in, see cache_codec.py.
+#
+#   If there is a database replica then cache misses are filled from it,
+#   and everything else, writes included, runs on the primary. The
+#   replica lags the primary a little, so right after a write it may
+#   still return the old rows, and a value filled from those would stay
+#   in the cache until its TTL is up. To avoid that expire_cache() marks
+#   the tag as written for read_your_writes_window seconds, and keys
+#   with a marked tag are filled from the primary. Separately, the
+#   request handlers pass primary=True to the reads of a user who wrote
+#   something in the last read_your_writes_window seconds.
 # ----------------------------------------------------------------------------
+class CachePolicy(object):
+    def __init__(self, ttl, stale_grace=0, cacheable=True, tag_args=None):
+        """ How the results of one database statement are cached.
+
+        ttl is the number of seconds a result is fresh for. For
+        stale_grace seconds after that it is stale: a reader still gets
+        it at once, and the result is refreshed in the background. After
+        that it is gone, and the next reader waits for the database.
+
+        If cacheable is False the statement always goes to the database.
+
+        tag_args are the indexes of the statement's arguments that the
+        result is tagged with, see expire_cache(). None means all of
+        them. """
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self.cacheable = cacheable
+        self.tag_args = tag_args
+
+    def get_tags(self, args):
+        if self.tag_args is None:
+            return list(args)
+        return [args[i] for i in self.tag_args]
+
 class DatabaseManager(object):
     # ------------------------------------------------------------------------
     #   Database statements related to user authentication and CRUD.
@@ -97,55 +182,165 @@ class DatabaseManager(object):
     #
     #   We define the owner of a list as the user that created the list,
     #   i.e. the user who has the oldest datetime_edited for all revisions
-    #   of a given list.
+    #   of a given list. The owner is recorded in list_head when the list
+    #   is created, so ownership checks are a primary key lookup.
+    #
+    #   Every edit of a list appends a revision to the list table. The
+    #   list_head table has one row per list that points at its latest
+    #   revision, and also records the owner and title of the list. Every
+    #   statement that adds or removes revisions updates list_head in the
+    #   same statement, so the two can't disagree, and reading the latest
+    #   revision of a list is an indexed lookup rather than a GROUP BY
+    #   over the list's whole history.
+    #
+    #   Most revisions don't store the list's contents but a JSON patch,
+    #   see json_patch.py, from the revision before. Every
+    #   list_snapshot_interval revisions the full contents are stored
+    #   again. A snapshot and the deltas that follow it form a chain:
+    #
+    #       snapshot_revision_id    the revision_id of the chain's snapshot.
+    #       delta_number            0 for the snapshot, n for the n'th delta.
+    #
+    #   To read a list we fetch the chain up to the head revision and
+    #   apply the deltas in order, see reconstruct_list_revisions().
+    #
+    #   A delta only makes sense applied to the revision it was made from,
+    #   so an update only succeeds if the head is still that revision,
+    #   see UPDATE_LIST_WITH_PARENT_REVISION_ID. FOR UPDATE makes
+    #   concurrent updates of a list queue up, and each one re-checks the
+    #   head once the one before it has committed. The same check lets
+    #   an edit say which revision it was made to, and fail rather than
+    #   overwrite anything added since, see update_list_revision().
     # ------------------------------------------------------------------------
-    CREATE_LIST_WITH_USER_ID_AND_CONTENTS_RETURN_LIST_ID = """
-        INSERT INTO list (revision_id, list_id, helpmeshop_user_id, datetime_edited, contents)
-        VALUES (uuid_generate_v4(), uuid_generate_v4(), %s, now(), %s)
+    CREATE_LIST_RETURN_LIST_ID = """
+        WITH new_revision AS (
+            INSERT INTO list (revision_id, list_id, helpmeshop_user_id, datetime_edited, contents, snapshot_revision_id, delta_number)
+            VALUES (%(revision_id)s, %(list_id)s, %(user_id)s, now(), %(contents)s, %(revision_id)s, 0)
+            RETURNING revision_id, list_id, helpmeshop_user_id, datetime_edited
+        )
+        INSERT INTO list_head (list_id, revision_id, helpmeshop_user_id, title, datetime_edited)
+        SELECT list_id, revision_id, helpmeshop_user_id, %(title)s, datetime_edited
+        FROM new_revision
         RETURNING list_id;"""
-    UPDATE_LIST_WITH_LIST_ID_AND_USER_ID_AND_CONTENTS = """
-        INSERT INTO list (revision_id, list_id, helpmeshop_user_id, datetime_edited, contents)
-        VALUES (uuid_generate_v4(), %s, %s, now(), %s);"""        
+    UPDATE_LIST_WITH_PARENT_REVISION_ID = """
+        WITH head AS (
+            SELECT list_id
+            FROM list_head
+            WHERE list_id = %(list_id)s AND
+                  revision_id = %(parent_revision_id)s
+            FOR UPDATE
+        ),
+        new_revision AS (
+            INSERT INTO list (revision_id, list_id, helpmeshop_user_id, datetime_edited, contents, snapshot_revision_id, delta_number)
+            SELECT %(revision_id)s, list_id, %(user_id)s, now(), %(contents)s, %(snapshot_revision_id)s, %(delta_number)s
+            FROM head
+            RETURNING revision_id, list_id, datetime_edited
+        )
+        UPDATE list_head H
+        SET revision_id = N.revision_id,
+            title = %(title)s,
+            datetime_edited = N.datetime_edited
+        FROM new_revision N
+        WHERE H.list_id = N.list_id
+        RETURNING H.revision_id;"""
     GET_LATEST_LISTS_WITH_USER_ID = """
-        SELECT L.revision_id, L.list_id, L.contents, L.datetime_edited
-        FROM list L
-        INNER JOIN (
-            SELECT list_id, MAX(datetime_edited) AS datetime_edited
-            FROM list
-            WHERE helpmeshop_user_id = %s
-            GROUP BY list_id
-        ) X
-        ON X.list_id = L.list_id AND
-           X.datetime_edited = L.datetime_edited;"""
+        SELECT L.revision_id, L.list_id, L.contents, L.datetime_edited, L.snapshot_revision_id, L.delta_number
+        FROM list_head H
+        INNER JOIN list HL
+        ON HL.revision_id = H.revision_id
+        INNER JOIN list L
+        ON L.snapshot_revision_id = HL.snapshot_revision_id AND
+           L.delta_number <= HL.delta_number
+        WHERE H.helpmeshop_user_id = %s
+        ORDER BY L.list_id, L.delta_number;"""
     GET_LATEST_LIST_WITH_LIST_ID = """
-        SELECT L.revision_id, L.list_id, L.contents, L.datetime_edited
-        FROM list L
-        INNER JOIN (
-            SELECT list_id, MAX(datetime_edited) AS datetime_edited
-            FROM list
-            GROUP BY list_id
-        ) X
-        ON X.list_id = L.list_id AND
-           X.datetime_edited = L.datetime_edited
-        WHERE L.list_id = %s;"""
-    DELETE_LIST_WITH_LIST_ID = """DELETE FROM list WHERE list_id = %s;"""
+        SELECT L.revision_id, L.list_id, L.contents, L.datetime_edited, L.snapshot_revision_id, L.delta_number
+        FROM list_head H
+        INNER JOIN list HL
+        ON HL.revision_id = H.revision_id
+        INNER JOIN list L
+        ON L.snapshot_revision_id = HL.snapshot_revision_id AND
+           L.delta_number <= HL.delta_number
+        WHERE H.list_id = %s
+        ORDER BY L.delta_number;"""
+    DELETE_LIST_WITH_LIST_ID = """
+        WITH deleted_head AS (
+            DELETE FROM list_head WHERE list_id = %s
+        )
+        DELETE FROM list WHERE list_id = %s;"""
     GET_OWNER_USER_ID_WITH_LIST_ID = """
-        SELECT L.helpmeshop_user_id
-        FROM LIST L
-        INNER JOIN (
-            SELECT list_id, MIN(datetime_edited) AS datetime_edited
-            FROM list
-            WHERE list_id = %s
-            GROUP BY list_id
-        ) X
-        ON X.list_id = L.list_id AND
-           X.datetime_edited = L.datetime_edited;"""        
+        SELECT helpmeshop_user_id
+        FROM list_head
+        WHERE list_id = %s;"""
+    GET_RECENTLY_EDITED_LIST_IDS = """
+        SELECT list_id
+        FROM list_head
+        ORDER BY datetime_edited DESC
+        LIMIT %s;"""
+    GET_LATEST_LISTS_WITH_LIST_IDS = """
+        SELECT L.revision_id, L.list_id, L.contents, L.datetime_edited, L.snapshot_revision_id, L.delta_number
+        FROM list_head H
+        INNER JOIN list HL
+        ON HL.revision_id = H.revision_id
+        INNER JOIN list L
+        ON L.snapshot_revision_id = HL.snapshot_revision_id AND
+           L.delta_number <= HL.delta_number
+        WHERE H.list_id = ANY(%s::uuid[])
+        ORDER BY L.list_id, L.delta_number;"""
+    GET_OWNER_USER_IDS_WITH_LIST_IDS = """
+        SELECT list_id, helpmeshop_user_id
+        FROM list_head
+        WHERE list_id = ANY(%s::uuid[]);"""
     # ------------------------------------------------------------------------
     
     # ------------------------------------------------------------------------
-    #   If a 
+    #   How the results of each statement are cached, by statement name,
+    #   see CachePolicy. Statements that aren't listed get
+    #   DEFAULT_CACHE_POLICY.
+    #
+    #   Every statement that changes what one of these returns expires
+    #   the cached results by tag, so the TTLs only bound how long cold
+    #   results take up memory, and it is safe to serve a result in its
+    #   stale grace window.
     # ------------------------------------------------------------------------
-    
+    CACHE_FORMAT_VERSION = 1
+    DEFAULT_CACHE_POLICY = CachePolicy(ttl=60 * 60 * 24)
+    CACHE_POLICIES = {
+        # Roles never change while the server runs, and the role name
+        # isn't something we expire by.
+        "GET_ROLE_ID": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60 * 24, tag_args=()),
+
+        "GET_USER_ID_FROM_GOOGLE_EMAIL": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60, tag_args=(0, )),
+        "GET_USER_ID_FROM_FACEBOOK_ID": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60, tag_args=(0, )),
+        "GET_USER_ID_FROM_TWITTER_USERNAME": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60, tag_args=(0, )),
+        "GET_USER_ID_FROM_BROWSERID_EMAIL": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60, tag_args=(0, )),
+        # Keep API secret keys out of redis.
+        "GET_USER_ID_FROM_API_SECRET_KEY": CachePolicy(ttl=0, cacheable=False),
+
+        "GET_LATEST_LISTS_WITH_USER_ID": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60, tag_args=(0, )),
+        "GET_LATEST_LIST_WITH_LIST_ID": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60, tag_args=(0, )),
+        # The owner of a list never changes.
+        "GET_OWNER_USER_ID_WITH_LIST_ID": CachePolicy(ttl=60 * 60 * 24, stale_grace=60 * 60 * 24, tag_args=(0, )),
+    }
+    # Tag sets must live as long as the longest-lived key in them, see
+    # CacheTagIndex.add().
+    TAG_EXPIRY_TIME = max(policy.ttl + policy.stale_grace
+                          for policy in CACHE_POLICIES.values() + [DEFAULT_CACHE_POLICY])
+    # ------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------
+    #   Locks for filling missing cache keys, see fill_cache(). The lock
+    #   for a cache key is LOCK_KEY_PREFIX + key, and holds a random token
+    #   so that a worker only ever releases its own lock.
+    # ------------------------------------------------------------------------
+    LOCK_KEY_PREFIX = "lock:"
+    # Marks a tag as recently written, see expire_cache().
+    WRITE_MARKER_KEY_PREFIX = "written:"
+    RELEASE_LOCK_SCRIPT = """
+        if redis.call("GET", KEYS[1]) == ARGV[1] then
+            return redis.call("DEL", KEYS[1])
+        end
+        return 0"""
     # ------------------------------------------------------------------------
 
     def __init__(self):
@@ -158,49 +353,145 @@ class DatabaseManager(object):
             'min_conn': options.database_min_conn,
             'max_conn': options.database_max_conn,
             'cleanup_timeout': options.database_cleanup_timeout})
+        self.replica_db = None
+        if options.database_replica_host:
+            self.replica_db = momoko.AsyncClient({
+                'host': options.database_replica_host,
+                'port': options.database_replica_port,
+                'database': options.database_name,
+                'user': options.database_username,
+                'password': options.database_password,
+                'min_conn': options.database_replica_min_conn,
+                'max_conn': options.database_replica_max_conn,
+                'cleanup_timeout': options.database_cleanup_timeout})
+        self.replica_reads = 0
+        self.recent_write_reads = 0
+        metrics.registry.register_pool("primary", self.db)
+        if self.replica_db is not None:
+            metrics.registry.register_pool("replica", self.replica_db)
 
         # Start a connection to the redis to the database ID that stores
-        # cached versions of database read queries. Delete all of them.
-        self.r = redis.StrictRedis(host=options.redis_hostname,
-                                   port=options.redis_port,
-                                   db=options.redis_database_id_for_database_results)
-        self.r.flushdb()            
-
-    def expire_cache(self, pattern):
-        """ Expire all keys in the catch that contain 'pattern',
-        which is a string.  For a given database query call this
-        function repeatedly for every argument you used.
+        # cached versions of database read queries. Whatever is cached
+        # for the current generation is still valid, so keep it.
+        self.r = create_redis_client(options.redis_database_id_for_database_results)
+        self.cache_key_prefix = "v%s.%s:" % (self.CACHE_FORMAT_VERSION, options.cache_generation)
+        self.codec = CacheCodec(format=options.cache_codec,
+                                compression=options.cache_compression,
+                                compress_threshold=options.cache_compress_threshold)
+        self.tag_index = CacheTagIndex(self.r,
+                                       self.TAG_EXPIRY_TIME,
+                                       use_unlink=options.redis_cache_use_unlink)
+
+        # Per-process cache in front of redis. Note that DatabaseManager is
+        # created after the server forks, so every worker subscribes to
+        # invalidations for its own cache.
+        self.local_cache = LocalCache(max_entries=options.local_cache_max_entries,
+                                      max_bytes=options.local_cache_max_bytes,
+                                      ttl=options.local_cache_ttl)
+        self.local_caches = []
+        self.invalidation_subscriber = None
+        self.add_local_cache(self.local_cache)
+
+        # Callers in this process that miss the same cache key at the same
+        # time wait for one query, see single_flight.py.
+        self.single_flight = SingleFlight()
+        self.cache_fill_locks_acquired = 0
+        self.cache_fill_lock_waits = 0
+        self.cache_fill_lock_wait_hits = 0
+        self.cache_fill_lock_timeouts = 0
+
+        # Keys that are being refreshed in the background because a stale
+        # value was served, see revalidate().
+        self.revalidating = set()
+        self.stale_hits = 0
+        self.revalidations = 0
+        metrics.registry.register_source("cache", self.get_cache_statistics)
+
+    def add_local_cache(self, local_cache):
+        """ Have expire_cache() invalidate the entries of 'local_cache', a
+        LocalCache of this process, by tag, in every process, as it does
+        those of self.local_cache. For caches of values made from cached
+        results, e.g. rendered pages, tagged with the same tags. """
+        if not local_cache.enabled:
+            return
+        self.local_caches.append(local_cache)
+        if self.invalidation_subscriber is None:
+            self.invalidation_subscriber = CacheInvalidationSubscriber(self.local_caches,
+                                                                       options.redis_cache_invalidation_channel,
+                                                                       options.redis_hostname,
+                                                                       options.redis_port,
+                                                                       options.redis_database_id_for_database_results)
+            self.invalidation_subscriber.start()
+
+    @tornado.gen.engine
+    def expire_cache(self, pattern, callback):
+        """ Expire all keys in the cache that were stored with 'pattern',
+        which is a string, as one of their arguments.  For a given
+        database query call this function repeatedly for every argument
+        you used.
         
         This function will not normalize UUIDs for you, i.e.
         remove the dashes! Do this yourself!"""
         logger = logging.getLogger("DatabaseManager.expire_cache")
-        logger.debug("entry. pattern: %s" % (pattern))
-        substring_pattern = "*%s*" % (pattern, )
-        for key in self.r.keys(substring_pattern):
-            self.r.delete(key)
+        logger.debug("entry. pattern: %s", pattern)
+        number_of_keys = yield tornado.gen.Task(self.tag_index.invalidate, pattern)
+        logger.debug("expired %s keys", number_of_keys)
+        if self.replica_db is not None:
+            # Until the replica has caught up with the write, keys tagged
+            # with pattern are filled from the primary.
+            yield tornado.gen.Task(self.r.setex,
+                                   self.get_write_marker_key(pattern),
+                                   options.read_your_writes_window,
+                                   "1")
+        if self.local_caches:
+            for local_cache in self.local_caches:
+                local_cache.invalidate(pattern)
+            yield tornado.gen.Task(self.r.publish,
+                                   options.redis_cache_invalidation_channel,
+                                   pattern)
+        callback()
         
     @tornado.gen.engine
     def execute_cached_db_statement(self,
                                     statement,
                                     args,
                                     statement_name,
-                                    callback):
+                                    callback,
+                                    transform=None,
+                                    primary=False):
         """ Execute a database statement. Use a redis-based cache.
         Only call this function for database queries that gather
         data, rather than modify data, i.e. SELECT statements.
         
         This will return the full result of cursor.fetchall(). If
         you need access to the actual cursor don't use this
-        function, as cursors can't be pickled.
+        function, as cursors can't be cached.
         
         statement is a string of the database query you want to
         execute. args is a tuple of arguments. statement_name
         is a string of the variable that the database statement
         string comes from.
+
+        If transform is given then the rows are passed through it
+        before they are cached and returned, so that work done on the
+        rows, e.g. reconstructing list contents, is cached too.
+
+        How long results are cached for, and what they are tagged with,
+        is set by the statement's entry in CACHE_POLICIES.
+
+        A cache miss is filled from the database replica, if there is
+        one, unless primary is True or the result is tagged with a tag
+        that was written recently.
         """
         
         logger = logging.getLogger("DatabaseManager.execute_cached_db_statement")
-        logger.debug("entry. statement_name: %s, args: %s" % (statement_name, args))
+        logger.debug("entry. statement_name: %s, args: %s", statement_name, args)
+        start = time.time()
+        statement_metrics = metrics.registry.get_statement(statement_name)
+        statement_metrics.calls += 1
+        def finish(value):
+            statement_metrics.latency.observe(time.time() - start)
+            callback(value)
         
         # --------------------------------------------------------------------
         #   Use, or create, an element in the cache that maps
@@ -210,23 +501,367 @@ class DatabaseManager(object):
         #   For each arg that looks like a UUID remove all the dashes
         #   from it. This helps with future lookups.
         # --------------------------------------------------------------------        
-        args_with_normalized_uuids = [normalize_uuid_string(elem) for elem in args]
-        logger.debug("args_with_normalized_uuids: %s" % (args_with_normalized_uuids, ))        
-        key_elems = args_with_normalized_uuids + [statement_name]        
-        key = ":".join(key_elems)
-        value_pickled = self.r.get(key)        
-        if not value_pickled:
-            logger.debug("cache miss")
-            cursor = yield tornado.gen.Task(self.db.execute, statement, args)
+        policy = self.CACHE_POLICIES.get(statement_name, self.DEFAULT_CACHE_POLICY)
+        if not policy.cacheable:
+            statement_metrics.misses += 1
+            cursor = yield tornado.gen.Task(self.query, statement, args, statement_name)
             value = cursor.fetchall()
-            self.r.setex(key, 60 * 60 * 24, pickle.dumps(value, -1))
+            if transform is not None:
+                value = transform(value)
+            finish(value)
+            return
+        (key, args_with_normalized_uuids) = self.get_cache_key(args, statement_name)
+        logger.debug("args_with_normalized_uuids: %s", args_with_normalized_uuids)        
+        tags = policy.get_tags(args_with_normalized_uuids)
+        value = self.local_cache.get(key)
+        if value is not None:
+            logger.debug("local cache hit")
+            logger.debug("value: %s", value)
+            statement_metrics.local_hits += 1
+            finish(value)
+            return
+
+        # If another caller in this process is already getting the value
+        # then wait for it. If it fails then one of the callers that
+        # waited takes over.
+        while self.single_flight.is_in_flight(key):
+            logger.debug("waiting for the caller in flight")
+            value = yield tornado.gen.Task(self.single_flight.wait, key)
+            if value is not None:
+                logger.debug("coalesced. statistics: %s", self.single_flight.get_statistics())
+                statement_metrics.coalesced += 1
+                finish(value)
+                return
+        self.single_flight.start(key)
+        try:
+            (value, number_of_bytes, fresh_until) = yield tornado.gen.Task(self.fill_cache,
+                                                                           key,
+                                                                           statement,
+                                                                           statement_name,
+                                                                           args,
+                                                                           tags,
+                                                                           transform,
+                                                                           policy,
+                                                                           primary)
+        except:
+            self.single_flight.finish(key, None)
+            raise
+        fresh_for = fresh_until - time.time()
+        if fresh_for > 0:
+            self.local_cache.set(key, value, number_of_bytes, tags, fresh_for)
         else:
-            logger.debug("cache hit")
-            value = pickle.loads(value_pickled)
+            # Serve the stale value, and refresh it without making this
+            # caller wait. The refresh mustn't run in this request's
+            # stack context, as it outlives the request.
+            logger.debug("stale by %.1f seconds", -fresh_for)
+            self.stale_hits += 1
+            with tornado.stack_context.NullContext():
+                self.revalidate(key, statement, statement_name, args, tags, transform, policy)
+        self.single_flight.finish(key, value)
         # --------------------------------------------------------------------        
         
-        logger.debug("value: %s" % (value, ))
-        callback(value)
+        logger.debug("value: %s", value)
+        finish(value)
+
+    @tornado.gen.engine
+    def execute(self, statement, args, statement_name, callback):
+        """ Execute a database statement on the primary, uncached, and
+        return the cursor. Use this rather than self.db.execute, so that
+        the statement shows up in the metrics under statement_name. """
+        start = time.time()
+        statement_metrics = metrics.registry.get_statement(statement_name)
+        statement_metrics.calls += 1
+        cursor = yield tornado.gen.Task(self.query, statement, args, statement_name)
+        statement_metrics.latency.observe(time.time() - start)
+        callback(cursor)
+
+    @tornado.gen.engine
+    def query(self, statement, args, statement_name, callback, db=None):
+        """ Run a statement on 'db', default the primary, and record the
+        round trip in the metrics of statement_name. """
+        if db is None:
+            db = self.db
+        start = time.time()
+        cursor = yield tornado.gen.Task(db.execute, statement, args)
+        metrics.registry.record_query(statement_name, time.time() - start, cursor.rowcount)
+        callback(cursor)
+
+    def get_write_marker_key(self, tag):
+        return "%s%s" % (self.WRITE_MARKER_KEY_PREFIX, tag)
+
+    def get_write_marker_commands(self, tags):
+        """ Return the pipeline commands whose replies, summed, count how
+        many of 'tags' were written recently. One EXISTS per tag, as
+        EXISTS only takes several keys from redis 3.0.3. """
+        return [("EXISTS", self.get_write_marker_key(tag)) for tag in tags]
+
+    def choose_read_db(self, number_of_recently_written_tags):
+        """ Return the database client to fill cache misses from, given
+        how many of their tags were written recently. """
+        if number_of_recently_written_tags:
+            self.recent_write_reads += 1
+            return self.db
+        self.replica_reads += 1
+        return self.replica_db
+
+    @tornado.gen.engine
+    def get_read_db(self, tags, callback):
+        """ Return the database client to fill a cache key tagged with
+        'tags' from, see choose_read_db(). """
+        if self.replica_db is None:
+            callback(self.db)
+            return
+        number_of_recently_written_tags = 0
+        if tags:
+            replies = yield tornado.gen.Task(self.r.pipeline,
+                                             self.get_write_marker_commands(tags))
+            number_of_recently_written_tags = sum(replies)
+        callback(self.choose_read_db(number_of_recently_written_tags))
+
+    def get_cache_key(self, args, statement_name):
+        """ Return (cache key, args with normalized UUIDs) for the result
+        of statement_name with 'args'. """
+        args_with_normalized_uuids = [normalize_uuid_string(elem) for elem in args]
+        key_elems = args_with_normalized_uuids + [statement_name]
+        key = self.cache_key_prefix + ":".join(key_elems)
+        return (key, args_with_normalized_uuids)
+
+    @tornado.gen.engine
+    def fill_cache(self, key, statement, statement_name, args, tags, transform, policy, primary, callback):
+        """ Return (value, size in bytes of its encoded form, time until
+        which it is fresh) for the cache key 'key'. Get it from redis,
+        where it may be stale, or run the statement and put the value in
+        redis, tagged with 'tags'.
+
+        If cache_fill_lock_timeout is set then a worker takes a lock in
+        redis before it runs the statement. Other workers that miss the
+        same key in the meantime poll redis for the value rather than run
+        the statement too, for up to cache_fill_lock_timeout seconds. The
+        lock expires after that long, in case its holder dies.
+
+        The statement runs on the replica unless primary is True or one
+        of 'tags' was written recently. Whether one was is looked up in
+        the same round trip as the key. """
+        logger = logging.getLogger("DatabaseManager.fill_cache")
+        statement_metrics = metrics.registry.get_statement(statement_name)
+        db = self.db
+        if self.replica_db is None or primary:
+            value_encoded = yield tornado.gen.Task(self.r.get, key)
+        elif not tags:
+            value_encoded = yield tornado.gen.Task(self.r.get, key)
+            db = self.choose_read_db(0)
+        else:
+            replies = yield tornado.gen.Task(self.r.pipeline,
+                                             [("GET", key)] + self.get_write_marker_commands(tags))
+            value_encoded = replies[0]
+            db = self.choose_read_db(sum(replies[1:]))
+        if value_encoded:
+            logger.debug("cache hit")
+            (fresh_until, value) = self.codec.decode(value_encoded)
+            statement_metrics.redis_hits += 1
+            statement_metrics.bytes += len(value_encoded)
+            callback((value, len(value_encoded), fresh_until))
+            return
+        logger.debug("cache miss")
+
+        lock_key = None
+        token = None
+        if options.cache_fill_lock_timeout > 0:
+            lock_key = self.LOCK_KEY_PREFIX + key
+            token = uuid.uuid4().hex
+            locked = yield tornado.gen.Task(self.r.execute_command,
+                                            "SET", lock_key, token,
+                                            "NX", "EX", options.cache_fill_lock_timeout)
+            if locked:
+                self.cache_fill_locks_acquired += 1
+            else:
+                self.cache_fill_lock_waits += 1
+                logger.debug("waiting for another worker to fill the key")
+                value_encoded = yield tornado.gen.Task(self.wait_for_cache_fill, key, lock_key)
+                if value_encoded:
+                    self.cache_fill_lock_wait_hits += 1
+                    (fresh_until, value) = self.codec.decode(value_encoded)
+                    statement_metrics.redis_hits += 1
+                    statement_metrics.bytes += len(value_encoded)
+                    callback((value, len(value_encoded), fresh_until))
+                    return
+                # The holder of the lock didn't fill the key in time, or
+                # failed. Run the statement ourselves.
+                self.cache_fill_lock_timeouts += 1
+                logger.debug("no value from the other worker. statistics: %s", self.get_cache_statistics())
+                lock_key = None
+
+        statement_metrics.misses += 1
+        result = yield tornado.gen.Task(self.query_and_store,
+                                        key,
+                                        statement,
+                                        statement_name,
+                                        args,
+                                        tags,
+                                        transform,
+                                        policy,
+                                        lock_key,
+                                        token,
+                                        db)
+        callback(result)
+
+    @tornado.gen.engine
+    def query_and_store(self, key, statement, statement_name, args, tags, transform, policy, lock_key, token, db, callback):
+        """ Run the statement on 'db', one of the database clients, and
+        store its value in redis under 'key', to be fresh for policy.ttl
+        seconds and kept for policy.stale_grace seconds more. If lock_key
+        is given then release that lock, which holds 'token', in the same
+        round trip. Returns (value, size in bytes of its encoded form,
+        time until which it is fresh). """
+        cursor = yield tornado.gen.Task(self.query, statement, args, statement_name, db=db)
+        value = cursor.fetchall()
+        if transform is not None:
+            value = transform(value)
+        fresh_until = time.time() + policy.ttl
+        commands = []
+        number_of_bytes = self.add_store_commands(commands, key, value, tags, policy, fresh_until)
+        metrics.registry.get_statement(statement_name).bytes += number_of_bytes
+        if lock_key is not None:
+            commands.append(("EVAL", self.RELEASE_LOCK_SCRIPT, 1, lock_key, token))
+        yield tornado.gen.Task(self.r.pipeline, commands)
+        callback((value, number_of_bytes, fresh_until))
+
+    def add_store_commands(self, commands, key, value, tags, policy, fresh_until):
+        """ Append to the list of pipeline command tuples 'commands' the
+        commands that store value under 'key' until fresh_until plus
+        policy.stale_grace seconds, tagged with 'tags'. Returns the size
+        in bytes of its encoded form. """
+        value_encoded = self.codec.encode(value, fresh_until)
+        expiry_time = policy.ttl + policy.stale_grace
+        commands.append(("SETEX", key, expiry_time, value_encoded))
+        self.tag_index.add(commands, key, tags)
+        return len(value_encoded)
+
+    @tornado.gen.engine
+    def revalidate(self, key, statement, statement_name, args, tags, transform, policy, callback=None):
+        """ Refresh the stale value under 'key' in the background. Only
+        one refresh of a key runs per process and, if
+        cache_fill_lock_timeout is set, across processes. """
+        logger = logging.getLogger("DatabaseManager.revalidate")
+        if key in self.revalidating:
+            logger.debug("already refreshing key: %s", key)
+            return
+        self.revalidating.add(key)
+        try:
+            lock_key = None
+            token = None
+            if options.cache_fill_lock_timeout > 0:
+                lock_key = self.LOCK_KEY_PREFIX + key
+                token = uuid.uuid4().hex
+                locked = yield tornado.gen.Task(self.r.execute_command,
+                                                "SET", lock_key, token,
+                                                "NX", "EX", options.cache_fill_lock_timeout)
+                if not locked:
+                    logger.debug("another worker is refreshing key: %s", key)
+                    return
+            self.revalidations += 1
+            db = yield tornado.gen.Task(self.get_read_db, tags)
+            (value, number_of_bytes, fresh_until) = yield tornado.gen.Task(self.query_and_store,
+                                                                           key,
+                                                                           statement,
+                                                                           statement_name,
+                                                                           args,
+                                                                           tags,
+                                                                           transform,
+                                                                           policy,
+                                                                           lock_key,
+                                                                           token,
+                                                                           db)
+            self.local_cache.set(key, value, number_of_bytes, tags, fresh_until - time.time())
+            logger.debug("refreshed key: %s", key)
+        finally:
+            self.revalidating.discard(key)
+
+    @tornado.gen.engine
+    def wait_for_cache_fill(self, key, lock_key, callback):
+        """ Poll redis until the cache key 'key' has a value, and return
+        it. Return None if the lock 'lock_key' is released without a value
+        being stored, or if cache_fill_lock_timeout seconds pass. """
+        logger = logging.getLogger("DatabaseManager.wait_for_cache_fill")
+        deadline = time.time() + options.cache_fill_lock_timeout
+        while time.time() < deadline:
+            yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout,
+                                   time.time() + options.cache_fill_lock_poll_interval)
+            (value_encoded, locked) = yield tornado.gen.Task(self.r.pipeline,
+                                                             [("GET", key),
+                                                              ("EXISTS", lock_key)])
+            if value_encoded or not locked:
+                callback(value_encoded)
+                return
+        logger.debug("timed out waiting for key: %s", key)
+        callback(None)
+
+    # ------------------------------------------------------------------------
+    #   Start-up and cache warm-up.
+    # ------------------------------------------------------------------------
+    PING = """SELECT 1;"""
+    WARM_UP_ROLE_NAMES = ["regular", "admin"]
+    # Number of lists warm_up() reads at a time.
+    WARM_UP_BATCH_SIZE = 10
+
+    @tornado.gen.engine
+    def open(self, callback):
+        """ Wait for a connection to every database and to redis, and
+        load the role IDs, which never change, so that the first requests
+        of this process don't pay for any of them. """
+        logger = logging.getLogger("DatabaseManager.open")
+        logger.debug("entry.")
+        clients = [self.db]
+        if self.replica_db is not None:
+            clients.append(self.replica_db)
+        yield [tornado.gen.Task(self.query, self.PING, (), "PING", db=client) for client in clients]
+        yield tornado.gen.Task(self.r.execute_command, "PING")
+        for role_name in self.WARM_UP_ROLE_NAMES:
+            yield tornado.gen.Task(self.execute_cached_db_statement,
+                                   self.GET_ROLE_ID,
+                                   (role_name, ),
+                                   "GET_ROLE_ID")
+        callback()
+
+    @tornado.gen.engine
+    def warm_up(self, number_of_lists, callback):
+        """ Fill the cache with results that are about to be wanted: the
+        latest revision and owner of each of the number_of_lists most
+        recently edited lists, and the lists of their owners. Results
+        that are already cached are left as they are. Returns the number
+        of lists. """
+        logger = logging.getLogger("DatabaseManager.warm_up")
+        logger.debug("entry. number_of_lists: %s", number_of_lists)
+        cursor = yield tornado.gen.Task(self.execute,
+                                        self.GET_RECENTLY_EDITED_LIST_IDS,
+                                        (number_of_lists, ),
+                                        "GET_RECENTLY_EDITED_LIST_IDS")
+        list_ids = [row[0] for row in cursor.fetchall()]
+        owner_user_ids = set()
+        for i in xrange(0, len(list_ids), self.WARM_UP_BATCH_SIZE):
+            batch = list_ids[i:i + self.WARM_UP_BATCH_SIZE]
+            yield tornado.gen.Task(self.read_lists, batch)
+            owners = yield [tornado.gen.Task(self.get_owner_user_id, list_id) for list_id in batch]
+            owner_user_ids.update(str(owner) for owner in owners if owner is not None)
+        owner_user_ids = list(owner_user_ids)
+        for i in xrange(0, len(owner_user_ids), self.WARM_UP_BATCH_SIZE):
+            batch = owner_user_ids[i:i + self.WARM_UP_BATCH_SIZE]
+            yield [tornado.gen.Task(self.get_lists, user_id) for user_id in batch]
+        logger.debug("warmed up %s lists of %s users", len(list_ids), len(owner_user_ids))
+        callback(len(list_ids))
+    # ------------------------------------------------------------------------
+
+    def get_cache_statistics(self):
+        return {"local_cache": self.local_cache.get_statistics(),
+                "single_flight": self.single_flight.get_statistics(),
+                "cache_fill_locks_acquired": self.cache_fill_locks_acquired,
+                "cache_fill_lock_waits": self.cache_fill_lock_waits,
+                "cache_fill_lock_wait_hits": self.cache_fill_lock_wait_hits,
+                "cache_fill_lock_timeouts": self.cache_fill_lock_timeouts,
+                "stale_hits": self.stale_hits,
+                "revalidations": self.revalidations,
+                "replica_reads": self.replica_reads,
+                "recent_write_reads": self.recent_write_reads}
 
     def extract_one_value_from_one_or_zero_rows(self, cursor_or_rows):
         """ If you execute a query that SELECTs for one value, and expects only
@@ -241,69 +876,161 @@ class DatabaseManager(object):
         has a "fetchall" method we assume its a cursor and call this method.
         """
         logger = logging.getLogger("DatabaseManager.extract_one_value_from_one_or_zero_rows")                
-        logger.debug("entry. cursor_or_rows: %s" % (cursor_or_rows, ))
+        logger.debug("entry. cursor_or_rows: %s", cursor_or_rows)
         if hasattr(cursor_or_rows, "fetchall"):
             logger.debug("cursor_or_rows has fetchall method")
             results = cursor_or_rows.fetchall()
         else:
             logger.debug("cursor_or_rows does not have fetchall method")
             results = cursor_or_rows
-        logger.debug("results: %s" % (results, ))
+        logger.debug("results: %s", results)
         if len(results) == 0:
             logger.debug("returning: None")
             return None
         assert(len(results) == 1)
         only_row = results[0]
         assert(len(only_row) == 1)        
-        logger.debug("returning: %s" % (only_row[0], ))
+        logger.debug("returning: %s", only_row[0])
         return only_row[0]        
         
     # ------------------------------------------------------------------------
     #   List CRUD.
     # ------------------------------------------------------------------------    
+    @staticmethod
+    def get_title_from_contents(contents):
+        """ Return the title in the JSON string 'contents' of a list, to
+        store in list_head. None if there isn't one. """
+        try:
+            contents_decoded = json.loads(contents)
+        except ValueError:
+            return None
+        return contents_decoded.get("title")
+
+    @staticmethod
+    def reconstruct_list_revisions(rows):
+        """ Given the rows of the revision chains of one or more lists,
+        ordered by list and then by delta_number, return one row per list
+        for its latest revision with the full contents of the list:
+
+            (revision_id, list_id, contents, datetime_edited, snapshot_revision_id, delta_number) """
+        reconstructed_rows = []
+        for (i, row) in enumerate(rows):
+            (revision_id, list_id, contents, datetime_edited, snapshot_revision_id, delta_number) = row
+            if delta_number == 0:
+                # Only decode the snapshot if there are deltas to apply.
+                snapshot_contents = contents
+                document = None
+            else:
+                assert(rows[i - 1][1] == list_id and rows[i - 1][5] == delta_number - 1)
+                if document is None:
+                    document = json.loads(snapshot_contents)
+                document = apply_patch(document, json.loads(contents))
+            if i + 1 == len(rows) or rows[i + 1][1] != list_id:
+                if document is None:
+                    contents = snapshot_contents
+                else:
+                    contents = json.dumps(document)
+                reconstructed_rows.append((revision_id, list_id, contents, datetime_edited, snapshot_revision_id, delta_number))
+        return reconstructed_rows
+
+    @staticmethod
+    def encode_list_revision(parent_row, revision_id, contents, snapshot_interval):
+        """ Return (contents to store, snapshot_revision_id, delta_number)
+        for a new revision, revision_id, of a list whose full contents are
+        'contents'. parent_row is the reconstructed row of the revision
+        the new one follows. The new revision is a snapshot if the chain
+        has reached snapshot_interval revisions, or if the JSON patch from
+        the parent would be no smaller than the contents, otherwise it is
+        that patch. """
+        (parent_revision_id, _, parent_contents, _, snapshot_revision_id, delta_number) = parent_row
+        if delta_number + 1 >= snapshot_interval:
+            return (contents, revision_id, 0)
+        patch = json.dumps(make_patch(json.loads(parent_contents), json.loads(contents)))
+        if len(patch) >= len(contents):
+            return (contents, revision_id, 0)
+        return (patch, snapshot_revision_id, delta_number + 1)
+
     @tornado.gen.engine
     def create_list(self, user_id, contents, callback):
         logger = logging.getLogger("DatabaseManager.create_list")
-        logger.debug("entry. user_id: %s, contents: %s" % (user_id, contents))        
+        logger.debug("entry. user_id: %s, contents: %s", user_id, contents)        
         
-        cursor = yield tornado.gen.Task(self.db.execute,
-                                        self.CREATE_LIST_WITH_USER_ID_AND_CONTENTS_RETURN_LIST_ID,
-                                        (user_id, contents))        
+        args = {"revision_id": str(uuid.uuid4()),
+                "list_id": str(uuid.uuid4()),
+                "user_id": user_id,
+                "contents": contents,
+                "title": self.get_title_from_contents(contents)}
+        cursor = yield tornado.gen.Task(self.execute,
+                                        self.CREATE_LIST_RETURN_LIST_ID,
+                                        args,
+                                        "CREATE_LIST_RETURN_LIST_ID")
         normalized_user_id = normalize_uuid_string(user_id)
-        self.expire_cache(normalized_user_id)                        
+        yield tornado.gen.Task(self.expire_cache, normalized_user_id)                        
 
         new_list_id = self.extract_one_value_from_one_or_zero_rows(cursor)
-        logger.debug("new_list_id: %s" % (new_list_id, ))  
+        logger.debug("new_list_id: %s", new_list_id)  
         assert(new_list_id is not None)
         callback(new_list_id)
 
     @tornado.gen.engine
-    def update_list(self, list_id, user_id, contents, callback):
-        logger = logging.getLogger("DatabaseManager.update_list")
-        logger.debug("entry. list_id: %s, user_id: %s, contents: %s" % (list_id, user_id, contents))        
-        cursor = yield tornado.gen.Task(self.db.execute,
-                                        self.UPDATE_LIST_WITH_LIST_ID_AND_USER_ID_AND_CONTENTS,
-                                        (list_id, user_id, contents))   
-        normalized_list_id = normalize_uuid_string(list_id)
-        self.expire_cache(normalized_list_id)                        
-        normalized_user_id = normalize_uuid_string(user_id)
-        self.expire_cache(normalized_user_id)                        
-        
-        if cursor.rowcount != 1:        
-            rc = False
+    def update_list_revision(self, list_obj, user_id, callback):
+        """ Add the contents of list_obj, a List from read_list() that
+        has since been changed, as the revision that follows
+        list_obj.revision_id. This is one statement, that only succeeds
+        if list_obj.revision_id is still the latest revision of the list.
+
+        Returns the revision_id of the new revision, or None if the list
+        has changed since list_obj was read, or no longer exists. This
+        doesn't try again, as the change was made to a revision that
+        isn't the latest any more; see
+        BaseListModifyHandler.modify_list(). """
+        logger = logging.getLogger("DatabaseManager.update_list_revision")
+        logger.debug("entry. list_obj: %s, user_id: %s", list_obj, user_id)
+        contents = list_obj.contents
+        parent_row = (list_obj.revision_id,
+                      list_obj.list_id,
+                      list_obj.revision_contents,
+                      list_obj.datetime_edited,
+                      list_obj.snapshot_revision_id,
+                      list_obj.delta_number)
+        revision_id = str(uuid.uuid4())
+        (stored_contents, snapshot_revision_id, delta_number) = self.encode_list_revision(parent_row,
+                                                                                          revision_id,
+                                                                                          contents,
+                                                                                          options.list_snapshot_interval)
+        args = {"list_id": list_obj.list_id,
+                "parent_revision_id": list_obj.revision_id,
+                "revision_id": revision_id,
+                "user_id": user_id,
+                "contents": stored_contents,
+                "snapshot_revision_id": snapshot_revision_id,
+                "delta_number": delta_number,
+                "title": self.get_title_from_contents(contents)}
+        cursor = yield tornado.gen.Task(self.execute,
+                                        self.UPDATE_LIST_WITH_PARENT_REVISION_ID,
+                                        args,
+                                        "UPDATE_LIST_WITH_PARENT_REVISION_ID")
+        new_revision_id = self.extract_one_value_from_one_or_zero_rows(cursor)
+        if new_revision_id is None:
+            logger.debug("head of the list moved on from %s", list_obj.revision_id)
         else:
-            rc = True
-        logger.debug("returning: %s" % (rc, ))
-        callback(rc)
-        
+            normalized_list_id = normalize_uuid_string(list_obj.list_id)
+            yield tornado.gen.Task(self.expire_cache, normalized_list_id)
+            normalized_user_id = normalize_uuid_string(user_id)
+            yield tornado.gen.Task(self.expire_cache, normalized_user_id)
+        logger.debug("returning: %s", new_revision_id)
+        callback(new_revision_id)
+
     @tornado.gen.engine
-    def get_lists(self, user_id, callback):
+    def get_lists(self, user_id, callback, primary=False):
         logger = logging.getLogger("DatabaseManager.get_lists")
-        logger.debug("entry. user_id: %s" % (user_id, ))        
+        logger.debug("entry. user_id: %s", user_id)        
         rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_LATEST_LISTS_WITH_USER_ID,
                                       (user_id, ),
-                                      "GET_LATEST_LISTS_WITH_USER_ID")                
+                                      "GET_LATEST_LISTS_WITH_USER_ID",
+                                      transform=self.reconstruct_list_revisions,
+                                      primary=primary)
         lists = []
         for row in rows:
             revision_id = row[0]
@@ -317,7 +1044,7 @@ class DatabaseManager(object):
     @tornado.gen.engine
     def delete_list(self, list_id, user_id, callback):
         logger = logging.getLogger("DatabaseManager.delete_list")
-        logger.debug("Entry. list_id: %s, user_id: %s" % (list_id, user_id))
+        logger.debug("Entry. list_id: %s, user_id: %s", list_id, user_id)
         
         # --------------------------------------------------------------------
         #   Validate assumptions.
@@ -327,11 +1054,13 @@ class DatabaseManager(object):
         except:
             logger.error("list_id is not a valid UUID.")
             callback(None)
+            return
         try:
             user_id_obj = uuid.UUID(user_id)
         except:
             logger.error("user_id is not a valid UUID.")
             callback(None)
+            return
         # --------------------------------------------------------------------
         
         # --------------------------------------------------------------------
@@ -343,71 +1072,244 @@ class DatabaseManager(object):
         owner_user_id_obj = yield tornado.gen.Task(self.get_owner_user_id,
                                                    list_id)        
         if (owner_user_id_obj != user_id_obj):
-            logger.debug("User making request is not the owner, who is: %s" % (owner_user_id_obj, ))
+            logger.debug("User making request is not the owner, who is: %s", owner_user_id_obj)
             callback(None)
+            return
         # --------------------------------------------------------------------        
         
         # --------------------------------------------------------------------
         #   Delete the list and return whether the deletion is successful.
         # --------------------------------------------------------------------
-        cursor = yield tornado.gen.Task(self.db.execute,
+        cursor = yield tornado.gen.Task(self.execute,
                                         self.DELETE_LIST_WITH_LIST_ID,
-                                        (list_id, ))    
+                                        (list_id, list_id),
+                                        "DELETE_LIST_WITH_LIST_ID")
         normalized_list_id = normalize_uuid_string(list_id)
-        self.expire_cache(normalized_list_id)                        
+        yield tornado.gen.Task(self.expire_cache, normalized_list_id)                        
         normalized_user_id = normalize_uuid_string(user_id)
-        self.expire_cache(normalized_user_id)                        
+        yield tornado.gen.Task(self.expire_cache, normalized_user_id)                        
         
         # cursor.rowcount will indicate how many rows were deleted. If it's 0
         # we didn't delete anything, which is unexpected. It can be any other
         # positive because there could be many revisions of a given list.
-        logger.debug("cursor.rowcount: %s" % (cursor.rowcount, ))
+        logger.debug("cursor.rowcount: %s", cursor.rowcount)
         if cursor.rowcount == 0:        
             rc = False
         else:
             rc = True            
-        logger.debug("returning: %s" % (rc, ))
+        logger.debug("returning: %s", rc)
         callback(rc)        
         # --------------------------------------------------------------------
         
     @tornado.gen.engine
-    def read_list(self, list_id, callback):
+    def read_list(self, list_id, callback, primary=False, cached=True):
+        """ Return the List of the latest revision of list_id, or None if
+        there is no such list. If cached is False it is read from the
+        primary, bypassing the caches, which may lag a write made by
+        another process for as long as its invalidation takes to
+        arrive. """
         logger = logging.getLogger("DatabaseManager.read_list")
-        logger.debug("Entry. list_id: %s" % (list_id, ))
-        rows = yield tornado.gen.Task(self.execute_cached_db_statement,
-                                      self.GET_LATEST_LIST_WITH_LIST_ID,
-                                      (list_id, ),
-                                      "GET_LATEST_LIST_WITH_LIST_ID")                
+        logger.debug("Entry. list_id: %s, cached: %s", list_id, cached)
+        if cached:
+            rows = yield tornado.gen.Task(self.execute_cached_db_statement,
+                                          self.GET_LATEST_LIST_WITH_LIST_ID,
+                                          (list_id, ),
+                                          "GET_LATEST_LIST_WITH_LIST_ID",
+                                          transform=self.reconstruct_list_revisions,
+                                          primary=primary)
+        else:
+            cursor = yield tornado.gen.Task(self.query,
+                                            self.GET_LATEST_LIST_WITH_LIST_ID,
+                                            (list_id, ),
+                                            "GET_LATEST_LIST_WITH_LIST_ID")
+            rows = self.reconstruct_list_revisions(cursor.fetchall())
         if len(rows) == 0:
             logger.debug("Could not find the list.")
             callback(None)
+            return
         assert(len(rows) == 1)
-        row = rows[0]
-        revision_id = row[0]
-        list_id = row[1]
-        contents = row[2]
-        datetime_edited = row[3]
-        list_obj = List(revision_id, list_id, contents, datetime_edited)
-        logger.debug("Returning: %s" % (list_obj, ))
+        list_obj = self.make_list(rows[0])
+        logger.debug("Returning: %s", list_obj)
         callback(list_obj)     
 
     @tornado.gen.engine
-    def get_owner_user_id(self, list_id, callback):
+    def read_lists(self, list_ids, callback, primary=False):
+        """ Batched read_list() for pages that show several lists.
+        Returns a list with the List object for every list_id in
+        'list_ids', in the same order, and None for the lists that
+        don't exist.
+
+        This shares its cache keys with read_list(). Lists that aren't
+        in the local cache are looked up in redis with one MGET, the
+        ones that aren't there either are read with one query, and they
+        are stored in redis with one pipeline. Stale lists are served and
+        refreshed in the background, and the query runs on the replica
+        or the primary, as in execute_cached_db_statement(). """
+        logger = logging.getLogger("DatabaseManager.read_lists")
+        logger.debug("Entry. list_ids: %s", list_ids)
+        statement_name = "GET_LATEST_LIST_WITH_LIST_ID"
+        policy = self.CACHE_POLICIES.get(statement_name, self.DEFAULT_CACHE_POLICY)
+        # The lists are counted one by one, under the batch statement.
+        start = time.time()
+        statement_metrics = metrics.registry.get_statement("GET_LATEST_LISTS_WITH_LIST_IDS")
+        statement_metrics.calls += 1
+
+        # --------------------------------------------------------------------
+        #   Look in the local cache.
+        # --------------------------------------------------------------------
+        keys = []
+        # key -> (list_id, normalized list_id, tags) for every distinct key.
+        lookups = {}
+        # key -> rows.
+        values = {}
+        for list_id in list_ids:
+            (key, args_with_normalized_uuids) = self.get_cache_key((list_id, ), statement_name)
+            keys.append(key)
+            if key in lookups:
+                continue
+            lookups[key] = (list_id,
+                            args_with_normalized_uuids[0],
+                            policy.get_tags(args_with_normalized_uuids))
+            value = self.local_cache.get(key)
+            if value is not None:
+                values[key] = value
+        missing_keys = [key for key in lookups if key not in values]
+        logger.debug("local cache hits: %s, misses: %s", len(lookups) - len(missing_keys), len(missing_keys))
+        statement_metrics.local_hits += len(lookups) - len(missing_keys)
+        # --------------------------------------------------------------------
+
+        # --------------------------------------------------------------------
+        #   Look in redis.
+        # --------------------------------------------------------------------
+        db = self.db
+        if missing_keys and (self.replica_db is None or primary):
+            values_encoded = yield tornado.gen.Task(self.r.mget, missing_keys)
+        elif missing_keys:
+            tags = set()
+            for key in missing_keys:
+                tags.update(lookups[key][2])
+            replies = yield tornado.gen.Task(self.r.pipeline,
+                                             [("MGET", ) + tuple(missing_keys)] + self.get_write_marker_commands(tags))
+            values_encoded = replies[0]
+            db = self.choose_read_db(sum(replies[1:]))
+        if missing_keys:
+            for (key, value_encoded) in zip(missing_keys, values_encoded):
+                if not value_encoded:
+                    continue
+                (fresh_until, value) = self.codec.decode(value_encoded)
+                values[key] = value
+                statement_metrics.redis_hits += 1
+                statement_metrics.bytes += len(value_encoded)
+                (list_id, normalized_list_id, tags) = lookups[key]
+                fresh_for = fresh_until - time.time()
+                if fresh_for > 0:
+                    self.local_cache.set(key, value, len(value_encoded), tags, fresh_for)
+                else:
+                    logger.debug("stale by %.1f seconds: %s", -fresh_for, key)
+                    self.stale_hits += 1
+                    with tornado.stack_context.NullContext():
+                        self.revalidate(key,
+                                        self.GET_LATEST_LIST_WITH_LIST_ID,
+                                        statement_name,
+                                        (list_id, ),
+                                        tags,
+                                        self.reconstruct_list_revisions,
+                                        policy)
+            missing_keys = [key for key in missing_keys if key not in values]
+            logger.debug("redis misses: %s", len(missing_keys))
+        # --------------------------------------------------------------------
+
+        # --------------------------------------------------------------------
+        #   Read the rest from the database and store them in redis. A
+        #   list that doesn't exist is cached as no rows, like
+        #   read_list() does.
+        # --------------------------------------------------------------------
+        if missing_keys:
+            statement_metrics.misses += len(missing_keys)
+            cursor = yield tornado.gen.Task(self.query,
+                                            self.GET_LATEST_LISTS_WITH_LIST_IDS,
+                                            ([str(lookups[key][0]) for key in missing_keys], ),
+                                            "GET_LATEST_LISTS_WITH_LIST_IDS",
+                                            db=db)
+            rows = self.reconstruct_list_revisions(cursor.fetchall())
+            rows_by_list_id = dict((normalize_uuid_string(row[1]), row) for row in rows)
+            fresh_until = time.time() + policy.ttl
+            commands = []
+            for key in missing_keys:
+                (list_id, normalized_list_id, tags) = lookups[key]
+                row = rows_by_list_id.get(normalized_list_id)
+                if row is None:
+                    value = []
+                else:
+                    value = [row]
+                values[key] = value
+                number_of_bytes = self.add_store_commands(commands, key, value, tags, policy, fresh_until)
+                statement_metrics.bytes += number_of_bytes
+                self.local_cache.set(key, value, number_of_bytes, tags, policy.ttl)
+            yield tornado.gen.Task(self.r.pipeline, commands)
+        # --------------------------------------------------------------------
+
+        lists = []
+        for key in keys:
+            rows = values[key]
+            if len(rows) == 0:
+                lists.append(None)
+            else:
+                assert(len(rows) == 1)
+                lists.append(self.make_list(rows[0]))
+        logger.debug("Returning: %s", lists)
+        statement_metrics.latency.observe(time.time() - start)
+        callback(lists)
+
+    @staticmethod
+    def make_list(row):
+        """ Return the List object for a reconstructed row, see
+        reconstruct_list_revisions(). """
+        (revision_id, list_id, contents, datetime_edited, snapshot_revision_id, delta_number) = row
+        return List(revision_id, list_id, contents, datetime_edited, snapshot_revision_id, delta_number)
+
+    @tornado.gen.engine
+    def get_owner_user_id(self, list_id, callback, primary=False):
         logger = logging.getLogger("DatabaseManager.get_owner_user_id")
-        logger.debug("Entry. list_id: %s" % (list_id, ))
+        logger.debug("Entry. list_id: %s", list_id)
         rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_OWNER_USER_ID_WITH_LIST_ID,
                                       (list_id, ),
-                                      "GET_OWNER_USER_ID_WITH_LIST_ID")        
+                                      "GET_OWNER_USER_ID_WITH_LIST_ID",
+                                      primary=primary)
         if len(rows) == 0:
             logger.debug("Could not identify the owner.")
             callback(None)
+            return
         assert(len(rows) == 1)
         row = rows[0]
         assert(len(row) == 1)
         user_id_obj = uuid.UUID(row[0])
-        logger.debug("Returning: %s" % (user_id_obj, ))
+        logger.debug("Returning: %s", user_id_obj)
         callback(user_id_obj)
+
+    @tornado.gen.engine
+    def get_owners(self, list_ids, callback):
+        """ Batched get_owner_user_id() for pages that show many lists.
+        Returns a dict mapping the UUID object of every list_id in
+        'list_ids' that exists to the UUID object of its owner. Lists
+        that don't exist are left out.
+
+        This is one indexed lookup for all the lists. It isn't cached,
+        because the cache key would be different for every combination
+        of lists. """
+        logger = logging.getLogger("DatabaseManager.get_owners")
+        logger.debug("Entry. list_ids: %s", list_ids)
+        if not list_ids:
+            callback({})
+            return
+        cursor = yield tornado.gen.Task(self.execute,
+                                        self.GET_OWNER_USER_IDS_WITH_LIST_IDS,
+                                        ([str(list_id) for list_id in list_ids], ),
+                                        "GET_OWNER_USER_IDS_WITH_LIST_IDS")
+        owners = dict((uuid.UUID(list_id), uuid.UUID(user_id)) for (list_id, user_id) in cursor.fetchall())
+        logger.debug("Returning: %s", owners)
+        callback(owners)
     # ------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------
@@ -416,37 +1318,38 @@ class DatabaseManager(object):
     @tornado.gen.engine
     def get_role_id(self, type, callback):
         logger = logging.getLogger("DatabaseManager.get_role_id")
-        logger.debug("entry. type: %s" % (type, ))
+        logger.debug("entry. type: %s", type)
         rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_ROLE_ID,
                                       (type, ),
                                       "GET_ROLE_ID")        
         yield_value = self.extract_one_value_from_one_or_zero_rows(rows)
-        logger.debug("yielding: %s" % (yield_value, ))        
+        logger.debug("yielding: %s", yield_value)        
         assert(yield_value is not None)
         callback(yield_value)                
 
     @tornado.gen.engine
     def create_user(self, type, callback):
         logger = logging.getLogger("DatabaseManager.create_user")
-        logger.debug("entry. type: %s" % (type, ))
+        logger.debug("entry. type: %s", type)
         
         role_id = yield tornado.gen.Task(self.get_role_id, type)
-        logger.debug("role_id: %s" % (role_id, ))
+        logger.debug("role_id: %s", role_id)
         assert(role_id is not None)
         
-        cursor = yield tornado.gen.Task(self.db.execute,
+        cursor = yield tornado.gen.Task(self.execute,
                                         self.CREATE_USER_AND_RETURN_USER_ID,
-                                        (role_id, ))
+                                        (role_id, ),
+                                        "CREATE_USER_AND_RETURN_USER_ID")
         new_user_id = self.extract_one_value_from_one_or_zero_rows(cursor)
-        logger.debug("new_user_id: %s" % (new_user_id, ))  
+        logger.debug("new_user_id: %s", new_user_id)  
         assert(new_user_id is not None)
         
         api_secret_key = base64.b64encode(uuid.uuid4().bytes + uuid.uuid4().bytes)
         rc = yield tornado.gen.Task(self.create_auth_api,
                                     api_secret_key,
                                     new_user_id)
-        logger.debug("rc from API authentication query: %s" % (rc, ))
+        logger.debug("rc from API authentication query: %s", rc)
         assert(rc == True)
         
         callback(new_user_id)
@@ -463,27 +1366,29 @@ class DatabaseManager(object):
     @tornado.gen.engine
     def create_auth_api(self, api_secret_key, user_id, callback):
         logger = logging.getLogger("DatabaseManager.create_auth_api")
-        logger.debug("entry. api_secret_key: %s, user_id: %s" % (api_secret_key, user_id))
-        cursor = yield tornado.gen.Task(self.db.execute,
+        logger.debug("entry. api_secret_key: %s, user_id: %s", api_secret_key, user_id)
+        cursor = yield tornado.gen.Task(self.execute,
                                         self.CREATE_AUTH_API,
-                                        (api_secret_key, user_id))
-        self.expire_cache(api_secret_key)
+                                        (api_secret_key, user_id),
+                                        "CREATE_AUTH_API")
+        yield tornado.gen.Task(self.expire_cache, api_secret_key)
         if cursor.rowcount == 0:
             return_value = False
         else:
             return_value = True
-        logger.debug("returning: %s" % (return_value, ))
+        logger.debug("returning: %s", return_value)
         callback(return_value)        
         
     @tornado.gen.engine
     def get_user_id_from_api_secret_key(self, api_secret_key, callback):
         logger = logging.getLogger("DatabaseManager.get_user_id_from_api_secret_key")
-        logger.debug("entry. api_secret_key: %s" % (api_secret_key, ))
-        rows = yield tornado.gen.Task(self.db.execute,
+        logger.debug("entry. api_secret_key: %s", api_secret_key)
+        rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_USER_ID_FROM_API_SECRET_KEY,
-                                      (api_secret_key, ))
+                                      (api_secret_key, ),
+                                      "GET_USER_ID_FROM_API_SECRET_KEY")
         yield_value = self.extract_one_value_from_one_or_zero_rows(rows)
-        logger.debug("yielding: %s" % (yield_value, ))        
+        logger.debug("yielding: %s", yield_value)        
         callback(yield_value)
         
     # ------------------------------------------------------------------------
@@ -492,28 +1397,29 @@ class DatabaseManager(object):
     @tornado.gen.engine
     def create_auth_google(self, email, user_id, first_name, last_name, name, locale, callback):
         logger = logging.getLogger("DatabaseManager.create_auth_google")
-        logger.debug("entry. email: %s, user_id: %s, first_name: %s, last_name: %s, name: %s, locale: %s" % (email, user_id, first_name, last_name, name, locale))        
-        cursor = yield tornado.gen.Task(self.db.execute,
+        logger.debug("entry. email: %s, user_id: %s, first_name: %s, last_name: %s, name: %s, locale: %s", email, user_id, first_name, last_name, name, locale)        
+        cursor = yield tornado.gen.Task(self.execute,
                                         self.CREATE_AUTH_GOOGLE,
-                                        (email, user_id, first_name, last_name, name, locale))        
-        self.expire_cache(email)                        
+                                        (email, user_id, first_name, last_name, name, locale),
+                                        "CREATE_AUTH_GOOGLE")
+        yield tornado.gen.Task(self.expire_cache, email)                        
         if cursor.rowcount == 0:
             return_value = False
         else:
             return_value = True
-        logger.debug("returning: %s" % (return_value, ))
+        logger.debug("returning: %s", return_value)
         callback(return_value)        
         
     @tornado.gen.engine
     def get_user_id_from_google_email(self, email, callback):
         logger = logging.getLogger("DatabaseManager.get_user_id_from_google_email")
-        logger.debug("entry. email: %s" % (email, ))
+        logger.debug("entry. email: %s", email)
         rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_USER_ID_FROM_GOOGLE_EMAIL,
                                       (email, ),
                                       "GET_USER_ID_FROM_GOOGLE_EMAIL")
         yield_value = self.extract_one_value_from_one_or_zero_rows(rows)
-        logger.debug("yielding: %s" % (yield_value, ))        
+        logger.debug("yielding: %s", yield_value)        
         callback(yield_value)
     # ------------------------------------------------------------------------
     
@@ -523,29 +1429,30 @@ class DatabaseManager(object):
     @tornado.gen.engine
     def create_auth_facebook(self, id, user_id, link, access_token, locale, first_name, last_name, name, picture, callback):
         logger = logging.getLogger("DatabaseManager.create_auth_facebook")
-        logger.debug("entry. id: %s, user_id: %s, link: %s, access_token: %s, locale: %s, first_name: %s, last_name: %s, name: %s, picture: %s" % \
-                     (id, user_id, link, access_token, locale, first_name, last_name, name, picture))
-        cursor = yield tornado.gen.Task(self.db.execute,
+        logger.debug("entry. id: %s, user_id: %s, link: %s, access_token: %s, locale: %s, first_name: %s, last_name: %s, name: %s, picture: %s",
+                     id, user_id, link, access_token, locale, first_name, last_name, name, picture)
+        cursor = yield tornado.gen.Task(self.execute,
                                         self.CREATE_AUTH_FACEBOOK,
-                                        (id, user_id, link, access_token, locale, first_name, last_name, name, picture))
-        self.expire_cache(id)
+                                        (id, user_id, link, access_token, locale, first_name, last_name, name, picture),
+                                        "CREATE_AUTH_FACEBOOK")
+        yield tornado.gen.Task(self.expire_cache, id)
         if cursor.rowcount == 0:
             return_value = False
         else:
             return_value = True
-        logger.debug("returning: %s" % (return_value, ))
+        logger.debug("returning: %s", return_value)
         callback(return_value)        
         
     @tornado.gen.engine
     def get_user_id_from_facebook_id(self, id, callback):
         logger = logging.getLogger("DatabaseManager.get_user_id_from_facebook_id")
-        logger.debug("entry. id: %s" % (id, ))
+        logger.debug("entry. id: %s", id)
         rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_USER_ID_FROM_FACEBOOK_ID,
                                       (id, ),
                                       "GET_USER_ID_FROM_FACEBOOK_ID")
         yield_value = self.extract_one_value_from_one_or_zero_rows(rows)
-        logger.debug("yielding: %s" % (yield_value, ))        
+        logger.debug("yielding: %s", yield_value)        
         callback(yield_value)
     # ------------------------------------------------------------------------
     
@@ -555,28 +1462,29 @@ class DatabaseManager(object):
     @tornado.gen.engine
     def create_auth_twitter(self, username, user_id, profile_image_url, callback):
         logger = logging.getLogger("DatabaseManager.create_auth_twitter")
-        logger.debug("entry. username: %s, user_id: %s, profile_image_url: %s" % (username, user_id, profile_image_url))        
-        cursor = yield tornado.gen.Task(self.db.execute,
+        logger.debug("entry. username: %s, user_id: %s, profile_image_url: %s", username, user_id, profile_image_url)        
+        cursor = yield tornado.gen.Task(self.execute,
                                         self.CREATE_AUTH_TWITTER,
-                                        (username, user_id, profile_image_url))
-        self.expire_cache(username)
+                                        (username, user_id, profile_image_url),
+                                        "CREATE_AUTH_TWITTER")
+        yield tornado.gen.Task(self.expire_cache, username)
         if cursor.rowcount == 0:
             return_value = False
         else:
             return_value = True
-        logger.debug("returning: %s" % (return_value, ))
+        logger.debug("returning: %s", return_value)
         callback(return_value)        
         
     @tornado.gen.engine
     def get_user_id_from_twitter_username(self, username, callback):
         logger = logging.getLogger("DatabaseManager.get_user_id_from_twitter_username")
-        logger.debug("entry. username: %s" % (username, ))
+        logger.debug("entry. username: %s", username)
         rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_USER_ID_FROM_TWITTER_USERNAME,
                                       (username, ),
                                       "GET_USER_ID_FROM_TWITTER_USERNAME")
         yield_value = self.extract_one_value_from_one_or_zero_rows(rows)
-        logger.debug("yielding: %s" % (yield_value, ))        
+        logger.debug("yielding: %s", yield_value)        
         callback(yield_value)
     # ------------------------------------------------------------------------
 
@@ -586,28 +1494,29 @@ class DatabaseManager(object):
     @tornado.gen.engine
     def create_auth_browserid(self, email, user_id, callback):
         logger = logging.getLogger("DatabaseManager.create_auth_browserid")
-        logger.debug("entry. email: %s, user_id: %s" % (email, user_id))
+        logger.debug("entry. email: %s, user_id: %s", email, user_id)
         
-        cursor = yield tornado.gen.Task(self.db.execute,
+        cursor = yield tornado.gen.Task(self.execute,
                                         self.CREATE_AUTH_BROWSERID,
-                                        (email, user_id))
-        self.expire_cache(email)
+                                        (email, user_id),
+                                        "CREATE_AUTH_BROWSERID")
+        yield tornado.gen.Task(self.expire_cache, email)
         if cursor.rowcount == 0:
             return_value = False
         else:
             return_value = True
-        logger.debug("returning: %s" % (return_value, ))
+        logger.debug("returning: %s", return_value)
         callback(return_value)        
         
     @tornado.gen.engine
     def get_user_id_from_browserid_email(self, email, callback):
         logger = logging.getLogger("DatabaseManager.get_user_id_from_browserid_email")
-        logger.debug("entry. email: %s" % (email, ))
+        logger.debug("entry. email: %s", email)
         rows = yield tornado.gen.Task(self.execute_cached_db_statement,
                                       self.GET_USER_ID_FROM_BROWSERID_EMAIL,
                                       (email, ),
                                       "GET_USER_ID_FROM_BROWSERID_EMAIL")
         yield_value = self.extract_one_value_from_one_or_zero_rows(rows)
-        logger.debug("yielding: %s" % (yield_value, ))        
+        logger.debug("yielding: %s", yield_value)        
         callback(yield_value)
     # ------------------------------------------------------------------------
\ No newline at end of file
@@ -0,0 +1,105 @@
+# ----------------------------------------------------------------------------
+#   A small subset of JSON Patch (RFC 6902), enough to store a list
+#   revision as the difference from the revision before it.
+#
+#   A patch is a list of operations, e.g.
+#
+#       [{"op": "replace", "path": "/title", "value": "Groceries"},
+#        {"op": "add", "path": "/list_items/3", "value": "..."}]
+#
+#   Only "add", "remove" and "replace" are produced or understood. Paths
+#   are JSON pointers (RFC 6901).
+# ----------------------------------------------------------------------------
+
+def escape_pointer_token(token):
+    return unicode(token).replace(u"~", u"~0").replace(u"/", u"~1")
+
+def unescape_pointer_token(token):
+    return token.replace(u"~1", u"/").replace(u"~0", u"~")
+
+def make_patch(old, new, path=u""):
+    """ Return a patch that turns the decoded JSON document 'old' into
+    'new'. Objects are compared key by key. Arrays are compared index by
+    index after trimming the elements they start and end with in common,
+    so changing, adding or removing one element of a long array produces
+    one operation. """
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = []
+        for key in old:
+            if key not in new:
+                patch.append({"op": "remove", "path": path + u"/" + escape_pointer_token(key)})
+        for (key, value) in new.iteritems():
+            key_path = path + u"/" + escape_pointer_token(key)
+            if key not in old:
+                patch.append({"op": "add", "path": key_path, "value": value})
+            else:
+                patch.extend(make_patch(old[key], value, key_path))
+        return patch
+    if isinstance(old, list) and isinstance(new, list):
+        shortest_length = min(len(old), len(new))
+        start = 0
+        while start < shortest_length and old[start] == new[start]:
+            start += 1
+        # Number of elements both end with, not counting those in the
+        # common start.
+        end = 0
+        while end < shortest_length - start and old[-1 - end] == new[-1 - end]:
+            end += 1
+        old_end = len(old) - end
+        new_end = len(new) - end
+        patch = []
+        common_length = min(old_end, new_end) - start
+        for i in xrange(start, start + common_length):
+            patch.extend(make_patch(old[i], new[i], u"%s/%d" % (path, i)))
+        for i in xrange(start + common_length, new_end):
+            patch.append({"op": "add", "path": u"%s/%d" % (path, i), "value": new[i]})
+        # Remove from the end, so that earlier indexes stay valid.
+        for i in reversed(xrange(start + common_length, old_end)):
+            patch.append({"op": "remove", "path": u"%s/%d" % (path, i)})
+        return patch
+    return [{"op": "replace", "path": path, "value": new}]
+
+def apply_patch(document, patch):
+    """ Apply 'patch' to the decoded JSON document 'document' and return
+    the result. The document is modified in place, so pass in a copy if
+    you need to keep the original. """
+    for operation in patch:
+        op = operation["op"]
+        path = operation["path"]
+        if path == u"":
+            if op == "remove":
+                document = None
+            else:
+                document = operation["value"]
+            continue
+        tokens = [unescape_pointer_token(token) for token in path.split(u"/")[1:]]
+        parent = document
+        for token in tokens[:-1]:
+            if isinstance(parent, list):
+                parent = parent[int(token)]
+            else:
+                parent = parent[token]
+        token = tokens[-1]
+        if isinstance(parent, list):
+            if token == u"-":
+                index = len(parent)
+            else:
+                index = int(token)
+            if op == "add":
+                parent.insert(index, operation["value"])
+            elif op == "remove":
+                del parent[index]
+            elif op == "replace":
+                parent[index] = operation["value"]
+            else:
+                raise ValueError("Unsupported JSON patch operation: %s" % (op, ))
+        else:
+            if op in ("add", "replace"):
+                parent[token] = operation["value"]
+            elif op == "remove":
+                del parent[token]
+            else:
+                raise ValueError("Unsupported JSON patch operation: %s" % (op, ))
+    return document
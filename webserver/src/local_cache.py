@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------------
+#   In-process (L1) cache that sits in front of the redis database results
+#   cache.
+#
+#   Every forked worker has its own LocalCache. It is a bounded LRU: it
+#   holds at most max_entries values and at most max_bytes of their
+#   serialized size, and every value expires after ttl seconds.
+#
+#   Workers keep each other coherent through a redis pub/sub channel. When
+#   DatabaseManager.expire_cache() is called for a tag it publishes the tag
+#   on the channel, and every worker's CacheInvalidationSubscriber drops
+#   the entries for that tag of its LocalCaches, i.e. the cache of
+#   database results and any other cache of values made from them that
+#   was added with DatabaseManager.add_local_cache(). The subscriber blocks on the redis
+#   connection, so it runs in a background thread and hands each message
+#   to the IOLoop; the LocalCache itself is only ever touched from the
+#   IOLoop thread.
+# ----------------------------------------------------------------------------
+
+import time
+import logging
+import threading
+import collections
+
+import tornado.ioloop
+import redis
+
+class LocalCache(object):
+    def __init__(self, max_entries, max_bytes, ttl):
+        """ max_entries is the maximum number of values to hold, max_bytes
+        the maximum total size of the values as given to set(), and ttl the
+        number of seconds a value remains valid for. If max_entries is 0
+        then the cache is disabled and never holds anything. """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (value, size, expiry_time, tags). Ordered from least to
+        # most recently used.
+        self.entries = collections.OrderedDict()
+        # tag -> set of keys.
+        self.tags = {}
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        """ Return the value stored under key, or None if there is no
+        valid value. """
+        entry = self.entries.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        (value, size, expiry_time, tags) = entry
+        if expiry_time <= time.time():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        # Move the key to the most recently used end.
+        del self.entries[key]
+        self.entries[key] = entry
+        self.hits += 1
+        return value
+
+    def set(self, key, value, size, tags, ttl=None):
+        """ Store value under key. size is the size in bytes that the
+        value counts against max_bytes, typically the length of its
+        serialized form. tags are the invalidation tags of the value.
+        If ttl is given the value expires after that many seconds, if
+        that is sooner than the cache's own ttl. """
+        if not self.enabled or size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        if ttl is None:
+            ttl = self.ttl
+        else:
+            ttl = min(ttl, self.ttl)
+        tags = frozenset(tags)
+        self.entries[key] = (value, size, time.time() + ttl, tags)
+        self.total_bytes += size
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_entries or \
+              self.total_bytes > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate(self, tag):
+        """ Drop every value that was stored with tag. """
+        keys = self.tags.pop(tag, ())
+        for key in list(keys):
+            self._remove(key)
+        self.invalidations += len(keys)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.tags.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key):
+        (value, size, expiry_time, tags) = self.entries.pop(key)
+        self.total_bytes -= size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def get_statistics(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            hit_rate = 0.0
+        else:
+            hit_rate = float(self.hits) / lookups
+        return {"entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": hit_rate,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations}
+
+class CacheInvalidationSubscriber(object):
+    # Seconds to wait before reconnecting after losing the redis connection.
+    RECONNECT_DELAY = 1
+
+    def __init__(self, local_caches, channel, host, port, db):
+        """ local_caches is the list of LocalCaches to invalidate. It may
+        be added to later, from the IOLoop thread. """
+        self.local_caches = local_caches
+        self.channel = channel
+        self.host = host
+        self.port = port
+        self.db = db
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.thread = threading.Thread(target=self._run,
+                                       name="CacheInvalidationSubscriber")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        logger = logging.getLogger("CacheInvalidationSubscriber._run")
+        while True:
+            try:
+                r = redis.StrictRedis(host=self.host,
+                                      port=self.port,
+                                      db=self.db)
+                pubsub = r.pubsub()
+                pubsub.subscribe(self.channel)
+                # Any invalidation published while we were not subscribed
+                # has been missed, so start again from an empty cache.
+                self.io_loop.add_callback(self._clear)
+                for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    tag = message["data"]
+                    self.io_loop.add_callback(lambda tag=tag: self._invalidate(tag))
+            except Exception:
+                logger.exception("Lost the invalidation subscription, reconnecting.")
+                time.sleep(self.RECONNECT_DELAY)
+
+    def _clear(self):
+        for local_cache in self.local_caches:
+            local_cache.clear()
+
+    def _invalidate(self, tag):
+        for local_cache in self.local_caches:
+            local_cache.invalidate(tag)
@@ -0,0 +1,243 @@
+# ----------------------------------------------------------------------------
+#   Metrics of database statements, connection pools and caches.
+#
+#   Every process keeps its metrics in 'registry':
+#
+#   - per statement name, see DatabaseManager: calls, how they were
+#     answered (local cache, redis, another caller's query, a query of
+#     their own), rows and bytes returned, and latency histograms of the
+#     calls and of the queries. Statements that aren't cached only have
+#     queries.
+#   - the number of connections in use and idle of every registered
+#     momoko pool, next to its min_conn and max_conn.
+#   - the dicts returned by every registered statistics function, e.g.
+#     DatabaseManager.get_cache_statistics().
+#
+#   The server forks into several processes, so every process publishes a
+#   snapshot of its metrics to redis every metrics_publish_interval
+#   seconds, see start(). A snapshot expires after a few intervals, so
+#   the snapshots of processes that died drop out. MetricsHandler serves
+#   the sum of the live snapshots at /metrics.
+#
+#   Everything here is only ever touched from the IOLoop thread.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+import time
+import socket
+import logging
+import bisect
+
+import tornado.gen
+import tornado.ioloop
+from tornado.options import define, options
+
+from async_redis import create_redis_client
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("metrics_publish_interval", default=10, type=int, help="Seconds between publishing each process's metrics to redis. 0 disables publishing.")
+define("metrics_allowed_ips", default="127.0.0.1", help="Comma-separated IP addresses that may read /metrics.")
+# ----------------------------------------------------------------------------
+
+METRICS_KEY_PREFIX = "metrics:"
+# Set of the IDs of processes that have published metrics.
+PROCESSES_KEY = METRICS_KEY_PREFIX + "processes"
+# A snapshot expires after this many publish intervals.
+SNAPSHOT_EXPIRY_INTERVALS = 3
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. A last
+# bucket holds everything slower.
+LATENCY_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+LATENCY_BUCKET_LABELS = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+PERCENTILES = [50, 95, 99]
+
+class LatencyHistogram(object):
+    __slots__ = ["counts", "count", "total"]
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        milliseconds = seconds * 1000
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+
+    def to_dict(self):
+        return {"buckets": dict(zip(LATENCY_BUCKET_LABELS, self.counts)),
+                "count": self.count,
+                "sum_ms": self.total}
+
+class StatementMetrics(object):
+    __slots__ = ["calls", "local_hits", "redis_hits", "coalesced", "misses",
+                 "queries", "rows", "bytes", "latency", "query_latency"]
+
+    def __init__(self):
+        self.calls = 0
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+        # Of calls, from start to result.
+        self.latency = LatencyHistogram()
+        # Of database round trips, including those of background refreshes.
+        self.query_latency = LatencyHistogram()
+
+    def to_dict(self):
+        return {"calls": self.calls,
+                "local_hits": self.local_hits,
+                "redis_hits": self.redis_hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "queries": self.queries,
+                "rows": self.rows,
+                "bytes": self.bytes,
+                "latency": self.latency.to_dict(),
+                "query_latency": self.query_latency.to_dict()}
+
+def get_pool_statistics(client):
+    """ Return the connection counts of the pool of a momoko AsyncClient.
+    momoko doesn't expose these, so this looks at its pool directly. """
+    pool = client._pool
+    connections = pool._pool
+    in_use = len([connection for connection in connections if connection.isexecuting()])
+    return {"connections": len(connections),
+            "in_use": in_use,
+            "idle": len(connections) - in_use,
+            "min_conn": pool.min_conn,
+            "max_conn": pool.max_conn}
+
+class MetricsRegistry(object):
+    def __init__(self):
+        # statement_name -> StatementMetrics.
+        self.statements = {}
+        # name -> momoko client.
+        self.pools = {}
+        # name -> function that returns a dict of statistics.
+        self.sources = {}
+
+    def get_statement(self, statement_name):
+        statement = self.statements.get(statement_name)
+        if statement is None:
+            statement = self.statements[statement_name] = StatementMetrics()
+        return statement
+
+    def record_query(self, statement_name, seconds, rows):
+        statement = self.get_statement(statement_name)
+        statement.queries += 1
+        statement.query_latency.observe(seconds)
+        if rows > 0:
+            statement.rows += rows
+
+    def register_pool(self, name, client):
+        self.pools[name] = client
+
+    def register_source(self, name, get_statistics):
+        self.sources[name] = get_statistics
+
+    def get_snapshot(self):
+        """ Return the metrics of this process as a dict that can be
+        JSON encoded, and summed with the snapshots of other processes
+        by merge_snapshots(). """
+        return {"processes": 1,
+                "statements": dict((name, statement.to_dict()) for (name, statement) in self.statements.iteritems()),
+                "pools": dict((name, get_pool_statistics(client)) for (name, client) in self.pools.iteritems()),
+                "statistics": dict((name, get_statistics()) for (name, get_statistics) in self.sources.iteritems())}
+
+registry = MetricsRegistry()
+
+def merge_snapshots(snapshots):
+    """ Return the sum of the snapshots, number by number. """
+    def merge(total, snapshot):
+        for (key, value) in snapshot.iteritems():
+            if isinstance(value, dict):
+                merge(total.setdefault(key, {}), value)
+            elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+        return total
+    total = {}
+    for snapshot in snapshots:
+        merge(total, snapshot)
+    for statement in total.get("statements", {}).itervalues():
+        for histogram in (statement["latency"], statement["query_latency"]):
+            add_percentiles(histogram)
+    return total
+
+def add_percentiles(histogram):
+    """ Add the upper bounds of the buckets that the PERCENTILES fall in
+    to a histogram dict, as p50_ms etc. They are None if the percentile
+    is slower than the last bound. """
+    counts = [histogram["buckets"].get(label, 0) for label in LATENCY_BUCKET_LABELS]
+    for percentile in PERCENTILES:
+        value = None
+        if histogram["count"] > 0:
+            rank = histogram["count"] * percentile / 100.0
+            cumulative = 0
+            for (bound, count) in zip(LATENCY_BUCKETS + [None], counts):
+                cumulative += count
+                if cumulative >= rank:
+                    value = bound
+                    break
+        histogram["p%s_ms" % (percentile, )] = value
+
+# ----------------------------------------------------------------------------
+#   Publishing and aggregating across processes.
+# ----------------------------------------------------------------------------
+class MetricsPublisher(object):
+    def __init__(self, r, interval):
+        """ r is one of the callback-style clients from async_redis.py. """
+        self.r = r
+        self.interval = interval
+        self.process_id = "%s:%s" % (socket.gethostname(), os.getpid())
+
+    def get_snapshot_key(self, process_id):
+        return "%sprocess:%s" % (METRICS_KEY_PREFIX, process_id)
+
+    def publish(self, callback=None):
+        """ Store this process's snapshot in redis. """
+        expiry_time = max(1, self.interval * SNAPSHOT_EXPIRY_INTERVALS)
+        commands = [("SETEX", self.get_snapshot_key(self.process_id), expiry_time, json.dumps(registry.get_snapshot())),
+                    ("SADD", PROCESSES_KEY, self.process_id)]
+        self.r.pipeline(commands, callback=callback)
+
+    @tornado.gen.engine
+    def aggregate(self, callback):
+        """ Publish this process's snapshot, so that it is current, and
+        return the sum of the snapshots of every live process. """
+        logger = logging.getLogger("MetricsPublisher.aggregate")
+        yield tornado.gen.Task(self.publish)
+        process_ids = yield tornado.gen.Task(self.r.execute_command, "SMEMBERS", PROCESSES_KEY)
+        process_ids = list(process_ids)
+        snapshots = yield tornado.gen.Task(self.r.mget,
+                                           [self.get_snapshot_key(process_id) for process_id in process_ids])
+        expired_process_ids = [process_id for (process_id, snapshot) in zip(process_ids, snapshots) if snapshot is None]
+        if expired_process_ids:
+            logger.debug("processes without a snapshot: %s", expired_process_ids)
+            yield tornado.gen.Task(self.r.execute_command, "SREM", PROCESSES_KEY, *expired_process_ids)
+        callback(merge_snapshots(json.loads(snapshot) for snapshot in snapshots if snapshot is not None))
+
+publisher = None
+
+def start():
+    """ Publish this process's metrics every metrics_publish_interval
+    seconds. Call after the server has forked, in every process. """
+    global publisher
+    logger = logging.getLogger("metrics.start")
+    publisher = MetricsPublisher(create_redis_client(options.redis_database_id_for_database_results),
+                                 options.metrics_publish_interval)
+    if options.metrics_publish_interval <= 0:
+        logger.debug("publishing metrics is disabled.")
+        return None
+    periodic_callback = tornado.ioloop.PeriodicCallback(publisher.publish,
+                                                        options.metrics_publish_interval * 1000)
+    periodic_callback.start()
+    return periodic_callback
+# ----------------------------------------------------------------------------
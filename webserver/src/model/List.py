@@ -18,8 +18,7 @@ class List(object):
     REQUIRED_KEYS = ["revision_id", "list_id", "contents", "datetime_edited"]   
     ALL_KEYS = ["revision_id", "list_id", "contents", "datetime_edited", "list_items"]    
     
-    def __init__(self, revision_id, list_id, contents, datetime_edited):
-        logger = logging.getLogger("List")
+    def __init__(self, revision_id, list_id, contents, datetime_edited, snapshot_revision_id=None, delta_number=None):
         assert validate_uuid_string(revision_id)
         assert validate_uuid_string(list_id)
     
@@ -27,28 +26,64 @@ class List(object):
         self.list_id = list_id
         self.url_safe_list_id = convert_uuid_string_to_base64(self.list_id)
         self.url_safe_revision_id = convert_uuid_string_to_base64(self.revision_id)
-        self.contents = contents
         self.datetime_edited = datetime_edited
-        
-        self.list_items = []
-        try:
-            contents_decoded = tornado.escape.json_decode(self.contents)
-        except:
-            logger.exception("JSON decoding exception.")
-        else:            
-            if "list_items" in contents_decoded:                                
-                for list_item_encoded in contents_decoded['list_items']:                    
-                    list_item = ListItem.from_json(list_item_encoded)                    
-                    if list_item:                        
-                        self.list_items.append(list_item)
+
+        # Where revision_id sits in its chain of revisions, and its
+        # contents, which stay as they are when the list is changed. A
+        # change is stored as a delta from these, see
+        # DatabaseManager.update_list_revision().
+        self.snapshot_revision_id = snapshot_revision_id
+        self.delta_number = delta_number
+        self.revision_contents = contents
+
+        # The contents are kept as the JSON string we were given, and
+        # only decoded the first time something inside them is needed,
+        # e.g. the title. The list items are only built the first time
+        # they are needed. Changes are made to the decoded form, and
+        # the JSON string is only encoded again when contents is next
+        # read, i.e. when the list is written back to the database.
+        self._contents = contents
+        self._contents_decoded = None
+        self._list_items = None
+
+    def _decode_contents(self):
+        if self._contents_decoded is None:
+            try:
+                self._contents_decoded = tornado.escape.json_decode(self._contents)
+            except:
+                logging.getLogger("List").exception("JSON decoding exception.")
+                self._contents_decoded = {}
+        return self._contents_decoded
+
+    @property
+    def contents(self):
+        if self._contents is None:
+            contents_decoded = dict(self._contents_decoded)
+            contents_decoded['list_items'] = [elem.to_dict() for elem in self._list_items]
+            self._contents = tornado.escape.json_encode(contents_decoded)
+        return self._contents
+
+    @property
+    def list_items(self):
+        if self._list_items is None:
+            self._list_items = []
+            for list_item_encoded in self._decode_contents().get('list_items', []):
+                # Items used to be stored as JSON strings within the
+                # contents, and are now stored as JSON objects.
+                if isinstance(list_item_encoded, basestring):
+                    list_item = ListItem.from_json(list_item_encoded)
+                else:
+                    list_item = ListItem.from_dict(list_item_encoded)
+                if list_item:
+                    self._list_items.append(list_item)
+        return self._list_items
+
+    @property
+    def title(self):
+        return self.get_title()
             
     def get_title(self):
-        try:
-            contents_decoded = tornado.escape.json_decode(self.contents)
-        except:
-            logger.exception("JSON decoding exception.")
-            return None
-        return contents_decoded.get("title", "")            
+        return self._decode_contents().get("title", "")
             
     def create_item(self, title=None, url=None, notes=None):
         if len(self.list_items) == 0:
@@ -60,17 +95,42 @@ class List(object):
             title = "List item title"
         list_item = ListItem(new_ident, title, url, notes)
         self.list_items.append(list_item)
-        
-        contents_decoded = tornado.escape.json_decode(self.contents)
-        contents_decoded['list_items'] = [elem.to_json() for elem in self.list_items]
-        self.contents = tornado.escape.json_encode(contents_decoded)
+        self._contents = None
+
+    def get_item(self, ident):
+        """ Return the item with 'ident', or None if there isn't one. """
+        for list_item in self.list_items:
+            if list_item.ident == ident:
+                return list_item
+        return None
+
+    def update_item(self, ident, title=None, url=None, notes=None):
+        """ Returns False if there is no item with 'ident'. """
+        list_item = self.get_item(ident)
+        if not list_item:
+            return False
+        if title:
+            list_item.title = title
+        list_item.url = url
+        list_item.notes = notes
+        self._contents = None
+        return True
+
+    def delete_item(self, ident):
+        """ Returns False if there is no item with 'ident'. """
+        list_item = self.get_item(ident)
+        if not list_item:
+            return False
+        self.list_items.remove(list_item)
+        self._contents = None
+        return True
 
     def get_value_from_contents(self, key, default_value=None):
-        contents_decoded = tornado.escape.json_decode(self.contents)
-        return contents_decoded.get(key, default_value)
+        return self._decode_contents().get(key, default_value)
         
     def __repr__(self):
-        key_value_pairs = ["%s=%s" % (key, getattr(self, key)) for key in self.ALL_KEYS]
+        # Only the cheap keys, so that logging a List doesn't decode it.
+        key_value_pairs = ["%s=%s" % (key, getattr(self, key)) for key in self.REQUIRED_KEYS]
         output = "{List. %s}" % (", ".join(key_value_pairs), )
         return output
 
@@ -1,15 +1,19 @@
 import tornado.escape
 
 class ListItem(object):
-    REQUIRED_KEYS = ["ident", "title"]   
+    REQUIRED_KEYS = ["ident", "title"]
     ALL_KEYS = ["ident", "title", "url", "notes"]
 
+    # A list can have many items, and every item of every list on a page
+    # gets an object, so don't give each one a __dict__.
+    __slots__ = ["ident", "title", "_url", "_notes"]
+
     def __init__(self, ident, title, url=None, notes=None):
         self.ident = ident
         self.title = title
         self._url = url
-        self._notes = notes        
-    
+        self._notes = notes
+
     @property
     def url(self):
         if not self._url:
@@ -18,7 +22,7 @@ class ListItem(object):
     @url.setter
     def url(self, url):
         self._url = url
-        
+
     @property
     def notes(self):
         if not self._notes:
@@ -27,37 +31,52 @@ class ListItem(object):
     @notes.setter
     def notes(self, notes):
         self._notes = notes
-    
+
     def __repr__(self):
         output = "{ListItem. ident=%s, title=%s, url=%s, notes=%s}" % (self.ident, self.title, self.url, self.notes)
         return output
-        
+
     @staticmethod
-    def is_valid_json_representation(json_string):        
-        try:
-            decoded = tornado.escape.json_decode(json_string)
-        except:
+    def is_valid_dict_representation(decoded):
+        if not isinstance(decoded, dict):
             return False
         if not all(key in decoded for key in ListItem.REQUIRED_KEYS):
             return False
         return True
 
     @staticmethod
-    def from_json(json_string):
-        if not ListItem.is_valid_json_representation(json_string):
+    def is_valid_json_representation(json_string):
+        try:
+            decoded = tornado.escape.json_decode(json_string)
+        except:
+            return False
+        return ListItem.is_valid_dict_representation(decoded)
+
+    @staticmethod
+    def from_dict(decoded):
+        """ Build a ListItem from its already decoded JSON object, or
+        return None if it isn't valid. """
+        if not ListItem.is_valid_dict_representation(decoded):
             return None
-        decoded = tornado.escape.json_decode(json_string)
         return ListItem(ident = decoded['ident'],
                         title = decoded['title'],
                         url = decoded.get('url', None),
                         notes = decoded.get('notes', None))
 
-    def to_json(self):
+    @staticmethod
+    def from_json(json_string):
+        if not ListItem.is_valid_json_representation(json_string):
+            return None
+        return ListItem.from_dict(tornado.escape.json_decode(json_string))
+
+    def to_dict(self):
         encoded = {}
         for key in self.ALL_KEYS:
             value = getattr(self, key)
             if (key in self.REQUIRED_KEYS) or \
                (key not in self.REQUIRED_KEYS and value is not None):
-                encoded[key] = value                            
-        return tornado.escape.json_encode(encoded)
-        
\ No newline at end of file
+                encoded[key] = value
+        return encoded
+
+    def to_json(self):
+        return tornado.escape.json_encode(self.to_dict())
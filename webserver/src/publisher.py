@@ -0,0 +1,157 @@
+# ----------------------------------------------------------------------------
+#   Static pages of lists for nginx to serve.
+#
+#   Lists are public, and the page of a list for an anonymous reader only
+#   changes when the list is written. So after every write the server
+#   renders that page and publishes it under publish_path, see
+#   BaseListHandler.publish_list() in ListHandler.py, as
+#
+#       <publish_path>/list/<url safe list_id>/read.html
+#       <publish_path>/list/<url safe list_id>/read.html.gz
+#
+#   and nginx serves anonymous requests for /list/<id>/read from there,
+#   passing the request on to the server if there is no file, see
+#   infrastructure/nginx.conf. Deleting a list removes its files.
+#
+#   Every file is written to a temporary file in the same directory and
+#   renamed over the old one, so nginx never sees a partial page. If a
+#   page can't be rendered or written, the published page is removed,
+#   as nginx would otherwise serve an old revision for good. The
+#   writing is done by a background thread so that the IOLoop doesn't
+#   wait for the disk. The modification time of a page is the
+#   datetime_edited of the revision it shows, which nginx sends as
+#   Last-Modified, and a page is never replaced by one of an older
+#   revision, e.g. when two processes publish the same list at once.
+# ----------------------------------------------------------------------------
+
+import os
+import gzip
+import time
+import Queue
+import errno
+import logging
+import calendar
+import tempfile
+import threading
+import cStringIO
+
+from tornado.options import define, options
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("publish_path", default=None, help="Directory to publish the pages of lists to for nginx to serve to anonymous readers. None disables publishing.")
+# ----------------------------------------------------------------------------
+
+COMPRESS_LEVEL = 9
+PAGE_NAME = "read.html"
+# Mode of published files and directories, which nginx must be able to read.
+FILE_MODE = 0644
+DIRECTORY_MODE = 0755
+
+class ListPublisher(object):
+    def __init__(self, path):
+        self.path = path
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="ListPublisher")
+        self.thread.daemon = True
+
+        # Written only by the writer thread.
+        self.published = 0
+        self.unpublished = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def start(self):
+        self.thread.start()
+
+    def get_page_path(self, url_safe_list_id):
+        return os.path.join(self.path, "list", url_safe_list_id, PAGE_NAME)
+
+    def publish(self, url_safe_list_id, body, datetime_edited):
+        """ Publish body, the page of the list url_safe_list_id at the
+        revision edited at datetime_edited, a naive UTC datetime. """
+        self.queue.put((self.write_page, (url_safe_list_id, body, datetime_edited)))
+
+    def unpublish(self, url_safe_list_id):
+        """ Remove the page of the list url_safe_list_id. """
+        self.queue.put((self.remove_page, (url_safe_list_id, )))
+
+    def run(self):
+        logger = logging.getLogger("ListPublisher.run")
+        while True:
+            (function, args) = self.queue.get()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Failed to publish.")
+                self.errors += 1
+
+    def write_page(self, url_safe_list_id, body, datetime_edited):
+        try:
+            self._write_page(url_safe_list_id, body, datetime_edited)
+        except Exception:
+            # Don't leave the page of an older revision, or half of this
+            # one, for nginx to serve.
+            self.remove_page(url_safe_list_id)
+            raise
+
+    def _write_page(self, url_safe_list_id, body, datetime_edited):
+        logger = logging.getLogger("ListPublisher._write_page")
+        path = self.get_page_path(url_safe_list_id)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, DIRECTORY_MODE)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        modification_time = calendar.timegm(datetime_edited.utctimetuple()) + datetime_edited.microsecond / 1e6
+        try:
+            if os.stat(path).st_mtime > modification_time:
+                logger.debug("newer page already published. path: %s", path)
+                self.skipped += 1
+                return
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        output = cStringIO.StringIO()
+        gzip_file = gzip.GzipFile(mode="wb", fileobj=output, compresslevel=COMPRESS_LEVEL, mtime=0)
+        gzip_file.write(body)
+        gzip_file.close()
+        # nginx checks for the .gz first, so write it first.
+        write_file_atomically(path + ".gz", output.getvalue(), modification_time)
+        write_file_atomically(path, body, modification_time)
+        logger.debug("published. path: %s", path)
+        self.published += 1
+
+    def remove_page(self, url_safe_list_id):
+        path = self.get_page_path(url_safe_list_id)
+        for filename in (path, path + ".gz"):
+            try:
+                os.remove(filename)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self.unpublished += 1
+
+    def get_statistics(self):
+        return {"waiting": self.queue.qsize(),
+                "published": self.published,
+                "unpublished": self.unpublished,
+                "skipped": self.skipped,
+                "errors": self.errors}
+
+def write_file_atomically(path, data, modification_time):
+    """ Replace the file at path with one that holds data, last modified
+    at modification_time, seconds since the epoch. """
+    (fd, temporary_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(temporary_path, FILE_MODE)
+        os.utime(temporary_path, (time.time(), modification_time))
+        os.rename(temporary_path, path)
+    except:
+        os.remove(temporary_path)
+        raise
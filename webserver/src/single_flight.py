@@ -0,0 +1,72 @@
+# ----------------------------------------------------------------------------
+#   Request coalescing ("single-flight") for cache misses.
+#
+#   When a popular cached result expires or is invalidated, every request
+#   that wants it at that moment misses the cache. Without coalescing each
+#   of them runs the same database query. With it, the first caller to
+#   miss a key in a worker becomes the leader for that key and runs the
+#   query; callers that miss the same key while the leader is still
+#   working wait for the leader's result instead:
+#
+#       if self.single_flight.is_in_flight(key):
+#           value = yield tornado.gen.Task(self.single_flight.wait, key)
+#       else:
+#           self.single_flight.start(key)
+#           ...
+#           self.single_flight.finish(key, value)
+#
+#   This only coalesces callers within one worker process, and everything
+#   here is only ever touched from the IOLoop thread. See
+#   DatabaseManager.execute_cached_db_statement() for the optional redis
+#   lock that coalesces across workers.
+# ----------------------------------------------------------------------------
+
+import logging
+
+import tornado.stack_context
+
+class SingleFlight(object):
+    def __init__(self):
+        # key -> list of callbacks waiting for the leader's result.
+        self.in_flight = {}
+
+        self.leaders = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def is_in_flight(self, key):
+        return key in self.in_flight
+
+    def start(self, key):
+        """ The caller is the leader for key, and must call finish() when
+        it has the result, even if it fails to get one. """
+        assert(key not in self.in_flight)
+        self.in_flight[key] = []
+        self.leaders += 1
+
+    def wait(self, key, callback):
+        """ Call callback with the leader's result for key. If the leader
+        failed then callback is called with None, and the caller has to
+        get the result itself. """
+        # Run the callback in the waiting caller's stack context, rather
+        # than the leader's, so that errors are handled by the request
+        # that waited.
+        self.in_flight[key].append(tornado.stack_context.wrap(callback))
+        self.coalesced += 1
+
+    def finish(self, key, value):
+        """ Hand value, the result for key, to every caller waiting for
+        it. A value of None means the leader failed. """
+        logger = logging.getLogger("SingleFlight.finish")
+        callbacks = self.in_flight.pop(key)
+        logger.debug("key: %s, number of waiting callers: %s", key, len(callbacks))
+        if value is None:
+            self.failures += 1
+        for callback in callbacks:
+            callback(value)
+
+    def get_statistics(self):
+        return {"in_flight": len(self.in_flight),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "failures": self.failures}
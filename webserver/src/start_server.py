@@ -6,12 +6,14 @@ import tornado.web
 import tornado.auth
 import tornado.escape
 import tornado.httpserver
+import tornado.process
 
 import tornado.options
 from tornado.options import define, options
 
 import os
 import sys
+import time
 import json
 import base64
 import uuid
@@ -35,9 +37,19 @@ from ListHandler import ListCreateItemHandler
 from ListHandler import ListUpdateItemHandler
 from ListHandler import ListDeleteItemHandler
 
+from MetricsHandler import MetricsHandler
+from HealthHandler import HealthHandler
+
 from model.List import List
 from model.ListItem import ListItem
 
+import compaction
+import database
+import user_session
+import async_logging
+import metrics
+import assets
+
 # ----------------------------------------------------------------------
 #   Constants.
 # ----------------------------------------------------------------------
@@ -97,9 +109,9 @@ class MainHandler(BasePageHandler):
         logger = logging.getLogger("MainHandler.get")
         logger.debug("entry.")
         if self.current_user:
-            logger.debug("Current user is authorized as: %s" % (self.current_user, ))
+            logger.debug("Current user is authorized as: %s", self.current_user)
             new_url = self.reverse_url("ListsHandler")
-            logger.debug("Redirecting to: %s" % (new_url, ))
+            logger.debug("Redirecting to: %s", new_url)
             self.redirect(new_url)
             return
         data = {}
@@ -109,6 +121,27 @@ class MainHandler(BasePageHandler):
         data['title'] = "Help Me Shop"              
         self.render("index.html", **data)            
 
+@tornado.gen.engine
+def start_up(application):
+    """ Create this process's DatabaseManager and UserSessionManager,
+    rather than on the first request, and wait for their connections.
+    Then, if cache_warm_up_lists is set, fill the cache, which all the
+    processes share, see DatabaseManager.warm_up(); only the first
+    process warms up. Only then does /health report the process as
+    ready. Call after the server has forked. """
+    logger = logging.getLogger("start_up")
+    start = time.time()
+    application.db = database.DatabaseManager()
+    application.user_session = user_session.UserSessionManager()
+    yield [tornado.gen.Task(application.db.open),
+           tornado.gen.Task(application.user_session.open)]
+    logger.info("opened connections in %.2fs", time.time() - start)
+    if options.cache_warm_up_lists > 0 and tornado.process.task_id() in (None, 0):
+        start = time.time()
+        number_of_lists = yield tornado.gen.Task(application.db.warm_up, options.cache_warm_up_lists)
+        logger.info("warmed up the cache with %s lists in %.2fs", number_of_lists, time.time() - start)
+    application.ready = True
+
 class Application(tornado.web.Application):
     def __init__(self):
         handlers = [
@@ -126,16 +159,21 @@ class Application(tornado.web.Application):
             tornado.web.URLSpec(pattern=r"/list/create",       handler_class=ListCreateHandler, name="ListCreateHandler"),
             tornado.web.URLSpec(pattern=r"/list/(.*)/read",    handler_class=ListReadHandler, name="ListReadHandler"),            
             #tornado.web.URLSpec(pattern=r"/list/(.*)/update", handler_class=ListUpdateHandler, name="ListUpdateHandler"),
-            tornado.web.URLSpec(pattern=r"/list/(.*)/delete",  handler_class=ListDeleteHandler, name="ListDeleteHandler"),
+            tornado.web.URLSpec(pattern=r"/list/([^/]*)/delete", handler_class=ListDeleteHandler, name="ListDeleteHandler"),
             
             tornado.web.URLSpec(pattern=r"/list/(.*)/item/create",       handler_class=ListCreateItemHandler, name="ListCreateItemHandler"),
             #tornado.web.URLSpec(pattern=r"/list/(.*)/item/(.*)/read",   handler_class=ListReadItemHandler, name="ListReadItemHandler"),
             tornado.web.URLSpec(pattern=r"/list/(.*)/item/(.*)/update", handler_class=ListUpdateItemHandler, name="ListUpdateItemHandler"),
             tornado.web.URLSpec(pattern=r"/list/(.*)/item/(.*)/delete", handler_class=ListDeleteItemHandler, name="ListDeleteItemHandler"),
+
+            tornado.web.URLSpec(pattern=r"/metrics",           handler_class=MetricsHandler, name="MetricsHandler"),
+            tornado.web.URLSpec(pattern=r"/health",            handler_class=HealthHandler, name="HealthHandler"),
         ]
         settings = dict(
             template_path=os.path.join(os.path.dirname(__file__), 'templates'),
             static_path=os.path.join(os.path.dirname(__file__), 'static'),
+            static_handler_class=assets.AssetFileHandler,
+            ui_methods={"asset_urls": assets.asset_urls},
             xsrf_cookies=True,
             gzip=True,
             
@@ -157,6 +195,8 @@ class Application(tornado.web.Application):
         if options.debug_mode:
             settings['debug'] = True
         tornado.web.Application.__init__(self, handlers, **settings)
+        # Set by start_up().
+        self.ready = False
 
 if __name__ == "__main__":
     logger.info("starting")
@@ -167,13 +207,18 @@ if __name__ == "__main__":
     config_filepath = os.path.join(os.path.dirname(__file__), "server.conf")
     assert(os.path.isfile(config_filepath))    
     tornado.options.parse_config_file(config_filepath)    
+    logging.getLogger().setLevel(options.log_level.upper())
     
     #!!AI causes the execution to freeze, debug later.
     #tornado.options.parse_command_line()
     # ------------------------------------------------------------------------        
 
-    logger.debug("start listening on port %s" % (options.http_listen_port, ))
-    http_server = tornado.httpserver.HTTPServer(Application(),
+    logger.debug("start listening on port %s", options.http_listen_port)
+    application = Application()
+    if options.use_built_assets:
+        # Fail now rather than on the first page if assets.py wasn't run.
+        assets.load_manifest(application.settings["static_path"])
+    http_server = tornado.httpserver.HTTPServer(application,
                                                 xheaders=True)
     http_server.bind(port = options.http_listen_port,
                      address = options.http_listen_ip_address)
@@ -185,5 +230,9 @@ if __name__ == "__main__":
         number_of_processes = options.number_of_processes
         
     http_server.start(number_of_processes)    
+    async_logging.start()
+    metrics.start()
+    compaction.start()
+    start_up(application)
     tornado.ioloop.IOLoop.instance().start()
     
@@ -1,12 +1,13 @@
 import os
 import sys
+import time
 
 import tornado
+import tornado.gen
 from tornado.options import define, options
-import redis
 import logging
 
-import user_session
+from async_redis import create_redis_client
 
 # ----------------------------------------------------------------------------
 #   Configuration constants. Note that the redis hostname and port are
@@ -14,101 +15,205 @@ import user_session
 #   of doing this.
 # ----------------------------------------------------------------------------
 define("redis_database_id_for_user_sessions", default=None, type=int, help="Database ID for user sessions")
+define("session_expiry_window", default=60 * 60, type=int, help="Seconds of inactivity after which a user session expires")
+define("session_refresh_threshold", default=0.0, type=float, help="Fraction of session_expiry_window after which an active session's expiry is pushed back. 0 disables sliding expiry")
 # ----------------------------------------------------------------------------
 
+# ----------------------------------------------------------------------------
+#   A user's session is a redis hash keyed by their user_id, e.g.
+#
+#       <user_id> -> {"authentication_type": "google"}
+#
+#   with an expiry time. The hash exists if and only if the user is logged
+#   in.
+#
+#   Every request handler gets its own UserSession object, which loads the
+#   hash and its TTL once, in a single pipelined round-trip, and then
+#   answers every question about the session from memory. Changes to the
+#   session are queued and written in one pipeline by flush(). The
+#   request handlers flush in on_finish(), or straight away when the
+#   change must be visible to the user's next request, i.e. on log in and
+#   log out.
+#
+#   Sessions expire session_expiry_window seconds after they were last
+#   refreshed. On log in we refresh the session. With sliding expiry,
+#   i.e. a non-zero session_refresh_threshold, we also refresh the
+#   session of a user who is active once session_refresh_threshold of
+#   the window has passed since the last refresh. Writing EXPIRE on
+#   every request would double the redis write traffic, so the time of
+#   the last refresh is kept in the signed "user" cookie,
+#
+#       <user_id>|<last refresh, seconds since the epoch>
+#
+#   and most requests only need to read the cookie to know that no
+#   refresh is due.
+# ----------------------------------------------------------------------------
 class UserSessionManager(object):
+    COOKIE_SEPARATOR = "|"
+
     def __init__(self):
         # Start a connection to the redis to the database ID that stores
         # the user session data.
-        self.r = redis.StrictRedis(host=options.redis_hostname,
-                                   port=options.redis_port,
-                                   db=options.redis_database_id_for_user_sessions)
-        #self.r.flushdb()            
-        
-    def is_user_authorized(self, user_id):
-        """ Determine if a given user_id is authorized to be
-        performing operations."""
-        logger = logging.getLogger("UserSessionManager.is_user_authorized")
-        logger.debug("Entry. user_id: %s" % (user_id, ))
-        if self.r.exists(user_id):
-            return_value = True
+        self.r = create_redis_client(options.redis_database_id_for_user_sessions)
+        self.expiry_window = options.session_expiry_window
+        self.refresh_threshold = options.session_refresh_threshold
+
+        # Counters, to check that sessions cost at most one round-trip per
+        # request unless the session is changed.
+        self.sessions_loaded = 0
+        self.round_trips = 0
+        self.requests_with_extra_round_trips = 0
+        self.expiry_refreshes = 0
+
+    def open(self, callback):
+        """ Wait for a connection to redis. """
+        self.r.execute_command("PING", callback=lambda response: callback())
+
+    def get_session(self, user_id, data=None):
+        """ Return a new UserSession for user_id. If data is None the
+        session must be load()ed before use, otherwise data is taken to
+        be the current session data. """
+        return UserSession(self, user_id, data)
+
+    def encode_cookie(self, user_id, refreshed_at=None):
+        """ Return the value of the "user" cookie for user_id, whose
+        session was last refreshed at refreshed_at, default now. """
+        if refreshed_at is None:
+            refreshed_at = time.time()
+        return "%s%s%d" % (user_id, self.COOKIE_SEPARATOR, refreshed_at)
+
+    def decode_cookie(self, value):
+        """ Return (user_id, refreshed_at) from the value of the "user"
+        cookie. Cookies set before sliding expiry existed only contain
+        the user_id, in which case refreshed_at is None. """
+        (user_id, _, refreshed_at) = value.partition(self.COOKIE_SEPARATOR)
+        try:
+            refreshed_at = int(refreshed_at)
+        except ValueError:
+            refreshed_at = None
+        return (user_id, refreshed_at)
+
+    def is_refresh_due(self, session, refreshed_at, now=None):
+        """ Determine if an authorized session, last refreshed at
+        refreshed_at, should have its expiry time pushed back. If
+        refreshed_at isn't known we fall back on the session's TTL. """
+        if self.refresh_threshold <= 0:
+            return False
+        if now is None:
+            now = time.time()
+        if refreshed_at is not None:
+            elapsed = now - refreshed_at
+        elif session.ttl is not None:
+            elapsed = self.expiry_window - session.ttl
         else:
-            return_value = False
-        logger.debug("returning: %s" % (return_value, ))
-        return return_value
-        
-    def deauthorize_user(self, user_id):
-        """ Mark a given user ID as no longer authorized to
-        perform operations. Could do this if they e.g. log out,
-        are deleted, etc. """
-        logger = logging.getLogger("UserSessionManager.deauthorize_user")
-        logger.debug("Entry. user_id: %s" % (user_id, ))      
-        assert(self.is_user_authorized(user_id))
-        self.r.delete(user_id)
-        
-    def authorize_user(self, user_id, authentication_type):
-        """ Mark a given user ID as permitted to perform operations
-        on the server.
-        
+            # The session has no expiry time at all.
+            return True
+        return elapsed >= self.refresh_threshold * self.expiry_window
+
+    def record_request(self, session):
+        """ Called when a request that used 'session' finishes. """
+        logger = logging.getLogger("UserSessionManager.record_request")
+        self.round_trips += session.round_trips
+        if session.round_trips > 1:
+            self.requests_with_extra_round_trips += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("user_id: %s, round trips: %s, statistics: %s", session.user_id, session.round_trips, self.get_statistics())
+
+    def get_statistics(self):
+        return {"sessions_loaded": self.sessions_loaded,
+                "round_trips": self.round_trips,
+                "requests_with_extra_round_trips": self.requests_with_extra_round_trips,
+                "expiry_refreshes": self.expiry_refreshes}
+
+class UserSession(object):
+    AUTHENTICATION_TYPES = ["facebook", "google", "twitter", "browserid", "api"]
+
+    def __init__(self, manager, user_id, data=None):
+        self.manager = manager
+        self.user_id = user_id
+        self.data = data
+        self.ttl = None
+        self.pending_commands = []
+        self.round_trips = 0
+
+    @tornado.gen.engine
+    def load(self, callback):
+        """ Load the session hash and its TTL in one round-trip. """
+        logger = logging.getLogger("UserSession.load")
+        logger.debug("Entry. user_id: %s", self.user_id)
+        (data, ttl) = yield tornado.gen.Task(self.manager.r.pipeline,
+                                             [("HGETALL", self.user_id),
+                                              ("TTL", self.user_id)])
+        self.round_trips += 1
+        self.manager.sessions_loaded += 1
+        self.data = data
+        self.ttl = ttl
+        logger.debug("data: %s, ttl: %s", self.data, self.ttl)
+        callback(self)
+
+    def is_authorized(self):
+        """ Determine if the user is authorized to be performing
+        operations."""
+        assert(self.data is not None)
+        return len(self.data) != 0
+
+    def authorize(self, authentication_type):
+        """ Mark the user as permitted to perform operations on the
+        server.
+
         As the only way to get here is via an authentication handler
         we know how this user got authenticated (i.e. Google,
         Facebook, Twitter, BrowserID, or API call). Let's store that
         as the hash's first key. authentication_type, hence, is a
-        string from the following list:
-        -   "facebook"
-        -   "google"
-        -   "twitter"
-        -   "browserid"
-        -   "api"
-        
-        Also, set the user to expire in an hour.
-        """
-        logger = logging.getLogger("UserSessionManager.authorize_user")
-        logger.debug("Entry. user_id: %s, authentication_type: %s" % (user_id, authentication_type))        
-        assert(not self.is_user_authorized(user_id))
-        assert(authentication_type in ["facebook", "google", "twitter", "browserid", "api"])
-        self.r.hset(user_id, "authentication_type", authentication_type)        
-        self.set_user_expiry(user_id)
-    
-    def set_user_expiry(self, user_id, expiry_time = 60 * 60):
-        """ Set the user to expire in an hour. """
-        logger = logging.getLogger("UserSessionManager.set_user_expiry")
-        logger.debug("Entry. user_id: %s, expiry_time: %s" % (user_id, expiry_time))
-        self.r.expire(user_id, expiry_time)
-    
-    def get_all_user_session_data(self, user_id):
-        """ Return the user session data as a dictionary. If the user
-        is not authorized returns None."""
-        logger = logging.getLogger("UserSessionManager.get_all_user_session_data")
-        logger.debug("Entry. user_id: %s" % (user_id, ))        
-        if not self.is_user_authorized(user_id):
-            logger.debug("User is not authorized, so no data.")
-            return None
-        data = self.r.hgetall(user_id)
-        logger.debug("Returning: %s" % (data, ))
-        return data
-
-    def get_user_session_datum(self, user_id, key):
+        string from AUTHENTICATION_TYPES.
+
+        If the user is already authorized this just re-sets their
+        expiry time. """
+        logger = logging.getLogger("UserSession.authorize")
+        logger.debug("Entry. user_id: %s, authentication_type: %s", self.user_id, authentication_type)
+        assert(authentication_type in self.AUTHENTICATION_TYPES)
+        self.set("authentication_type", authentication_type)
+        self.set_expiry()
+
+    def deauthorize(self):
+        """ Mark the user as no longer authorized to perform operations.
+        Could do this if they e.g. log out, are deleted, etc. """
+        logger = logging.getLogger("UserSession.deauthorize")
+        logger.debug("Entry. user_id: %s", self.user_id)
+        assert(self.is_authorized())
+        self.data = {}
+        self.pending_commands = [("DEL", self.user_id)]
+
+    def set_expiry(self, expiry_time=None):
+        if expiry_time is None:
+            expiry_time = self.manager.expiry_window
+        self.ttl = expiry_time
+        self.pending_commands.append(("EXPIRE", self.user_id, expiry_time))
+
+    def get(self, key, default_value=None):
         """ Get a particular key from the user session data. """
-        logger = logging.getLogger("UserSessionManager.get_user_session_datum")
-        logger.debug("Entry. user_id: %s" % (user_id, key))        
-        if not self.is_user_authorized(user_id):
-            logger.debug("User is not authorized, so no data.")
-            return None
-        data = self.r.hget(user_id, key)
-        logger.debug("Returning: %s" % (data, ))
-        return data
-        
-    def set_user_session_datum(self, user_id, key, value):
+        return self.data.get(key, default_value)
+
+    def set(self, key, value):
         """ Set a key/value pair on the user session data. """
-        logger = logging.getLogger("UserSessionManager.set_user_session_datum")
-        logger.debug("Entry. user_id: %s, key: %s, value: %s" % (user_id, key, value))        
-        assert(self.is_user_authorized(user_id))
-        self.r.hset(user_id, key, value)
-        
-    def delete_user_session_datum(self, user_id, key):
+        self.data[key] = value
+        self.pending_commands.append(("HSET", self.user_id, key, value))
+
+    def delete(self, key):
         """ Delete a key/value pair."""
-        logger = logging.getLogger("UserSessionManager.delete_user_session_datum")
-        logger.debug("Entry. user_id: %s, key: %s" % (user_id, key))        
-        assert(self.is_user_authorized(user_id))
-        self.r.hdel(user_id, key)
+        assert(self.is_authorized())
+        self.data.pop(key, None)
+        self.pending_commands.append(("HDEL", self.user_id, key))
+
+    @tornado.gen.engine
+    def flush(self, callback):
+        """ Write all queued changes in one round-trip. """
+        logger = logging.getLogger("UserSession.flush")
+        if not self.pending_commands:
+            callback()
+            return
+        logger.debug("user_id: %s, commands: %s", self.user_id, self.pending_commands)
+        (commands, self.pending_commands) = (self.pending_commands, [])
+        yield tornado.gen.Task(self.manager.r.pipeline, commands)
+        self.round_trips += 1
+        callback()
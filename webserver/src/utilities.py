@@ -25,7 +25,7 @@ def validate_base64_parameter(parameter, is_uuid=True):
     
     Returns False is not valid, else returns True."""    
     logger = logging.getLogger("validate_base64_parameter")
-    logger.debug("entry. parameter: %s, is_uuid: %s" % (parameter, is_uuid))
+    logger.debug("entry. parameter: %s, is_uuid: %s", parameter, is_uuid)
     
     match = REGEXP_BASE64.search(parameter)    
     if not match: